@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Benchmark of package database generation.
+
+Builds the database of a repository of synthetic packages, once with a
+reference writer that builds the whole file with tarfile and gzip in
+memory, as `write_database_file` used to, and once for each compression of
+the streaming `iter_database_file`. Reports the time to the first block of
+output, the total time, the peak memory allocated while writing and the
+database size.
+
+Usage: python3 benchmarks/database.py [<count>] [<threads>]
+"""
+import os, sys, time, gzip, tarfile, tracemalloc
+from io import BytesIO
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from s3pac.package import Package, iter_database_file, zstandard
+from s3pac.package import write_desc_file, write_depends_file
+
+def reference_database_file(pkgs, files=None):
+    _file = BytesIO()
+    gz = gzip.GzipFile(fileobj=_file, mode='wb', mtime=0)
+    tar = tarfile.open(fileobj=gz, mode='w')
+
+    def _add(path, _file=None):
+        info = tarfile.TarInfo(path)
+        if _file:
+            info.size = _file.seek(0, 2)
+            _file.seek(0)
+        tar.addfile(info, _file)
+
+    for pkg in pkgs:
+        dirname = "%s-%s" % (pkg.name, pkg.version)
+        _add(dirname + "/")
+        descfile = BytesIO()
+        write_desc_file(descfile, pkg)
+        _add(dirname + "/desc", descfile)
+        dependsfile = BytesIO()
+        write_depends_file(dependsfile, pkg)
+        _add(dirname + "/depends", dependsfile)
+
+    tar.close()
+    gz.close()
+    yield _file.getvalue()
+
+def make_package(i):
+    return Package(repo="core", arch="x86_64", name="package%05d" % i,
+                   version="1.0-1", desc="Package number %d" % i,
+                   licenses=["MIT"], url="https://example.com/",
+                   builddate=datetime(2016, 1, 1), packager="Packager",
+                   size=1000 + i, provides=["libpackage%d.so" % i],
+                   depends=["glibc", "zlib", "openssl"],
+                   filename="package%05d-1.0-1-x86_64.pkg.tar.xz" % i,
+                   filesize=100 + i, md5sum="0" * 32, sha256sum="0" * 64,
+                   pgpsig="0" * 400, publishdate=datetime(2016, 1, 2))
+
+def measure(func):
+    start = time.perf_counter()
+    first = None
+    size = 0
+    for chunk in func():
+        size += len(chunk)
+        # skip the gzip header, which is available immediately
+        if first is None and size > 64:
+            first = time.perf_counter() - start
+    total = time.perf_counter() - start
+
+    # measure memory separately, as tracing slows down allocations
+    tracemalloc.start()
+    for chunk in func():
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first, total, peak, size
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    pkgs = [make_package(i) for i in range(count)]
+    executor = ThreadPoolExecutor(threads)
+
+    cases = [
+        ("reference", lambda: reference_database_file(pkgs)),
+        ("gz", lambda: iter_database_file(pkgs)),
+        ("gz/%d" % threads,
+         lambda: iter_database_file(pkgs, executor=executor)),
+        ("xz", lambda: iter_database_file(pkgs, compression='xz')),
+        ]
+    if zstandard is not None:
+        cases += [
+            ("zst", lambda: iter_database_file(pkgs, compression='zst')),
+            ("zst/mt", lambda: iter_database_file(pkgs, compression='zst',
+                                                  executor=executor)),
+            ]
+
+    print("%d packages" % count)
+    for name, func in cases:
+        first, total, peak, size = measure(func)
+        print("%-10s first %6.3f s  total %6.3f s  peak %7.1f MiB  "
+              "size %7.1f MiB" % (name, first, total, peak / 2**20,
+                                  size / 2**20))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""In-process stand-ins for the SimpleDB and S3 services used by s3pac.aws.
+
+`install` replaces the boto connection functions, so that the stores of
+`s3pac.aws` keep their data in memory. Each request to a service sleeps for
+the service `latency`, like a round trip to AWS, and is counted in the
+service `requests`. Only the requests made by `s3pac.aws` are supported.
+"""
+import re, time, threading
+from io import BytesIO
+
+import boto.sdb
+import boto.s3
+import boto.s3.key
+
+class _Service:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def _request(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+# -----------------------------------------------------------------------------
+
+# Items returned by a SimpleDB select without a LIMIT, per response.
+_SELECT_PAGE_SIZE = 100
+
+_TOKEN = re.compile(r'\s*(`[^`]*`|"(?:[^"]|"")*"|\(|\)|,|=|<|>|[A-Za-z]+|\*)')
+
+_SELECT = re.compile(r'SELECT (?P<fields>.*?) FROM `[^`]*`'
+                     r'(?: WHERE (?P<where>.*?))?'
+                     r'(?: ORDER BY `(?P<order>[^`]*)` (?P<dir>ASC|DESC))?'
+                     r'(?: LIMIT (?P<limit>\d+))?$')
+
+def _unquote(token):
+    if token[0] == '`':
+        return token[1:-1]
+    return token[1:-1].replace('""', '"')
+
+def _like(pattern):
+    regex = ""
+    escaped = False
+    for char in pattern:
+        if char == '\\' and not escaped:
+            escaped = True
+            continue
+        regex += ".*" if char == '%' and not escaped else re.escape(char)
+        escaped = False
+    return re.compile(regex + "$", re.S)
+
+def _values(attrs, name):
+    value = attrs.get(name)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+class _Parser:
+    """Parser of select conditions, returning predicates on attributes."""
+    def __init__(self, text):
+        self.tokens = []
+        pos = 0
+        while pos < len(text.rstrip()):
+            match = _TOKEN.match(text, pos)
+            if match is None:
+                raise ValueError("invalid query: %s" % text)
+            self.tokens.append(match.group(1))
+            pos = match.end()
+
+    def take(self, expected=None):
+        token = self.tokens.pop(0)
+        if expected is not None and token.upper() != expected:
+            raise ValueError("expected %s: %s" % (expected, token))
+        return token
+
+    def peek(self):
+        return self.tokens[0].upper() if self.tokens else None
+
+    def parse(self, binop='OR'):
+        preds = [self.parse('AND') if binop == 'OR' else self.atom()]
+        while self.peek() == binop:
+            self.take()
+            preds.append(self.parse('AND') if binop == 'OR' else self.atom())
+        if len(preds) == 1:
+            return preds[0]
+        if binop == 'OR':
+            return lambda attrs: any(pred(attrs) for pred in preds)
+        return lambda attrs: all(pred(attrs) for pred in preds)
+
+    def atom(self):
+        if self.peek() == '(':
+            self.take()
+            pred = self.parse()
+            self.take(')')
+            return pred
+        name = _unquote(self.take())
+        op = self.take().upper()
+        if op == 'IS':
+            self.take('NOT')
+            self.take('NULL')
+            return lambda attrs: bool(_values(attrs, name))
+        if op == 'IN':
+            self.take('(')
+            values = set([_unquote(self.take())])
+            while self.peek() == ',':
+                self.take()
+                values.add(_unquote(self.take()))
+            self.take(')')
+            return lambda attrs: any(value in values
+                                     for value in _values(attrs, name))
+        if op == 'LIKE':
+            regex = _like(_unquote(self.take()))
+            return lambda attrs: any(regex.match(value)
+                                     for value in _values(attrs, name))
+        if op == '=':
+            value = _unquote(self.take())
+            return lambda attrs: value in _values(attrs, name)
+        if op == '<':
+            value = _unquote(self.take())
+            return lambda attrs: any(v < value for v in _values(attrs, name))
+        if op == '>':
+            value = _unquote(self.take())
+            return lambda attrs: any(v > value for v in _values(attrs, name))
+        raise ValueError("unsupported operator: %s" % op)
+
+class _Item(dict):
+    def __init__(self, name, attrs):
+        super().__init__(attrs)
+        self.name = name
+
+class _ResultSet(list):
+    next_token = None
+
+class FakeSimpleDB(_Service):
+    """SimpleDB connection and domain."""
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.items = {}
+
+    def reset(self):
+        self.items.clear()
+        self.requests.clear()
+
+    def get_domain(self, name, validate=True):
+        if validate:
+            self._request('DomainMetadata')
+        return self
+
+    def put_attributes(self, item_name, attrs):
+        self._request('PutAttributes')
+        self.items.setdefault(item_name, {}).update(attrs)
+
+    def batch_put_attributes(self, items):
+        self._request('BatchPutAttributes')
+        if len(items) > 25:
+            raise ValueError("too many items: %d" % len(items))
+        for name, attrs in items.items():
+            self.items.setdefault(name, {}).update(attrs)
+
+    def batch_delete_attributes(self, items):
+        self._request('BatchDeleteAttributes')
+        if len(items) > 25:
+            raise ValueError("too many items: %d" % len(items))
+        for name in items:
+            self.items.pop(name, None)
+
+    def delete_attributes(self, item_name, attributes=None):
+        self._request('DeleteAttributes')
+        if attributes is None:
+            self.items.pop(item_name, None)
+            return
+        for name in attributes:
+            self.items.get(item_name, {}).pop(name, None)
+
+    def get_attributes(self, item_name, consistent_read=False):
+        self._request('GetAttributes')
+        return _Item(item_name, self.items.get(item_name, {}))
+
+    def _select(self, query):
+        match = _SELECT.match(query)
+        if match is None:
+            raise ValueError("invalid query: %s" % query)
+        pred = _Parser(match.group('where')).parse() \
+               if match.group('where') else None
+        items = [_Item(name, attrs) for name, attrs in
+                 sorted(self.items.items())
+                 if pred is None or pred(attrs)]
+        if match.group('order'):
+            order = match.group('order')
+            items.sort(key=lambda item: _values(item, order)[0],
+                       reverse=match.group('dir') == 'DESC')
+        if match.group('fields') != "*":
+            names = [_unquote(token) for token in
+                     match.group('fields').split(", ")]
+            items = [_Item(item.name, { name: item[name] for name in names
+                                        if name in item })
+                     for item in items]
+        limit = match.group('limit')
+        return items, int(limit) if limit else None
+
+    def _pages(self, items):
+        for i in range(0, len(items), _SELECT_PAGE_SIZE):
+            if i > 0:
+                self._request('Select')
+            yield from items[i:i+_SELECT_PAGE_SIZE]
+
+    def select(self, *args, next_token=None, consistent_read=False):
+        """Select with a domain, as `boto.sdb.domain.Domain.select`, which
+        fetches further pages as the results are read, or with a
+        connection, as `boto.sdb.connection.SDBConnection.select`, which
+        returns a single page."""
+        query = args[-1]
+        self._request('Select')
+        items, limit = self._select(query)
+        if len(args) == 1 and limit is None:
+            return self._pages(items)
+        start = int(next_token or 0)
+        limit = limit or _SELECT_PAGE_SIZE
+        results = _ResultSet(items[start:start+limit])
+        if start + limit < len(items):
+            results.next_token = str(start + limit)
+        return results
+
+# -----------------------------------------------------------------------------
+
+class _Key(BytesIO):
+    """S3 object, readable like `boto.s3.key.Key`."""
+    def __init__(self, bucket, name, data=b""):
+        super().__init__(data)
+        self.bucket = bucket
+        self.name = name
+
+    def set_contents_from_file(self, _file):
+        self.bucket._request('PutObject')
+        self.bucket.objects[self.name] = _file.read()
+
+class _MultiPartUpload:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.parts = {}
+
+    def upload_part_from_file(self, _file, part_num):
+        self.bucket._request('UploadPart')
+        self.parts[part_num] = _file.read()
+
+    def complete_upload(self):
+        self.bucket._request('CompleteMultipartUpload')
+        self.bucket.objects[self.name] = b"".join(
+            self.parts[num] for num in sorted(self.parts))
+
+    def cancel_upload(self):
+        self.bucket._request('AbortMultipartUpload')
+
+class _DeleteResult:
+    errors = []
+
+class FakeS3(_Service):
+    """S3 connection and bucket."""
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.objects = {}
+
+    def reset(self):
+        self.objects.clear()
+        self.requests.clear()
+
+    def get_bucket(self, name, validate=True):
+        if validate:
+            self._request('HeadBucket')
+        return self
+
+    def get_key(self, name):
+        self._request('GetObject')
+        if name not in self.objects:
+            return None
+        return _Key(self, name, self.objects[name])
+
+    def initiate_multipart_upload(self, name):
+        self._request('CreateMultipartUpload')
+        return _MultiPartUpload(self, name)
+
+    def delete_keys(self, names, quiet=False):
+        self._request('DeleteObjects')
+        if len(names) > 1000:
+            raise ValueError("too many keys: %d" % len(names))
+        for name in names:
+            self.objects.pop(name, None)
+        return _DeleteResult()
+
+    def generate_url(self, expires_in, method, bucket, key):
+        # presigned locally, without a request
+        return "https://%s.s3.amazonaws.com/%s?Expires=%d" % \
+            (bucket, key, expires_in)
+
+def install(latency=0.0):
+    """Make `s3pac.aws` use new stand-ins with the given latency, and
+    return them as a (simpledb, s3) pair."""
+    sdb = FakeSimpleDB(latency)
+    s3 = FakeS3(latency)
+    boto.sdb.connect_to_region = lambda *args, **kwargs: sdb
+    boto.s3.connect_to_region = lambda *args, **kwargs: s3
+    boto.s3.key.Key = _Key
+    return sdb, s3
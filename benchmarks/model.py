@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Microbenchmark of package metadata conversion.
+
+Loads and stores a number of packages with the SimpleDB converter table,
+once with the compiled conversion functions of `s3pac.model` and once with
+a plain loop over the properties, as `Model.convertdict` used to be.
+
+Usage: python3 benchmarks/model.py [<count>]
+"""
+import os, sys, time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from s3pac.model import LongProperty, DateTimeProperty
+from s3pac.package import Package
+
+_TO_SIMPLEDB = {
+    LongProperty: lambda v: "%020d" % (v + 2**63),
+    DateTimeProperty: datetime.isoformat,
+    }
+
+_FROM_SIMPLEDB = {
+    LongProperty: lambda v: int(v) - 2**63,
+    DateTimeProperty: datetime.fromisoformat,
+    }
+
+def reference_convertdict(convs, _dict):
+    result = {}
+    for name, prop in Package.__model_props__.items():
+        if name not in _dict:
+            continue
+        value = _dict.get(name)
+        conv = convs.get(prop.__class__, lambda v: v)
+        if prop.multiple:
+            if isinstance(value, list):
+                result[name] = list(map(conv, value))
+            else:
+                result[name] = [conv(value)]
+        else:
+            if isinstance(value, list):
+                result[name] = conv(value[0])
+            else:
+                result[name] = conv(value)
+    return result
+
+def reference_load(convs, _dict):
+    return Package(**reference_convertdict(convs, _dict))
+
+def reference_store(convs, pkg):
+    return reference_convertdict(convs,
+        { name: getattr(pkg, name) for name in Package.__model_properties__ })
+
+def compiled_load(convs, _dict):
+    return Package.load(convs, _dict)
+
+def compiled_store(convs, pkg):
+    return Package.store(convs, pkg)
+
+def make_package(i):
+    return Package(repo="core", arch="x86_64", name="package%d" % i,
+                   version="1.0-1", desc="Package number %d" % i,
+                   licenses=["MIT"], url="https://example.com/",
+                   builddate=datetime(2016, 1, 1), packager="Packager",
+                   size=1000 + i, provides=["libpackage%d.so" % i],
+                   depends=["glibc", "zlib", "openssl"],
+                   filename="package%d-1.0-1-x86_64.pkg.tar.xz" % i,
+                   filesize=100 + i, md5sum="0" * 32, sha256sum="0" * 64,
+                   publishdate=datetime(2016, 1, 2))
+
+def measure(func, args):
+    start = time.perf_counter()
+    for arg in args:
+        func(arg)
+    return time.perf_counter() - start
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    pkgs = [make_package(i) for i in range(count)]
+    items = [Package.store(_TO_SIMPLEDB, pkg) for pkg in pkgs]
+
+    print("%d packages" % count)
+    for name, load, store in [("reference", reference_load, reference_store),
+                              ("compiled", compiled_load, compiled_store)]:
+        tload = measure(lambda item: load(_FROM_SIMPLEDB, item), items)
+        tstore = measure(lambda pkg: store(_TO_SIMPLEDB, pkg), pkgs)
+        print("%-10s load %6.3f s  store %6.3f s" % (name, tload, tstore))
+
+if __name__ == '__main__':
+    main()
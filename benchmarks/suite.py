@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""Benchmark suite of s3pac on in-process SimpleDB and S3 stand-ins.
+
+For each repository size, fills a repository with synthetic packages and
+times package database operations and the main HTTP routes, through the
+Flask test client, against the AWS storage backend with SimpleDB and S3
+replaced by the stand-ins of `fakeaws`, which add `--latency` seconds to
+each request. Each operation is run `--repeat` times; the minimum, median
+and mean times and the number of SimpleDB and S3 requests of the last run
+are reported.
+
+Results are written as JSON to `--output`. With `--compare`, the median
+times are compared with those of an earlier results file.
+
+Usage: python3 benchmarks/suite.py [--sizes=1000,10000,100000]
+           [--latency=<seconds>] [--repeat=<count>] [--output=<file>]
+           [--compare=<file>]
+"""
+import os, io, sys, json, time, tarfile, platform, tempfile, statistics
+import argparse, subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import fakeaws
+from s3pac.package import Package, read_package_file, write_database_file
+
+REPO = "bench"
+ARCH = "x86_64"
+
+def make_package(i):
+    return Package(repo=REPO, arch=ARCH if i % 4 else "any",
+                   name="package%06d" % i, version="1.0-1",
+                   desc="Package number %d" % i, licenses=["MIT"],
+                   url="https://example.com/", builddate=datetime(2016, 1, 1),
+                   packager="Packager", size=1000 + i,
+                   provides=["libpackage%d.so" % i],
+                   depends=["glibc", "zlib", "openssl"],
+                   filename="package%06d-1.0-1-%s.pkg.tar.xz" % \
+                       (i, ARCH if i % 4 else "any"),
+                   filesize=100 + i, md5sum="0" * 32, sha256sum="0" * 64,
+                   publishdate=datetime(2016, 1, 2))
+
+def make_archive(name, nfiles=10):
+    """Return a package archive with `nfiles` files."""
+    pkginfo = "\n".join([
+        "pkgname = %s" % name, "pkgbase = %s" % name, "pkgver = 1.0-1",
+        "pkgdesc = Benchmark package", "url = https://example.com/",
+        "builddate = 1451606400", "packager = Packager", "size = 1000",
+        "arch = %s" % ARCH, "license = MIT", "depend = glibc", ""])
+    _file = io.BytesIO()
+    with tarfile.open(fileobj=_file, mode='w:xz') as tar:
+        members = [(".PKGINFO", pkginfo.encode('utf-8'))]
+        members += [("usr/share/%s/file%d" % (name, i), b"x" * 100)
+                    for i in range(nfiles)]
+        for path, data in members:
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return _file.getvalue()
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# -----------------------------------------------------------------------------
+
+class Suite:
+    def __init__(self, repeat, services):
+        self.repeat = repeat
+        self.services = services
+        self.results = {}
+
+    def measure(self, name, func, setup=None):
+        """Time `repeat` runs of `func`, passing the run number, and call
+        `setup` with the run number before each run, untimed."""
+        times = []
+        for run in range(self.repeat):
+            if setup:
+                setup(run)
+            for service in self.services:
+                service.requests.clear()
+            start = time.perf_counter()
+            func(run)
+            times.append(time.perf_counter() - start)
+        requests = {}
+        for service in self.services:
+            requests.update(service.requests)
+        self.results[name] = { 'min': min(times), 'max': max(times),
+                               'median': statistics.median(times),
+                               'mean': statistics.mean(times),
+                               'runs': len(times), 'requests': requests }
+        print("  %-28s median %9.4f s  min %9.4f s  requests %d" % \
+              (name, self.results[name]['median'], min(times),
+               sum(requests.values())), flush=True)
+
+def run_size(wsgi, sdb, s3, size, repeat):
+    pkgdb = wsgi.pkgdb
+    client = wsgi.app.test_client()
+    suite = Suite(repeat, [sdb, s3])
+
+    # fill the repository without latency
+    latency = sdb.latency, s3.latency
+    sdb.latency = s3.latency = 0.0
+    sdb.reset()
+    s3.reset()
+    pkgdb.package_cache.clear()
+    pkgdb._databases.clear()
+    pkgs = [make_package(i) for i in range(size)]
+    pkgdb.metadata.put(pkgs)
+    pkgdb._touch(REPO)
+    sdb.latency, s3.latency = latency
+
+    archive = make_archive("archive", 1000)
+    # packages for ARCH spread over the repository
+    sample = [pkgs[(i * size // repeat) | 1] for i in range(repeat)]
+    names = [pkg.name for pkg in sample]
+    filenames = [pkg.filename for pkg in sample]
+
+    # package module
+    suite.measure("read_package_file",
+                  lambda run: read_package_file(io.BytesIO(archive)))
+    suite.measure("write_database_file",
+                  lambda run: write_database_file(io.BytesIO(), pkgs))
+
+    # package database
+    suite.measure("publish", lambda run: pkgdb.publish_many(REPO, [
+        (io.BytesIO(make_archive("publish%d-%d" % (run, i))), None)
+        for i in range(10)]))
+    suite.measure("find", lambda run: pkgdb.find(repo=REPO,
+                  name=names[run]))
+    suite.measure("find_repo", lambda run: pkgdb.find(repo=REPO))
+    suite.measure("findone", lambda run: pkgdb.findone(repo=REPO,
+                  arch=ARCH, name=names[run]))
+    suite.measure("delete", lambda run: pkgdb.delete(repo=REPO, arch=ARCH,
+                  name="publish%d-0" % run))
+
+    def _uncached(run):
+        pkgdb._databases.clear()
+    suite.measure("database", lambda run: pkgdb.database(REPO, ARCH),
+                  setup=_uncached)
+
+    # http routes
+    def _get(url):
+        response = client.get(url)
+        response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError("%s: %d" % (url, response.status_code))
+
+    dburl = "/r/%s/%s/%s.db" % (REPO, ARCH, REPO)
+    suite.measure("GET database", lambda run: _get(dburl), setup=_uncached)
+    suite.measure("GET database cached", lambda run: _get(dburl))
+    suite.measure("GET package file", lambda run: _get("/r/%s/%s/%s" % \
+                  (REPO, ARCH, filenames[run])))
+    suite.measure("GET package", lambda run: _get("/p/%s/%s/%s" % \
+                  (REPO, ARCH, names[run])))
+    suite.measure("GET package list", lambda run: _get("/p/%s/?name=%s" % \
+                  (REPO, names[run])))
+
+    def _post(run):
+        response = client.post("/p/%s/" % REPO, data={ 'package': (
+            io.BytesIO(make_archive("post%d" % run)),
+            "post%d-1.0-1-%s.pkg.tar.xz" % (run, ARCH)) })
+        if response.status_code >= 400:
+            raise RuntimeError("POST: %d" % response.status_code)
+    suite.measure("POST package", _post)
+    return suite.results
+
+def compare(results, baseline):
+    print("%-8s %-28s %10s %10s %8s" % ("size", "operation", "baseline",
+                                        "current", "ratio"))
+    for size, ops in results['results'].items():
+        for name, result in ops.items():
+            old = baseline['results'].get(size, {}).get(name)
+            if old is None:
+                continue
+            print("%-8s %-28s %10.4f %10.4f %8.2f" % \
+                  (size, name, old['median'], result['median'],
+                   result['median'] / old['median']))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--sizes', default="1000,10000,100000")
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default="benchmark-results.json")
+    parser.add_argument('--compare', default=None)
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = args.compare and os.path.abspath(args.compare)
+
+    # run the server in a scratch directory with its own configuration
+    workdir = tempfile.mkdtemp(prefix="s3pac-bench-")
+    with open(os.path.join(workdir, "s3pac.conf.py"), 'w') as _file:
+        _file.write("STORAGE = 'aws'\n")
+    os.chdir(workdir)
+    sdb, s3 = fakeaws.install(args.latency)
+    from s3pac import wsgi
+
+    results = { 'version': git_version(), 'python': platform.python_version(),
+                'date': datetime.utcnow().isoformat(),
+                'latency': args.latency, 'repeat': args.repeat,
+                'results': {} }
+    for size in map(int, args.sizes.split(",")):
+        print("%d packages" % size, flush=True)
+        results['results'][str(size)] = run_size(wsgi, sdb, s3, size,
+                                                 args.repeat)
+
+    with open(output, 'w') as _file:
+        json.dump(results, _file, indent=2, sort_keys=True)
+    print("results written to %s" % output)
+
+    if baseline:
+        with open(baseline) as _file:
+            compare(results, json.load(_file))
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,132 @@ DATA_ROOT = "data"
 # Maximum upload size.
 MAX_CONTENT_LENGTH = 1024 * 1024 * 1024
 
+# Packages uploaded with the 'async' argument are spooled to DATA_ROOT and
+# published by up to PUBLISH_JOB_THREADS background jobs per server process.
+# The state of each job can be queried at /jobs/<id> for PUBLISH_JOB_TTL
+# seconds.
+PUBLISH_JOB_THREADS = 2
+PUBLISH_JOB_TTL = 86400
+
+# Package files can also be uploaded in chunks, e.g. by the s3pac command line
+# tool, to be resumed after interruptions. Chunks are kept in DATA_ROOT until
+# the package is published, or for UPLOAD_SESSION_TTL seconds after the last
+# chunk was received.
+UPLOAD_SESSION_TTL = 86400
+
+# Package lookups for downloads are cached in each server process. Up to
+# PACKAGE_CACHE_SIZE packages are kept for at most PACKAGE_CACHE_TTL seconds,
+# which bounds how long other processes may serve a replaced or deleted
+# package. Set PACKAGE_CACHE_SIZE to 0 to disable the cache.
+PACKAGE_CACHE_SIZE = 10000
+PACKAGE_CACHE_TTL = 60
+
+# File lists of packages, used to build the files databases (<repo>.files),
+# are stored next to the package files. Up to FILES_CACHE_SIZE file lists are
+# cached in each server process.
+FILES_CACHE_SIZE = 10000
+
+# Maximum number of concurrent storage operations. Independent operations,
+# such as package uploads when publishing several packages at once or the
+# queries and deletions of a single request, run concurrently, and must
+# complete within STORAGE_TIMEOUT seconds.
+STORAGE_THREADS = 8
+STORAGE_TIMEOUT = 60
+
+# Compression of package databases requested as <repo>.db or <repo>.files:
+# 'gz', 'xz' or 'zst' (requires the zstandard module). Explicit extensions
+# such as <repo>.db.tar.xz select the compression regardless. Databases are
+# compressed on up to DATABASE_COMPRESS_THREADS threads. The most recently
+# built DATABASE_CACHE_SIZE databases are kept in each server process.
+DATABASE_COMPRESSION = 'gz'
+DATABASE_COMPRESS_THREADS = 4
+DATABASE_CACHE_SIZE = 64
+
+# With DATABASE_SNAPSHOTS, the server process that publishes or deletes
+# packages then builds the databases of the repository for each architecture
+# in the background, compressed with DATABASE_COMPRESSION, and stores them in
+# the blob store named by their SHA-256 sum. Requests for those databases are
+# redirected to the stored snapshot, or, with DATABASE_SNAPSHOT_REDIRECT set to
+# False or a blob store without download URLs, the snapshot is sent by s3pac,
+# so that all servers and any CDN in front of them serve identical files
+# without building them. Until the snapshot of the latest change is stored,
+# databases are built as before. If DATABASE_SIGN_KEY names a gpg secret key
+# of the server user, snapshots are signed with it and the signatures served
+# as <repo>.db.sig and <repo>.files.sig.
+DATABASE_SNAPSHOTS = False
+DATABASE_SNAPSHOT_REDIRECT = True
+DATABASE_SIGN_KEY = None
+
+# Request durations, storage operation durations, database build times, cache
+# lookups and bytes sent are exported at /metrics in the Prometheus format.
+# Each server process writes its metrics to DATA_ROOT at most every
+# METRICS_INTERVAL seconds, and /metrics sums those of all processes. Metrics
+# of exited processes are kept; remove DATA_ROOT/metrics when restarting the
+# server to start from zero.
+METRICS_INTERVAL = 5.0
+
+# Package downloads are redirected to the blob store when it has download
+# URLs, such as presigned S3 URLs. If BLOB_CACHE_SIZE is set to a number of
+# bytes, they are instead served by s3pac from a cache of package files in
+# DATA_ROOT, filled from the blob store in the background on BLOB_CACHE_THREADS
+# threads per process after the first download, which is redirected, and
+# checked against the package checksums. The least recently downloaded files
+# are evicted to keep the cache within BLOB_CACHE_SIZE. Cached files are sent
+# with sendfile where the server supports it, or by a front-end web server
+# such as nginx if BLOB_CACHE_ACCEL_REDIRECT is set to the URL prefix of an
+# internal location serving DATA_ROOT/blobs, with the X-Accel-Redirect header.
+BLOB_CACHE_SIZE = 0
+BLOB_CACHE_THREADS = 2
+BLOB_CACHE_ACCEL_REDIRECT = None
+
+# Each server process connects to the storage backend on first use, and then
+# warms up its caches in the background for the repositories in WARMUP_REPOS:
+# package metadata, dependency indexes and package databases. /healthz answers
+# as soon as the process runs, and /readyz once the warm-up has completed, for
+# load balancer health checks during rolling restarts.
+WARMUP_REPOS = []
+
+# Requests to the ASGI application, s3pac.asgi:app, wait for storage
+# operations and for the WSGI application, which serves the routes without
+# async handlers, on up to ASGI_THREADS threads per server process.
+ASGI_THREADS = 64
+
+# Storage backend: 'aws' keeps package metadata in SimpleDB and package
+# files in S3, 'local' keeps metadata in an SQLite database and package files
+# in a local directory.
+STORAGE = 'aws'
+
 # AWS access credentials. Optional.
 AWS_ACCESS_KEY_ID = None
 AWS_SECRET_ACCESS_KEY = None
 
-# Storage configuration.
+# AWS storage configuration, used when STORAGE = 'aws'.
 AWS_REGION_NAME = 'eu-west-1'
 AWS_SDB_DOMAIN_NAME = 's3pac'
 AWS_S3_BUCKET_NAME = 'my-s3pac-bucket'
 AWS_S3_PREFIX = 'packages'
+
+# S3-compatible endpoint URL to use instead of AWS, e.g. a local S3 stand-in
+# for testing. Optional.
+AWS_S3_ENDPOINT = None
+
+# Package files are uploaded to S3 in parts of AWS_S3_PART_SIZE bytes (at
+# least 5 MiB), with up to AWS_S3_UPLOAD_THREADS parts in flight at a time.
+# Failed parts are retried up to AWS_S3_UPLOAD_RETRIES times.
+AWS_S3_PART_SIZE = 8 * 1024 * 1024
+AWS_S3_UPLOAD_THREADS = 4
+AWS_S3_UPLOAD_RETRIES = 3
+
+# Package downloads are redirected to presigned S3 URLs that expire after
+# AWS_S3_URL_EXPIRES seconds. Each URL is reused for AWS_S3_URL_REUSE
+# seconds, so a redirect is always valid for at least the difference.
+AWS_S3_URL_EXPIRES = 3600
+AWS_S3_URL_REUSE = 1800
+
+# Local storage configuration, used when STORAGE = 'local'. Paths are
+# relative to the server working directory. Package downloads are served by
+# s3pac itself, or redirected to LOCAL_BLOB_URL if it is set (e.g. a web
+# server serving LOCAL_BLOB_ROOT).
+LOCAL_DATABASE_PATH = "s3pac.sqlite"
+LOCAL_BLOB_ROOT = "packages"
+LOCAL_BLOB_URL = None
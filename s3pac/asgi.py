@@ -0,0 +1,282 @@
+"""ASGI entry point of the s3pac server.
+
+Serve with any ASGI server, e.g. `uvicorn s3pac.asgi:app`. The pacman
+repository interface at /r/, the bulk of the traffic, is answered by async
+handlers: package downloads are redirected to the blob store and database
+files are sent from the cache or streamed as they are built. Storage
+operations, which are blocking, run on a pool of ASGI_THREADS threads, so
+that waiting requests and slow clients hold no thread, only a coroutine.
+Everything else, including uploads and downloads served from local files,
+is passed on to the WSGI application of `s3pac.wsgi`, run on the same pool.
+"""
+import sys, time, asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException, ClientDisconnected
+from werkzeug.http import is_resource_modified, http_date
+
+from s3pac import wsgi
+from s3pac.package import is_package_filename
+
+# -----------------------------------------------------------------------------
+
+_executor = ThreadPoolExecutor(wsgi.app.config.get('ASGI_THREADS', 64))
+
+async def _run(func, *args):
+    """Run the blocking `func` with `args` on the thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args))
+
+class _RequestBody:
+    """Body of an ASGI request, readable as the WSGI input stream from a
+    thread other than that of the event loop."""
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = bytearray()
+        self.done = False
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self.receive(),
+                                                   self.loop).result()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        self.buffer += message.get('body', b"")
+        self.done = not message.get('more_body', False)
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        while not self.done and (size is None or size < 0 or
+                                 len(self.buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self.buffer)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        while not self.done and b"\n" not in self.buffer and \
+              (size is None or size < 0 or len(self.buffer) < size):
+            self._fill()
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        return self._take(end)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+def _environ(scope, body):
+    """Return the WSGI environment of the request of ASGI `scope`."""
+    server = scope.get('server') or ("localhost", 80)
+    client = scope.get('client') or ("", 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', "").encode('utf-8')
+                                                 .decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': "HTTP/%s" % scope.get('http_version', "1.1"),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', "http"),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace("-", "_")
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = "HTTP_" + name
+        environ[name] = environ[name] + "," + value if name in environ \
+                        else value
+    return environ
+
+def _start(status, headers):
+    return { 'type': 'http.response.start', 'status': status,
+             'headers': [(name.lower().encode('latin-1'),
+                          str(value).encode('latin-1'))
+                         for name, value in headers] }
+
+def _call_wsgi(environ, send, loop):
+    """Answer a request with the WSGI application, sending the response
+    from this thread."""
+    def _send(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [int(status.split(" ", 1)[0]), headers]
+
+    body = wsgi.app(environ, start_response)
+    try:
+        started = False
+        for data in body:
+            if not started:
+                _send(_start(*response))
+                started = True
+            if data:
+                _send({ 'type': 'http.response.body', 'body': data,
+                        'more_body': True })
+        if not started:
+            _send(_start(*response))
+        _send({ 'type': 'http.response.body', 'body': b"" })
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+# -----------------------------------------------------------------------------
+
+_OCTET_STREAM = ('Content-Type', 'application/octet-stream')
+
+async def _get_package_file(environ, repo, filename):
+    if wsgi.blob_cache is not None:
+        return None
+    pkg = await _run(wsgi.pkgdb.package_file, repo, filename)
+    if pkg is None:
+        return None
+    url = await _run(wsgi.pkgdb.url, pkg)
+    if url is None:
+        return None
+    return 302, [('Location', url)], b""
+
+async def _iter_chunks(chunks):
+    try:
+        while True:
+            chunk = await _run(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            await _run(chunks.close)
+
+async def _get_database_file(environ, repo, sysarch, files, compression):
+    pkgdb = wsgi.pkgdb
+    config = wsgi.app.config
+    compression = compression or config.get('DATABASE_COMPRESSION', 'gz')
+
+    stamp = await _run(pkgdb.stamp, repo)
+    etag = wsgi._database_etag(repo, sysarch, files, compression, stamp)
+    headers = [('ETag', '"%s"' % etag), ('Last-Modified', http_date(stamp))]
+    if not is_resource_modified(environ, etag=etag, last_modified=stamp):
+        return 304, headers, b""
+
+    snapshot = await _run(pkgdb.snapshot, repo, sysarch, stamp, files,
+                          compression)
+    if snapshot is not None:
+        url = None
+        if config.get('DATABASE_SNAPSHOT_REDIRECT', True):
+            url = await _run(pkgdb.blob_url, snapshot['keyname'])
+        if url is None:
+            return None
+        return 302, [('Location', url)], b""
+
+    headers.append(_OCTET_STREAM)
+    data = pkgdb.cached_database(repo, sysarch, stamp, files, compression)
+    if data is not None:
+        wsgi._database_cache.inc(('database', 'hit'))
+        return 200, headers + [('Content-Length', len(data))], data
+    try:
+        chunks = await _run(pkgdb.iter_database, repo, sysarch, stamp,
+                            files, compression)
+    except ValueError:
+        return None
+    wsgi._database_cache.inc(('database', 'miss'))
+    return 200, headers, _iter_chunks(chunks)
+
+async def _get_file(environ, repo, arch, filename):
+    """Async counterpart of `s3pac.wsgi.get_file`, returning None for the
+    requests to leave to it."""
+    if is_package_filename(filename):
+        return await _get_package_file(environ, repo, filename)
+    if filename.endswith(".sig"):
+        return None
+    for ext, files, compression in wsgi._DATABASE_EXTENSIONS:
+        if filename.endswith(ext):
+            return await _get_database_file(environ, repo, arch, files,
+                                            compression)
+    return None
+
+_TEXT_PLAIN = ('Content-Type', 'text/plain; charset=utf-8')
+
+async def _get_health(environ):
+    return 200, [_TEXT_PLAIN], b"ok\n"
+
+async def _get_readiness(environ):
+    # answered on the event loop, even while all threads are busy
+    status, body = wsgi._readiness()
+    return status, [_TEXT_PLAIN], body.encode('utf-8')
+
+# Routes of the WSGI application answered by async handlers.
+_HANDLERS = {
+    'get_file': _get_file,
+    'get_health': _get_health,
+    'get_readiness': _get_readiness,
+    }
+
+# -----------------------------------------------------------------------------
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            wsgi._start_warm_up()
+            await send({ 'type': 'lifespan.startup.complete' })
+        elif message['type'] == 'lifespan.shutdown':
+            await send({ 'type': 'lifespan.shutdown.complete' })
+            return
+
+async def app(scope, receive, send):
+    """ASGI application of the s3pac server."""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError("unsupported scope type: %s" % scope['type'])
+    # for servers not sending lifespan events
+    wsgi._start_warm_up()
+
+    loop = asyncio.get_running_loop()
+    environ = _environ(scope, _RequestBody(receive, loop))
+    start = time.perf_counter()
+    handler = None
+    if scope['method'] == 'GET':
+        try:
+            adapter = wsgi.app.url_map.bind_to_environ(environ)
+            endpoint, args = adapter.match()
+            handler = _HANDLERS.get(endpoint)
+        except HTTPException:
+            pass
+    response = await handler(environ, **args) if handler else None
+    if response is None:
+        return await _run(_call_wsgi, environ, send, loop)
+
+    status, headers, body = response
+    await send(_start(status, headers))
+    size = 0
+    if isinstance(body, bytes):
+        size = len(body)
+        await send({ 'type': 'http.response.body', 'body': body })
+    else:
+        try:
+            async for data in body:
+                size += len(data)
+                await send({ 'type': 'http.response.body', 'body': data,
+                             'more_body': True })
+        finally:
+            await body.aclose()
+        await send({ 'type': 'http.response.body', 'body': b"" })
+    wsgi.app.wsgi_app.observe(endpoint, scope['method'], str(status),
+                              time.perf_counter() - start, size)
@@ -0,0 +1,403 @@
+"""Storage backend on Amazon SimpleDB and S3."""
+import os, re, json, time, random, threading
+from io import BytesIO
+from datetime import datetime
+from http.client import HTTPException
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib import parse as urlparse
+from dateutil import parser as dateparser
+import boto.sdb
+import boto.s3
+import boto.s3.connection
+from boto.exception import BotoServerError
+
+from s3pac.cache import LRUCache
+from s3pac.model import LongProperty, DateTimeProperty
+from s3pac.package import Package
+from s3pac.storage import MetadataStore, BlobStore, BlobUpload
+
+# -----------------------------------------------------------------------------
+
+_FROM_SIMPLEDB = {
+    LongProperty: lambda v: int(v) - 2**63,
+    DateTimeProperty: dateparser.parse,
+    }
+
+_TO_SIMPLEDB = {
+    LongProperty: lambda v: "%020d" % (v + 2**63),
+    DateTimeProperty: datetime.isoformat,
+    }
+
+def _pkg_from_sdb(_dict):
+    return Package.load(_FROM_SIMPLEDB, _dict)
+
+def _sdb_from_pkg(pkg):
+    return Package.store(_TO_SIMPLEDB, pkg)
+
+# -----------------------------------------------------------------------------
+
+# Maximum number of items in a SimpleDB batch operation.
+_BATCH_SIZE = 25
+
+# Maximum number of values in a SimpleDB comparison.
+_QUERY_IN_SIZE = 20
+
+# Maximum number of items returned by a SimpleDB select.
+_SELECT_LIMIT = 2500
+
+# Changes are returned only once they are this many seconds old, so that
+# changes written concurrently by several processes, whose tokens are based on
+# the time, are all visible before a later token is returned.
+_CHANGES_SETTLE_TIME = 10
+
+_CHANGE_TOKEN = re.compile(r"[0-9a-f]{21}$")
+
+def _change_token(usecs):
+    """Return a change token for the time `usecs`, in microseconds since the
+    epoch, unique across processes."""
+    return "%015x%06x" % (usecs, random.getrandbits(24))
+
+def _quote(value):
+    return '"%s"' % value.replace('"', '""')
+
+class SimpleDBMetadataStore(MetadataStore):
+    """Package metadata storage in a SimpleDB domain.
+
+    Each thread connects to SimpleDB on first use, without checking the
+    domain, and keeps its connection for later requests.
+    """
+    batch_size = _BATCH_SIZE
+
+    def __init__(self, access_key_id, secret_access_key, region_name,
+                 domain_name):
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        self.region_name = region_name
+        self.sdb_domain_name = domain_name
+        self._local = threading.local()
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'domain', None) is None:
+            local.sdb = boto.sdb.connect_to_region(self.region_name,
+                aws_access_key_id=self.access_key_id,
+                aws_secret_access_key=self.secret_access_key)
+            local.domain = local.sdb.get_domain(self.sdb_domain_name,
+                                                validate=False)
+        return local
+
+    @property
+    def sdb(self):
+        return self._connection().sdb
+
+    @property
+    def sdb_domain(self):
+        return self._connection().domain
+
+    def _pkgitemname(self, pkg):
+        return os.path.join(pkg.repo, pkg.arch, pkg.name)
+
+    def _repoitemname(self, repo):
+        return os.path.join(repo, ".state")
+
+    def _changeitemname(self, repo, token):
+        return os.path.join(repo, ".changes", token)
+
+    def put(self, pkgs):
+        for i in range(0, len(pkgs), _BATCH_SIZE):
+            items = { self._pkgitemname(pkg): _sdb_from_pkg(pkg)
+                      for pkg in pkgs[i:i+_BATCH_SIZE] }
+            self.sdb_domain.batch_put_attributes(items)
+
+    def query(self, conds, fields=None, order=None, limit=None, token=None):
+        parts = []
+        conds = Package.convertvalues(_TO_SIMPLEDB, conds)
+        for name, values in conds.items():
+            if not isinstance(values, list):
+                values = [values]
+            if not values:
+                return iter([]), None
+            alts = []
+            exact = []
+            for value in values:
+                if value.startswith('%') or value.endswith('%'):
+                    escaped = value[1:-1].replace('%', '\\%')
+                    alts.append('`%s` LIKE %s' % \
+                        (name, _quote(value[0] + escaped + value[-1])))
+                else:
+                    exact.append(value)
+            if len(exact) == 1:
+                alts.append('`%s`=%s' % (name, _quote(exact[0])))
+            elif exact:
+                alts.extend('`%s` IN (%s)' % \
+                    (name, ", ".join(map(_quote, exact[i:i+_QUERY_IN_SIZE])))
+                    for i in range(0, len(exact), _QUERY_IN_SIZE))
+            parts.append(alts[0] if len(alts) == 1 else \
+                         "(%s)" % " OR ".join(alts))
+        if order:
+            # SimpleDB sorts only by attributes constrained by the query
+            parts.append('`%s` IS NOT NULL' % order.lstrip('-'))
+
+        query = "SELECT %s FROM `%s`" % \
+            (", ".join("`%s`" % name for name in fields) if fields else "*",
+             self.sdb_domain_name)
+        if parts:
+            query += " WHERE %s" % " AND ".join(parts)
+        if order:
+            query += " ORDER BY `%s` %s" % \
+                (order.lstrip('-'), "DESC" if order[0] == '-' else "ASC")
+        if limit is None:
+            results = self.sdb_domain.select(query, consistent_read=True)
+            return map(_pkg_from_sdb, results), None
+        query += " LIMIT %d" % min(limit, _SELECT_LIMIT)
+        results = self.sdb.select(self.sdb_domain, query, next_token=token,
+                                  consistent_read=True)
+        return list(map(_pkg_from_sdb, results)), results.next_token
+
+    def delete(self, pkgs):
+        for i in range(0, len(pkgs), _BATCH_SIZE):
+            items = { self._pkgitemname(pkg): None
+                      for pkg in pkgs[i:i+_BATCH_SIZE] }
+            self.sdb_domain.batch_delete_attributes(items)
+
+    def get_stamp(self, repo):
+        attrs = self.sdb_domain.get_attributes(self._repoitemname(repo),
+                                               consistent_read=True)
+        if 'stamp' not in attrs:
+            return None
+        return _FROM_SIMPLEDB[DateTimeProperty](attrs['stamp'])
+
+    def set_stamp(self, repo, stamp):
+        self.sdb_domain.put_attributes(self._repoitemname(repo),
+            { 'stamp': _TO_SIMPLEDB[DateTimeProperty](stamp) })
+
+    def get_snapshots(self, repo):
+        attrs = self.sdb_domain.get_attributes(self._repoitemname(repo),
+                                               consistent_read=True)
+        return { name[len("snapshot:"):]: json.loads(value)
+                 for name, value in attrs.items()
+                 if name.startswith("snapshot:") }
+
+    def set_snapshots(self, repo, snapshots):
+        itemname = self._repoitemname(repo)
+        if snapshots:
+            self.sdb_domain.put_attributes(itemname,
+                { "snapshot:" + name: json.dumps(snapshot)
+                  for name, snapshot in snapshots.items() })
+        removed = ["snapshot:" + name
+                   for name in self.get_snapshots(repo)
+                   if name not in snapshots]
+        # without attribute names, the whole item would be deleted
+        if removed:
+            self.sdb_domain.delete_attributes(itemname, removed)
+
+    def add_changes(self, repo, changes):
+        # changes have no package attributes, so package queries skip them
+        for i in range(0, len(changes), _BATCH_SIZE):
+            usecs = int(time.time() * 1000000)
+            items = {}
+            for j, change in enumerate(changes[i:i+_BATCH_SIZE]):
+                token = _change_token(usecs + j)
+                items[self._changeitemname(repo, token)] = {
+                    'changelog': repo, 'token': token,
+                    'change': json.dumps(change) }
+            self.sdb_domain.batch_put_attributes(items)
+
+    def query_changes(self, repo, since=None, limit=None):
+        if since is not None and not _CHANGE_TOKEN.match(since):
+            raise ValueError("invalid change token: %s" % since)
+        settled = _change_token(
+            int((time.time() - _CHANGES_SETTLE_TIME) * 1000000))[:15]
+        query = "SELECT * FROM `%s` WHERE `changelog`=%s AND " \
+                "`token` > %s AND `token` < %s ORDER BY `token` ASC" % \
+            (self.sdb_domain_name, _quote(repo), _quote(since or ""),
+             _quote(settled))
+        query += " LIMIT %d" % min(limit or _SELECT_LIMIT, _SELECT_LIMIT)
+        changes = []
+        token = None
+        while limit is None or len(changes) < limit:
+            results = self.sdb.select(self.sdb_domain, query,
+                                      next_token=token, consistent_read=True)
+            for item in results:
+                change = json.loads(item['change'])
+                change['token'] = item['token']
+                changes.append(change)
+            token = results.next_token
+            if token is None:
+                break
+        return changes[:limit]
+
+# -----------------------------------------------------------------------------
+
+# S3 requires all parts of a multipart upload except the last to be at
+# least 5 MiB.
+_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Maximum number of keys in an S3 multi-object delete request.
+_DELETE_BATCH_SIZE = 1000
+
+class S3BlobUpload(BlobUpload):
+    """Streaming multipart upload of a blob to S3.
+
+    Data is sent in parts as it arrives. Parts are uploaded concurrently,
+    with at most `upload_threads` parts in flight, so memory use is bounded
+    by a few parts. Blobs smaller than one part are sent with a single PUT.
+    """
+    def __init__(self, store, keyname):
+        self.store = store
+        self.keyname = keyname
+        self.buffer = bytearray()
+        self.multipart = None
+        self.partnum = 0
+        self.pending = []
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.store.part_size:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self.multipart is None:
+            self.multipart = self.store.s3_bucket.initiate_multipart_upload(
+                self.keyname)
+
+        # wait for the oldest part if too many are in flight
+        while len(self.pending) >= self.store.upload_threads:
+            self.pending.pop(0).result()
+
+        self.partnum += 1
+        self.pending.append(self.store._executor.submit(
+            self._send_part, self.partnum, bytes(self.buffer)))
+        self.buffer = bytearray()
+
+    def _send_part(self, partnum, data):
+        for attempt in range(self.store.upload_retries + 1):
+            try:
+                return self.multipart.upload_part_from_file(BytesIO(data),
+                                                            partnum)
+            except (BotoServerError, HTTPException, OSError):
+                if attempt == self.store.upload_retries:
+                    raise
+                time.sleep(0.5 * 2**attempt)
+
+    def commit(self):
+        if self.multipart is None:
+            key = boto.s3.key.Key(self.store.s3_bucket, self.keyname)
+            key.set_contents_from_file(BytesIO(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part()
+            while self.pending:
+                self.pending.pop(0).result()
+            self.multipart.complete_upload()
+            self.multipart = None
+        self.buffer = None
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        wait(self.pending)
+        self.pending = []
+        if self.multipart is not None:
+            self.multipart.cancel_upload()
+            self.multipart = None
+        self.buffer = None
+
+class S3BlobStore(BlobStore):
+    """Package archive storage in an S3 bucket.
+
+    Download URLs are presigned locally, without contacting S3, to expire
+    after `url_expires` seconds. Each URL is reused for `url_reuse` seconds,
+    so clients always receive a URL valid for at least the difference.
+
+    Each thread connects to S3 on first use, without checking the bucket,
+    and keeps its connection for later requests.
+    """
+    batch_size = _DELETE_BATCH_SIZE
+
+    def __init__(self, access_key_id, secret_access_key, region_name,
+                 bucket_name, prefix, endpoint=None, part_size=8*1024*1024,
+                 upload_threads=4, upload_retries=3, url_expires=3600,
+                 url_reuse=1800, url_cache_size=10000):
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        self.region_name = region_name
+        self.endpoint = endpoint and urlparse.urlsplit(endpoint)
+        self.s3_bucket_name = bucket_name
+        self.s3_prefix = prefix
+        self._local = threading.local()
+
+        # multipart upload configuration
+        self.part_size = max(part_size, _MIN_PART_SIZE)
+        self.upload_threads = max(upload_threads, 1)
+        self.upload_retries = upload_retries
+        self._executor = ThreadPoolExecutor(self.upload_threads)
+
+        # presigned download urls by key name
+        self.url_expires = url_expires
+        self.url_cache = LRUCache(url_cache_size, min(url_reuse, url_expires))
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'bucket', None) is not None:
+            return local
+        # connect to s3, or to an S3-compatible endpoint if one is given
+        if self.endpoint:
+            local.s3 = boto.s3.connection.S3Connection(
+                aws_access_key_id=self.access_key_id,
+                aws_secret_access_key=self.secret_access_key,
+                host=self.endpoint.hostname, port=self.endpoint.port,
+                is_secure=(self.endpoint.scheme == 'https'),
+                calling_format=boto.s3.connection.OrdinaryCallingFormat())
+        else:
+            local.s3 = boto.s3.connect_to_region(self.region_name,
+                aws_access_key_id=self.access_key_id,
+                aws_secret_access_key=self.secret_access_key)
+        local.bucket = local.s3.get_bucket(self.s3_bucket_name,
+                                           validate=False)
+        return local
+
+    @property
+    def s3(self):
+        return self._connection().s3
+
+    @property
+    def s3_bucket(self):
+        return self._connection().bucket
+
+    def _keyname(self, keyname):
+        return os.path.join(self.s3_prefix, keyname)
+
+    def upload(self, keyname):
+        return S3BlobUpload(self, self._keyname(keyname))
+
+    def delete(self, keynames):
+        for keyname in keynames:
+            self.url_cache.pop(keyname)
+        for i in range(0, len(keynames), _DELETE_BATCH_SIZE):
+            result = self.s3_bucket.delete_keys(
+                [self._keyname(keyname)
+                 for keyname in keynames[i:i+_DELETE_BATCH_SIZE]],
+                quiet=True)
+            if result.errors:
+                error = result.errors[0]
+                raise IOError("cannot delete %s: %s" % \
+                              (error.key, error.message))
+
+    def url(self, keyname):
+        url = self.url_cache.get(keyname)
+        if url is None:
+            url = self.s3.generate_url(self.url_expires, 'GET',
+                bucket=self.s3_bucket_name, key=self._keyname(keyname))
+            self.url_cache.put(keyname, url)
+        return url
+
+    def open(self, keyname):
+        key = self.s3_bucket.get_key(self._keyname(keyname))
+        if key is None:
+            raise FileNotFoundError(keyname)
+        return key
+
+    def stats(self):
+        return { 'url_cache': self.url_cache.stats() }
@@ -0,0 +1,159 @@
+"""Local disk cache of package files."""
+import os, re, hashlib, tempfile, threading
+
+# Data copied per read when filling the cache.
+_COPY_SIZE = 1024 * 1024
+
+_SHA256SUM = re.compile(r"[0-9a-f]{64}$")
+
+def is_sha256sum(value):
+    """Return whether `value` is a SHA-256 sum in hexadecimal."""
+    return bool(value) and _SHA256SUM.match(value) is not None
+
+class BlobCache:
+    """Size-bounded least-recently-used cache of blobs in the directory
+    `root`, holding up to `maxsize` bytes.
+
+    Blobs are stored under their SHA-256 sum, which is checked as they are
+    added, so a cached file always has the expected contents. Every use of
+    a file touches its modification time, and when the cache outgrows
+    `maxsize` the least recently used files are evicted, so the directory
+    can be shared by several processes. Lookups are counted in `hits` and
+    `misses`, and files removed to make room in `evictions`.
+    """
+    def __init__(self, root, maxsize):
+        self.root = os.path.abspath(root)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._filling = {}
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, sha256sum):
+        """Return the path of the file of the blob with `sha256sum`."""
+        if not is_sha256sum(sha256sum):
+            raise ValueError("invalid SHA-256 sum: %s" % sha256sum)
+        return os.path.join(self.root, sha256sum)
+
+    def _open(self, sha256sum):
+        try:
+            _file = open(self.path(sha256sum), 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(_file.fileno())
+        return _file
+
+    def get(self, sha256sum):
+        """Return the cached blob with `sha256sum` open for reading, or
+        None."""
+        _file = self._open(sha256sum)
+        with self._lock:
+            if _file is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return _file
+
+    def fill(self, sha256sum, source):
+        """Copy the blob with `sha256sum` from the file object `source` to
+        the cache, unless it is there already, and return it open for
+        reading.
+
+        Raises ValueError if the data read does not match `sha256sum`.
+        Concurrent fills of the same blob in this process read `source`
+        only once.
+        """
+        path = self.path(sha256sum)
+        with self._lock:
+            lock = self._filling.setdefault(sha256sum, threading.Lock())
+        with lock:
+            try:
+                _file = self._open(sha256sum)
+                if _file is not None:
+                    return _file
+                size = self._copy(sha256sum, source, path)
+                _file = open(path, 'rb')
+            finally:
+                with self._lock:
+                    self._filling.pop(sha256sum, None)
+        # the open file stays readable even if it is evicted right away
+        self._evict(size)
+        return _file
+
+    def _copy(self, sha256sum, source, path):
+        fd, temppath = tempfile.mkstemp(dir=self.root, prefix=".blob-")
+        try:
+            sha256 = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as _file:
+                while True:
+                    data = source.read(_COPY_SIZE)
+                    if not data:
+                        break
+                    sha256.update(data)
+                    _file.write(data)
+                    size += len(data)
+            if sha256.hexdigest() != sha256sum:
+                raise ValueError("blob does not match %s" % sha256sum)
+            os.replace(temppath, path)
+        except BaseException:
+            try:
+                os.unlink(temppath)
+            except FileNotFoundError:
+                pass
+            raise
+        return size
+
+    def _scan(self):
+        """Return (mtime, path, size) tuples of the cached files, and their
+        total size."""
+        files = []
+        for entry in os.scandir(self.root):
+            if entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, entry.path, stat.st_size))
+        return files, sum(size for _, _, size in files)
+
+    def _evict(self, added):
+        """Account for `added` bytes, and evict the least recently used
+        files if the cache has outgrown `maxsize`."""
+        with self._evict_lock:
+            if self._size is not None:
+                self._size += added
+                if self._size <= self.maxsize:
+                    return
+            # other processes fill and evict too, so rescan the directory
+            files, size = self._scan()
+            for _, path, filesize in sorted(files):
+                if size <= self.maxsize:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                else:
+                    with self._lock:
+                        self.evictions += 1
+                size -= filesize
+            self._size = size
+
+    def stats(self):
+        """Return the size and counters of the cache."""
+        size = self._size
+        if size is None:
+            size = self._size = self._scan()[1]
+        return {
+            'size': size,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            }
@@ -1,26 +1,69 @@
 """S3pac command line tool.
 
 Usage:
-  s3pac [--server=<url>] add <repo> <pkgfile> [<sigfile>]
+  s3pac [--server=<url>] add [--wait] [--threads=<n>] <repo> <pkgfile>...
   s3pac [--server=<url>] remove <repo> <arch> <name>
+  s3pac [--server=<url>] prune [--dry-run] [--before=<date>] [--match=<pattern>] <repo>
   s3pac [--server=<url>] show <repo> <arch> <name>
   s3pac [--server=<url>] list [--full] <repo> [<key>=<value>]...
+  s3pac [--server=<url>] sync [--delete] [--dry-run] [--threads=<n>] <repo> <dir>
 
 Options:
   -h --help         Show this screen.
   --version         Show version.
   -s --server=<url> Use URL a base server (default http://127.0.0.1:9111/).
   --full            Display full metadata for each package.
+  --wait            Wait until the uploaded packages are published.
+  --threads=<n>     Upload up to <n> chunks at a time [default: 4].
+  --before=<date>   Remove packages published before the given date.
+  --match=<pattern> Remove packages with names matching a glob pattern.
+  --dry-run         Only list the packages that would be published or
+                    removed.
+  --delete          Remove packages not present in the directory.
+
+A signature file given after a package file is uploaded with that package.
+Otherwise <pkgfile>.sig is uploaded if it exists. Package files are
+uploaded in chunks, and an interrupted upload is resumed when the same file
+is added again. Uploaded packages are published by a background job on the
+server.
+
+The sync command publishes the package files in a directory that are not
+in the repository yet, comparing SHA256 sums, and waits until they are
+published. Signature files <pkgfile>.sig are uploaded along.
 """
-import os, sys
+import os, io, sys, time
 import json
+import uuid
+import hashlib
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dateutil import parser as dateparser
 from docopt import docopt
 from urllib import parse as urlparse
 
+from s3pac.package import is_package_filename, vercmp
+
 DEFAULT_SERVER = "http://127.0.0.1:9111/"
 
+# Number of packages fetched per request by `list`.
+LIST_PAGE_SIZE = 1000
+
+# Maximum interval in seconds between polls of a job by `add --wait`.
+JOB_POLL_INTERVAL = 5.0
+
+# Number of packages published per job by `sync`.
+SYNC_PUBLISH_SIZE = 100
+
+# Package files are uploaded in chunks of UPLOAD_CHUNK_SIZE bytes. Each
+# chunk is retried up to UPLOAD_RETRIES times.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_RETRIES = 5
+
+# Directory recording the uploads in progress, so that they can be resumed.
+UPLOAD_STATE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                                os.path.expanduser("~/.cache"),
+                                "s3pac", "uploads")
+
 UNITS = ('B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB', 'YiB')
 
 def _human_readable_size(size):
@@ -30,6 +73,15 @@ def _human_readable_size(size):
         unit += 1
     return "%.2f %s" % (size, UNITS[unit])
 
+def _http_session(connections=1):
+    """Return a requests session keeping up to `connections` connections
+    to the server open."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 def _make_url(opts, urlpath):
     server = opts['--server'] or DEFAULT_SERVER
     return urlparse.urljoin(server, urlpath)
@@ -71,20 +123,365 @@ class CommandException(Exception):
     def __init__(self, msg):
         self.msg = msg
 
-def do_add(opts):
-    pkgfilepath = opts['<pkgfile>']
-    sigfilepath = opts['<sigfile>'] or (pkgfilepath + ".sig")
+class _MultipartBody:
+    """Streamed multipart/form-data request body.
+
+    File contents are read only as the body is sent, so uploading many
+    large files does not require holding them in memory.
+    """
+    def __init__(self, fields):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+        self.parts = []
+        for name, filepath, filename in fields:
+            header = '--%s\r\nContent-Disposition: form-data; ' \
+                     'name="%s"; filename="%s"\r\n' \
+                     'Content-Type: application/octet-stream\r\n\r\n' % \
+                     (self.boundary, name, filename)
+            self.parts.append(header.encode('utf-8'))
+            self.parts.append(filepath)
+            self.parts.append(b"\r\n")
+        self.parts.append(("--%s--\r\n" % self.boundary).encode('utf-8'))
+        self.current = None
 
-    files = { 'package': open(pkgfilepath, 'rb') }
-    if os.path.isfile(sigfilepath):
-        files['signature'] = open(sigfilepath, 'rb')
+    def __len__(self):
+        return sum(os.path.getsize(part) if isinstance(part, str)
+                   else len(part) for part in self.parts)
 
+    def read(self, size=-1):
+        while True:
+            if self.current is None:
+                if not self.parts:
+                    return b""
+                part = self.parts.pop(0)
+                self.current = open(part, 'rb') if isinstance(part, str) \
+                               else io.BytesIO(part)
+            data = self.current.read(size)
+            if data:
+                return data
+            self.current.close()
+            self.current = None
+
+def _package_files(paths):
+    """Pair package files with signature files."""
+    pairs = []
+    for path in paths:
+        if path.endswith(".sig") and pairs and pairs[-1][1] is None:
+            pairs[-1][1] = path
+        else:
+            pairs.append([path, None])
+    for pair in pairs:
+        if pair[1] is None and os.path.isfile(pair[0] + ".sig"):
+            pair[1] = pair[0] + ".sig"
+    return pairs
+
+def _upload_statepath(url, path):
+    stat = os.stat(path)
+    key = "%s\n%s\n%d\n%d" % (url, os.path.abspath(path), stat.st_size,
+                               stat.st_mtime_ns)
+    return os.path.join(UPLOAD_STATE_DIR,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+def _start_upload(http, url, path):
+    """Return the state of an upload of the file `path` to `url`, resuming
+    an earlier upload of the same file if the server still has it."""
+    statepath = _upload_statepath(url, path)
+    try:
+        with open(statepath) as _file:
+            response = http.get("%s/%s" % (url, _file.read().strip()))
+        if response.ok:
+            return response.json()
+    except FileNotFoundError:
+        pass
+
+    filename = os.path.basename(path)
+    response = http.post(url, params={ 'filename': filename,
+                                       'size': os.path.getsize(path) })
+
+    if response.status_code == 401:
+        raise CommandException("invalid package file: %s" % filename)
+
+    if response.status_code == 413:
+        raise CommandException("package file too large: %s" % filename)
+
+    if not response.ok:
+        raise CommandException("server error: %d" % response.status_code)
+
+    upload = response.json()
+    os.makedirs(UPLOAD_STATE_DIR, exist_ok=True)
+    with open(statepath, 'w') as _file:
+        _file.write(upload['id'])
+    return upload
+
+def _missing_chunks(upload):
+    """Return the (start, stop) ranges of an upload not received yet."""
+    chunks = []
+    offset = 0
+    for start, stop in upload['received'] + [[upload['size']] * 2]:
+        chunks.extend((chunk, min(chunk + UPLOAD_CHUNK_SIZE, start))
+                      for chunk in range(offset, start, UPLOAD_CHUNK_SIZE))
+        offset = stop
+    return chunks
+
+def _put_chunk(http, url, path, start, stop, size):
+    """Upload bytes `start` to `stop` of the file `path`, retrying failed
+    requests. Returns the number of bytes uploaded."""
+    with open(path, 'rb') as _file:
+        _file.seek(start)
+        data = _file.read(stop - start)
+    headers = { 'Content-Type': "application/octet-stream",
+                'Content-Range': "bytes %d-%d/%d" % (start, stop - 1, size) }
+
+    for retry in range(UPLOAD_RETRIES + 1):
+        if retry:
+            time.sleep(min(0.5 * 2 ** retry, 30.0))
+        try:
+            response = http.put(url, data=data, headers=headers)
+        except requests.RequestException as ex:
+            error = str(ex)
+            continue
+        if response.ok:
+            return len(data)
+        error = "server error: %d" % response.status_code
+        if response.status_code < 500:
+            break
+    raise CommandException(error)
+
+def _print_progress(filename, done, size, end=""):
+    if sys.stderr.isatty() or end:
+        print("\r%s: %s of %s" % (filename, _human_readable_size(done),
+                                  _human_readable_size(size)),
+              end=end, file=sys.stderr, flush=True)
+
+def _upload_package_file(http, executor, url, path, progress=True):
+    """Upload the file `path` in chunks and return its upload id."""
+    upload = _start_upload(http, url, path)
+    uploadurl = "%s/%s" % (url, upload['id'])
+    filename = os.path.basename(path)
+    size = upload['size']
+    chunks = _missing_chunks(upload)
+    done = size - sum(stop - start for start, stop in chunks)
+
+    futures = [executor.submit(_put_chunk, http, uploadurl, path,
+                               start, stop, size)
+               for start, stop in chunks]
+    try:
+        for future in as_completed(futures):
+            done += future.result()
+            if progress:
+                _print_progress(filename, done, size)
+    finally:
+        for future in futures:
+            future.cancel()
+    _print_progress(filename, done, size, end="\n")
+    return upload['id']
+
+def _forget_uploads(statepaths):
+    for statepath in statepaths:
+        try:
+            os.unlink(statepath)
+        except FileNotFoundError:
+            pass
+
+def _threads(opts):
+    try:
+        return max(int(opts['--threads']), 1)
+    except ValueError:
+        raise CommandException("invalid number: %s" % opts['--threads'])
+
+def _publish_package_files(http, opts, pairs, threads, concurrent=False):
+    """Upload (pkgfile, sigfile) pairs of paths to the repository and
+    return the background job publishing them.
+
+    With `concurrent`, several package files are uploaded at a time.
+    Otherwise package files are uploaded one after another, reporting
+    progress.
+    """
+    url = _make_url(opts, "p/%s/uploads" % opts['<repo>'])
+    with ThreadPoolExecutor(threads) as executor, \
+         ThreadPoolExecutor(threads if concurrent else 1) as files:
+        uploadids = list(files.map(
+            lambda pair: _upload_package_file(http, executor, url, pair[0],
+                                              progress=not concurrent),
+            pairs))
+    statepaths = [_upload_statepath(url, pkgfilepath)
+                  for pkgfilepath, sigfilepath in pairs]
+    fields = [('signature', sigfilepath,
+               os.path.basename(pkgfilepath) + ".sig")
+              for pkgfilepath, sigfilepath in pairs if sigfilepath]
+
+    # publish the uploaded packages, sending signatures along
+    body = _MultipartBody(fields)
     url = _make_url(opts, "p/%s/" % opts['<repo>'])
-    response = requests.post(url, files=files)
+    response = http.post(url, data=body,
+                         params={ 'async': "1", 'upload': uploadids },
+                         headers={ 'Content-Type': body.content_type })
+
+    if response.status_code == 401:
+        raise CommandException("invalid package file")
+
+    if response.status_code in (404, 409):
+        _forget_uploads(statepaths)
+        raise CommandException("upload expired, please add again")
 
     if not response.ok:
         raise CommandException("server error: %d" % response.status_code)
 
+    _forget_uploads(statepaths)
+    return response.json()
+
+def _wait_for_job(http, opts, job):
+    """Wait until a publish job completes, print its report and return the
+    number of packages that failed to publish."""
+    joburl = _make_url(opts, "jobs/%s" % job['id'])
+    interval = 0.5
+    while job['state'] in ('pending', 'running'):
+        time.sleep(interval)
+        interval = min(interval * 2, JOB_POLL_INTERVAL)
+        response = http.get(joburl)
+        if not response.ok:
+            raise CommandException("server error: %d" % response.status_code)
+        job = response.json()
+
+    if job['state'] == 'failed':
+        raise CommandException("publish failed: %s" % job['error'])
+
+    failed = 0
+    for entry in job['result']:
+        if entry['error']:
+            print("%s: %s" % (entry['filename'], entry['error']))
+            failed += 1
+        else:
+            print("%s: published" % entry['filename'])
+    return failed
+
+def do_add(opts):
+    threads = _threads(opts)
+    http = _http_session(threads)
+    pairs = _package_files(opts['<pkgfile>'])
+    job = _publish_package_files(http, opts, pairs, threads)
+
+    if not opts['--wait']:
+        print("publishing in job %s" % job['id'])
+        print("status: %s" % _make_url(opts, "jobs/%s" % job['id']))
+        return
+
+    failed = _wait_for_job(http, opts, job)
+    if failed:
+        raise CommandException("%d of %d packages failed" % \
+                               (failed, len(pairs)))
+
+def _list_packages(http, opts, params):
+    """Yield the packages of the repository matching `params`, requesting
+    further pages while the server returns a next page token."""
+    url = _make_url(opts, "p/%s/" % opts['<repo>'])
+    params = dict(params)
+    while True:
+        response = http.get(url, params=params)
+
+        if response.status_code == 400:
+            raise CommandException("invalid query")
+
+        if not response.ok:
+            raise CommandException("server error: %d" % response.status_code)
+
+        yield from response.json()
+
+        if not response.headers.get('X-Next-Token'):
+            break
+        params['next'] = response.headers['X-Next-Token']
+
+def _sha256sum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as _file:
+        for data in iter(lambda: _file.read(1024 * 1024), b""):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+def _arch_name(filename):
+    """Return the architecture and name of a package from its file name."""
+    name, pkgver, pkgrel, rest = filename.rsplit("-", 3)
+    return rest.split(".", 1)[0], name
+
+def _version(filename):
+    """Return the version of a package from its file name."""
+    name, pkgver, pkgrel, rest = filename.rsplit("-", 3)
+    return "%s-%s" % (pkgver, pkgrel)
+
+def _newest(paths):
+    """Return the newest package file of each architecture and name among
+    `paths`, by (arch, name)."""
+    newest = {}
+    for path in paths:
+        filename = os.path.basename(path)
+        key = _arch_name(filename)
+        if key not in newest or vercmp(
+                _version(filename),
+                _version(os.path.basename(newest[key]))) > 0:
+            newest[key] = path
+    return newest
+
+def do_sync(opts):
+    threads = _threads(opts)
+    http = _http_session(threads)
+
+    paths = sorted(os.path.join(opts['<dir>'], filename)
+                   for filename in os.listdir(opts['<dir>'])
+                   if is_package_filename(filename))
+    try:
+        local = _newest(paths)
+    except ValueError:
+        raise CommandException("invalid package file name in %s" % \
+                               opts['<dir>'])
+    # only the newest version of each package is published
+    paths = sorted(local.values())
+
+    # checksum local packages on all cores, as hashlib releases the GIL
+    with ThreadPoolExecutor(os.cpu_count()) as executor:
+        sums = dict(zip(paths, executor.map(_sha256sum, paths)))
+
+    remote = list(_list_packages(http, opts, {
+        'fields': "arch,name,version,sha256sum" }))
+    published = set(pkg['sha256sum'] for pkg in remote)
+
+    pairs = [[path, path + ".sig" if os.path.isfile(path + ".sig")
+              else None]
+             for path in paths if sums[path] not in published]
+    stale = [pkg for pkg in remote
+             if opts['--delete'] and (pkg['arch'], pkg['name']) not in local]
+
+    print("%d packages unchanged, %d to publish, %d to remove" % \
+          (len(paths) - len(pairs), len(pairs), len(stale)))
+    if opts['--dry-run']:
+        for pkgfilepath, sigfilepath in pairs:
+            print("would publish %s" % os.path.basename(pkgfilepath))
+        for pkg in stale:
+            print("would remove %s %s (%s)" % \
+                  (pkg['name'], pkg['version'], pkg['arch']))
+        return
+
+    failed = 0
+    for i in range(0, len(pairs), SYNC_PUBLISH_SIZE):
+        job = _publish_package_files(http, opts,
+                                     pairs[i:i+SYNC_PUBLISH_SIZE],
+                                     threads, concurrent=True)
+        failed += _wait_for_job(http, opts, job)
+
+    def _remove(pkg):
+        urlpath = "p/%s/%s/%s" % (opts['<repo>'], pkg['arch'], pkg['name'])
+        response = http.delete(_make_url(opts, urlpath))
+        if not response.ok and response.status_code != 404:
+            raise CommandException("server error: %d" % response.status_code)
+        print("removed %s %s (%s)" % (pkg['name'], pkg['version'],
+                                      pkg['arch']))
+
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(_remove, stale))
+
+    if failed:
+        raise CommandException("%d of %d packages failed" % \
+                               (failed, len(pairs)))
+
 def do_remove(opts):
     urlpath = "p/%s/%s/%s" % (opts['<repo>'], opts['<arch>'], opts['<name>'])
     url = _make_url(opts, urlpath)
@@ -96,6 +493,32 @@ def do_remove(opts):
     if not response.ok:
         raise CommandException("server error: %d" % response.status_code)
 
+def do_prune(opts):
+    if not opts['--before'] and not opts['--match']:
+        raise CommandException("--before or --match is required")
+
+    params = {}
+    if opts['--before']:
+        params['before'] = opts['--before']
+    if opts['--match']:
+        params['match'] = opts['--match']
+    if opts['--dry-run']:
+        params['dry_run'] = "1"
+
+    url = _make_url(opts, "p/%s/prune" % opts['<repo>'])
+    response = requests.post(url, params=params)
+
+    if response.status_code == 400:
+        raise CommandException("invalid date: %s" % opts['--before'])
+
+    if not response.ok:
+        raise CommandException("server error: %d" % response.status_code)
+
+    for pkg in response.json():
+        print("%s %s %s (%s)" % ("would remove" if opts['--dry-run'] \
+                                 else "removed",
+                                 pkg['name'], pkg['version'], pkg['arch']))
+
 def do_show(opts):
     urlpath = "p/%s/%s/%s" % (opts['<repo>'], opts['<arch>'], opts['<name>'])
     url = _make_url(opts, urlpath)
@@ -118,30 +541,31 @@ def do_list(opts):
     except ValueError:
         raise CommandException("must be <key>=<value>: %s" % keyvalue)
 
-    urlpath = "p/%s/" % opts['<repo>']
-    url = _make_url(opts, urlpath)
-    response = requests.get(url, params=params)
-
-    if not response.ok:
-        raise CommandException("server error: %d" % response.status_code)
+    # without --full, fetch only the properties shown
+    params['limit'] = LIST_PAGE_SIZE
+    if not opts['--full']:
+        params['fields'] = "name,version,arch"
 
-    for pkg in response.json():
+    for pkg in _list_packages(_http_session(), opts, params):
         if opts['--full']:
             _print_package(pkg)
         else:
             _print_package_oneline(pkg)
 
-
 def main(opts):
     try:
         if opts['add']:
             return do_add(opts)
         elif opts['remove']:
             return do_remove(opts)
+        elif opts['prune']:
+            return do_prune(opts)
         elif opts['show']:
             return do_show(opts)
         elif opts['list']:
             return do_list(opts)
+        elif opts['sync']:
+            return do_sync(opts)
     except CommandException as ex:
         print("s3pac:", ex.msg)
         return 255
@@ -1,116 +1,826 @@
-import os
-from datetime import datetime
-from dateutil import parser as dateparser
-import boto.sdb
-import boto.s3
+import os, json, time, gzip, fnmatch, hashlib, logging, threading
+from datetime import datetime, timedelta
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-from s3pac.model import LongProperty, StringProperty, DateTimeProperty
-from s3pac.package import Package, read_package_file
+from s3pac.cache import LRUCache
+from s3pac.blobcache import is_sha256sum
+from s3pac.metrics import TimedStore, TimedIterator
+from s3pac.index import DependencyIndex, INDEX_FIELDS
+from s3pac.package import PackageReader, iter_database_file, sign_data
+
+_log = logging.getLogger(__name__)
 
 # -----------------------------------------------------------------------------
 
-_FROM_SIMPLEDB = {
-    LongProperty: lambda v: int(v) - 2**63,
-    DateTimeProperty: dateparser.parse,
-    }
+# Archive data buffered while waiting for the .PKGINFO file, which names the
+# blob the archive is uploaded to.
+_MAX_HEAD_SIZE = 8 * 1024 * 1024
+
+class PackageUpload:
+    """Streaming upload of a package archive.
+
+    Archive data written to the upload is checksummed, scanned for the
+    .PKGINFO file and passed on to a blob store upload as it arrives, so
+    the archive is read only once and nothing is written to local disk.
+    Data is buffered only until the .PKGINFO file has been read, which
+    makepkg ensures by always storing it first.
+
+    Errors while writing are held back until `finish`, so that a failed
+    upload does not interrupt others in the same request.
+    """
+    def __init__(self, pkgdb, repo):
+        self.pkgdb = pkgdb
+        self.repo = repo
+        self.reader = PackageReader()
+        self.buffer = bytearray()
+        self.upload = None
+        self.error = None
+
+    def write(self, data):
+        """Write the next chunk of archive data."""
+        if self.error is None:
+            try:
+                self._write(data)
+            except Exception as ex:
+                self.abort()
+                self.error = ex
+        return len(data)
+
+    def _write(self, data):
+        self.reader.write(data)
+        if self.upload is not None:
+            self.upload.write(data)
+            return
+        self.buffer += data
+        if self.reader.pkg is not None:
+            self._start()
+        elif len(self.buffer) > _MAX_HEAD_SIZE:
+            raise ValueError("not a package archive: no .PKGINFO found")
+
+    def seek(self, offset, whence=0):
+        # werkzeug rewinds file containers after writing them
+        return 0
 
-_TO_SIMPLEDB = {
-    LongProperty: lambda v: "%020d" % (v + 2**63),
-    DateTimeProperty: datetime.isoformat,
-    }
+    def _start(self):
+        self.reader.pkg.repo = self.repo
+        self.upload = self.pkgdb.blobs.upload(
+            self.pkgdb._pkgkeyname(self.reader.pkg))
+        self.upload.write(bytes(self.buffer))
+        self.buffer = None
 
-def _pkg_from_sdb(_dict):
-    return Package.load(_FROM_SIMPLEDB, _dict)
+    def finish(self, sigfile=None):
+        """Complete the upload and return the package metadata."""
+        if self.error is not None:
+            raise self.error
+        pkg = self.reader.package(sigfile)
+        if self.upload is None:
+            self._start()
+        self.pkgdb._put_files(pkg, self.reader.files)
+        self.upload.commit()
+        self.upload = None
+        return pkg
 
-def _sdb_from_pkg(pkg):
-    return Package.store(_TO_SIMPLEDB, pkg)
+    def abort(self):
+        """Abort an unfinished upload, discarding any uploaded data."""
+        if self.upload is not None:
+            self.upload.abort()
+            self.upload = None
+        self.buffer = None
 
 # -----------------------------------------------------------------------------
 
+# Maximum number of values in a single query condition.
+_QUERY_IN_SIZE = 20
+
+# File lists read per `_gather` call when building files databases, and
+# missing from the file lists blob of an architecture before it is read again.
+_FILES_GATHER_SIZE = 1000
+
+# Package properties needed to delete packages.
+_DELETE_FIELDS = ['repo', 'arch', 'name', 'version', 'filename', 'publishdate']
+
+# Stamp of repositories never changed, which is not stored, so that reading
+# a repository does not write to the metadata store.
+_EPOCH = datetime(1970, 1, 1)
+
+def _snapshot_name(arch, files, compression):
+    return "%s.%s.%s" % (arch, "files" if files else "db", compression)
+
+def _files_id(pkg):
+    """Return the key of the file list of `pkg`, which changes whenever the
+    package file does, even if its filename stays the same."""
+    return "%s:%s" % (pkg.filename, pkg.sha256sum or "")
+
+def _change(action, pkg, date):
+    """Return the change log entry of `action` on `pkg`."""
+    change = { 'action': action, 'date': date.isoformat(), 'arch': pkg.arch,
+               'name': pkg.name, 'version': pkg.version,
+               'filename': pkg.filename }
+    if action == 'publish':
+        change['sha256sum'] = pkg.sha256sum
+    return change
+
 class PackageDatabase:
-    """Package repository interface to SimpleDB and S3."""
-    def __init__(self, access_key_id, secret_access_key, region_name,
-                 sdb_domain_name, s3_bucket_name, s3_prefix):
-        # connect to simpledb
-        self.sdb = boto.sdb.connect_to_region(region_name,
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key)
-        self.sdb_domain = self.sdb.get_domain(sdb_domain_name)
-        self.sdb_domain_name = sdb_domain_name
-
-        # connect to s3
-        self.s3 = boto.s3.connect_to_region(region_name,
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key)
-        self.s3_bucket = self.s3.get_bucket(s3_bucket_name)
-        self.s3_bucket_name = s3_bucket_name
-        self.s3_prefix = s3_prefix
-
-    def _pkgitemname(self, pkg):
-        return os.path.join(pkg.repo, pkg.arch, pkg.name)
+    """Package repository interface to a metadata store and a blob store.
+
+    See `s3pac.storage` for the store interfaces. Packages looked up with
+    `package` and `package_file` are cached in this process for up to
+    `cache_ttl` seconds, and dropped from the cache when they are replaced
+    or deleted through this instance.
+
+    If `blob_cache`, a `s3pac.blobcache.BlobCache`, is given, package files
+    can be read from it with `open_cached`, and are copied to it in the
+    background on `fill_threads` threads.
+
+    If `snapshot_compression` is given, the databases of a repository are
+    built in the background after each change, see `snapshot_databases`,
+    and signed with the gpg key `sign_key` if given.
+
+    If `metrics` is given, storage operations and database builds are timed
+    and cache statistics exported in this `s3pac.metrics.Registry`.
+    """
+    def __init__(self, metadata, blobs, cache_size=10000, cache_ttl=60,
+                 files_cache_size=10000, database_cache_size=64,
+                 threads=8, timeout=60,
+                 compress_threads=4, blob_cache=None, fill_threads=2,
+                 snapshot_compression=None, sign_key=None, metrics=None):
+        self.metadata = metadata
+        self.blobs = blobs
+        self.blob_cache = blob_cache
+
+        # thread pool filling the blob cache, and the SHA-256 sums of the
+        # package files waiting for it
+        self._fill_executor = None
+        if blob_cache is not None:
+            self._fill_executor = ThreadPoolExecutor(max(fill_threads, 1))
+        self._fill_pending = set()
+        self._fill_lock = threading.Lock()
+
+        # thread pool for concurrent storage operations, see `_gather`
+        self._executor = ThreadPoolExecutor(max(threads, 1))
+        self.timeout = timeout
+
+        # thread pool for package uploads, which may take much longer than
+        # `timeout` and must not hold up the calls of `_gather`
+        self._upload_executor = ThreadPoolExecutor(max(threads, 1))
+
+        # packages by (repo, arch, name) and (repo, filename)
+        self.package_cache = LRUCache(cache_size, cache_ttl)
+
+        # package file lists by key name and SHA-256 sum, which never change
+        self.files_cache = LRUCache(files_cache_size, float('inf'))
+
+        # package file lists by `_files_id` by (repo, arch), see `_file_lists`
+        self._file_lists_cache = {}
+
+        # thread pool for database compression
+        self._compress_executor = None
+        if compress_threads > 1:
+            self._compress_executor = ThreadPoolExecutor(compress_threads)
+
+        # (stamp, package database file) pairs by (repo, arch, files,
+        # compression), see `database`; entries of older stamps are not
+        # used, and make room for others when the cache is full
+        self._databases = LRUCache(database_cache_size, float('inf'))
+
+        # (stamp, DependencyIndex) pairs by repo, see `index`
+        self._indexes = {}
+
+        # thread building database snapshots, and the repos waiting for it
+        self.snapshot_compression = snapshot_compression
+        self.sign_key = sign_key
+        self._snapshot_executor = None
+        if snapshot_compression is not None:
+            self._snapshot_executor = ThreadPoolExecutor(1)
+        self._snapshot_pending = set()
+        self._snapshot_lock = threading.Lock()
+
+        # database snapshots by repo, as last read, see `snapshot`
+        self._snapshots = {}
+
+        self._database_seconds = None
+        if metrics is not None:
+            self._instrument(metrics)
+
+    def _instrument(self, metrics):
+        storage = metrics.histogram(
+            's3pac_storage_operation_duration_seconds',
+            "Time taken by metadata and blob store operations.",
+            ('store', 'operation'))
+        self.metadata = TimedStore(self.metadata, storage, 'metadata')
+        self.blobs = TimedStore(self.blobs, storage, 'blobs')
+        self._database_seconds = metrics.histogram(
+            's3pac_database_build_duration_seconds',
+            "Time taken to build package databases, excluding the time "
+            "spent sending them.", ('kind', 'compression'))
+        metrics.counter('s3pac_cache_requests_total',
+                        "Cache lookups by result.", ('cache', 'result'))
+        metrics.counter('s3pac_cache_evictions_total',
+                        "Cache entries evicted to make room.", ('cache',))
+        metrics.collect(self._cache_metrics)
+
+    def _cache_metrics(self):
+        values = []
+        for cache, stats in sorted(self.stats().items()):
+            values.append(('s3pac_cache_requests_total', (cache, 'hit'),
+                           stats['hits']))
+            values.append(('s3pac_cache_requests_total', (cache, 'miss'),
+                           stats['misses']))
+            if 'evictions' in stats:
+                values.append(('s3pac_cache_evictions_total', (cache,),
+                               stats['evictions']))
+        return values
+
+    def _gather(self, calls):
+        """Run `calls`, a list of functions taking no arguments, concurrently
+        and return their results.
+
+        All calls must complete within `timeout` seconds. The first error
+        raised by any call is raised, after cancelling the calls not yet
+        started. Must not be called from a storage thread.
+        """
+        if len(calls) <= 1:
+            return [call() for call in calls]
+        deadline = time.monotonic() + self.timeout
+        futures = [self._executor.submit(call) for call in calls]
+        try:
+            return [future.result(max(deadline - time.monotonic(), 0))
+                    for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _batched(self, store, method, items):
+        """Return calls of `method` of `store` on batches of `items`."""
+        size = store.batch_size or len(items) or 1
+        return [partial(method, items[i:i+size])
+                for i in range(0, len(items), size)]
+
+    def _touch(self, repo, added=(), removed=()):
+        """Record that the contents of `repo` have changed, with packages
+        `added` and `removed`, in its stamp and change log.
+
+        Stamps are whole seconds, each at least a second after the previous
+        stamp of `repo`, so that clocks of other servers lagging behind or a
+        change within the same second never repeat a stamp.
+        """
+        stamp = datetime.utcnow().replace(microsecond=0)
+        previous = self.metadata.get_stamp(repo)
+        if previous is not None:
+            stamp = max(stamp, previous.replace(microsecond=0) +
+                               timedelta(seconds=1))
+        changes = [_change('delete', pkg, stamp) for pkg in removed] + \
+                  [_change('publish', pkg, stamp) for pkg in added]
+        if changes:
+            self.metadata.add_changes(repo, changes)
+        self.metadata.set_stamp(repo, stamp)
+        indexed = self._indexes.get(repo)
+        if indexed is not None:
+            indexed[1].remove(removed)
+            indexed[1].add(added)
+            self._indexes[repo] = (stamp, indexed[1])
+        if changes:
+            self._schedule_snapshots(repo)
+        return stamp
 
     def _pkgkeyname(self, pkg):
-        return os.path.join(self.s3_prefix, pkg.repo, pkg.filename)
+        return os.path.join(pkg.repo, pkg.filename)
 
-    def publish(self, repo, pkgfile, sigfile):
-        """Read package archive from `pkgfile` and publish to `repo`."""
-        pkg = read_package_file(pkgfile, sigfile)
+    def _fileskeyname(self, pkg):
+        return os.path.join(pkg.repo, pkg.filename + ".files")
 
-        pkg.repo = repo
-        pkg.publishdate = datetime.utcnow()
+    def _filelistskeyname(self, repo, arch):
+        return os.path.join(repo, ".files", arch + ".json.gz")
 
-        # upload package file to s3
-        pkgkey = boto.s3.key.Key(self.s3_bucket, self._pkgkeyname(pkg))
-        pkgfile.seek(0)
-        pkgkey.set_contents_from_file(pkgfile)
+    def _keynames(self, pkgs):
+        """Return the key names of all blobs of `pkgs`."""
+        keynames = []
+        for pkg in pkgs:
+            keynames.append(self._pkgkeyname(pkg))
+            keynames.append(self._fileskeyname(pkg))
+        return keynames
+
+    def _forget(self, pkgs):
+        """Drop `pkgs` from the package cache."""
+        for pkg in pkgs:
+            self.package_cache.pop((pkg.repo, pkg.arch, pkg.name))
+            self.package_cache.pop((pkg.repo, pkg.filename))
+
+    def upload(self, repo):
+        """Start a streaming upload of a package archive to `repo`."""
+        return PackageUpload(self, repo)
 
-        # insert metadata
-        self.sdb_domain.put_attributes(self._pkgitemname(pkg),
-                                       _sdb_from_pkg(pkg))
+    def _finish(self, repo, pkgfile, sigfile):
+        """Upload `pkgfile` to `repo` if necessary and return its metadata."""
+        if isinstance(pkgfile, PackageUpload):
+            upload = pkgfile
+        else:
+            upload = self.upload(repo)
 
-        # remove previous versions if they exist
-        for ppkg in self.find(repo=pkg.repo, arch=pkg.arch, name=pkg.name):
-            if ppkg.version != pkg.version:
-                self.delete(repo=repo, arch=ppkg.arch, name=ppkg.name,
-                            version=ppkg.version)
+        try:
+            if upload is not pkgfile:
+                pkgfile.seek(0)
+                for data in iter(lambda: pkgfile.read(65536), b""):
+                    upload._write(data)
+            pkg = upload.finish(sigfile)
+        except Exception:
+            upload.abort()
+            raise
 
+        pkg.publishdate = datetime.utcnow()
         return pkg
 
+    def publish(self, repo, pkgfile, sigfile):
+        """Read package archive from `pkgfile` and publish to `repo`.
+
+        `pkgfile` is either a file or a `PackageUpload` to which the whole
+        archive has been written.
+        """
+        pkg, error = self.publish_many(repo, [(pkgfile, sigfile)])[0]
+        if error is not None:
+            raise error
+        return pkg
+
+    def publish_many(self, repo, files):
+        """Publish several packages to `repo` at once.
+
+        `files` is a list of (pkgfile, sigfile) pairs as accepted by
+        `publish`. Package files are uploaded concurrently and the metadata
+        is written in batches. Returns a (pkg, error) pair for each package,
+        where `error` is the exception that prevented publishing it.
+        """
+        futures = [self._upload_executor.submit(self._finish, repo, *pair)
+                   for pair in files]
+        results = []
+        for future in futures:
+            try:
+                results.append([future.result(), None])
+            except Exception as ex:
+                results.append([None, ex])
+
+        # of several packages with the same name, only the last is published
+        latest = {}
+        stale = []
+        for i, (pkg, error) in enumerate(results):
+            if pkg is None:
+                continue
+            j = latest.get((pkg.arch, pkg.name))
+            if j is not None:
+                if results[j][0].filename != pkg.filename:
+                    stale.append(results[j][0])
+                error = ValueError("superseded by %s" % pkg.filename)
+                results[j] = [None, error]
+            latest[(pkg.arch, pkg.name)] = i
+        pkgs = { key: results[i][0] for key, i in latest.items() }
+
+        if pkgs:
+            # find previous versions, whose metadata is replaced below
+            names = sorted(set(name for arch, name in pkgs))
+            ppkgs = [ppkg for found in self._gather(
+                         [partial(self.find, repo=repo,
+                                  name=names[i:i+_QUERY_IN_SIZE])
+                          for i in range(0, len(names), _QUERY_IN_SIZE)])
+                     for ppkg in found if (ppkg.arch, ppkg.name) in pkgs]
+
+            # insert metadata
+            self._gather(self._batched(self.metadata, self.metadata.put,
+                                       list(pkgs.values())))
+
+            # remove package files of previous versions
+            stale.extend(ppkg for ppkg in ppkgs
+                if ppkg.filename != pkgs[(ppkg.arch, ppkg.name)].filename)
+            self._forget(list(pkgs.values()) + ppkgs)
+            self._gather(self._batched(self.blobs, self.blobs.delete,
+                                       self._keynames(stale)) +
+                         [partial(self._touch, repo, list(pkgs.values()))])
+        elif stale:
+            self._gather(self._batched(self.blobs, self.blobs.delete,
+                                       self._keynames(stale)))
+
+        return [tuple(result) for result in results]
+
     def find(self, **kwargs):
         """Find matching packages."""
-        parts = []
-        conds = Package.convertdict(_TO_SIMPLEDB, kwargs)
-        for name, values in conds.items():
-            if not isinstance(values, list):
-                values = [values]
-            for value in values:
-                if value.startswith('%') or value.endswith('%'):
-                    escaped = value[1:-1].replace('%', '\%')
-                    parts.append('`%s` LIKE "%s%s%s"' % \
-                        (name, value[0], escaped, value[-1]))
-                else:
-                    parts.append('`%s`="%s"' % (name, value))
-        query = "SELECT * FROM `%s` WHERE %s" % \
-            (self.sdb_domain_name, " AND ".join(parts))
-        results = self.sdb_domain.select(query, consistent_read=True)
-        return list(map(_pkg_from_sdb, results))
+        return self.metadata.find(**kwargs)
+
+    def query(self, conds, fields=None, order=None, limit=None, token=None):
+        """Find matching packages, see `MetadataStore.query`."""
+        return self.metadata.query(conds, fields, order, limit, token)
 
     def findone(self, **kwargs):
         """Find first matching package."""
         pkgs = self.find(**kwargs)
         return pkgs[0] if pkgs else None
 
+    def _cached(self, key, **kwargs):
+        pkg = self.package_cache.get(key)
+        if pkg is None:
+            pkg = self.findone(**kwargs)
+            if pkg is not None:
+                self.package_cache.put(key, pkg)
+        return pkg
+
+    def package(self, repo, arch, name):
+        """Return package `name` of `repo` for `arch`, or None."""
+        return self._cached((repo, arch, name),
+                            repo=repo, arch=arch, name=name)
+
+    def package_file(self, repo, filename):
+        """Return the package of `repo` with file `filename`, or None."""
+        return self._cached((repo, filename),
+                            repo=repo, filename=filename)
+
     def url(self, pkg):
-        """Return a HTTP download URL for `pkg`."""
-        pkgkey = self.s3_bucket.get_key(self._pkgkeyname(pkg))
-        return pkgkey.generate_url(3600)
+        """Return a HTTP download URL for `pkg`, or None if the package
+        file must be served with `open`."""
+        return self.blobs.url(self._pkgkeyname(pkg))
 
-    def delete(self, **kwargs):
-        """Delete all matching packages."""
-        pkgs = self.find(**kwargs)
+    def open(self, pkg):
+        """Open the package file of `pkg` for reading."""
+        return self.blobs.open(self._pkgkeyname(pkg))
+
+    def open_cached(self, pkg):
+        """Open the package file of `pkg` for reading from the blob cache.
+
+        Returns None if there is no blob cache, `pkg` has no SHA-256 sum or
+        its file is not cached yet. In the last case the file is copied to
+        the cache from the blob store in the background.
+        """
+        if self.blob_cache is None or not is_sha256sum(pkg.sha256sum):
+            return None
+        _file = self.blob_cache.get(pkg.sha256sum)
+        if _file is None:
+            with self._fill_lock:
+                if pkg.sha256sum in self._fill_pending:
+                    return None
+                self._fill_pending.add(pkg.sha256sum)
+            self._fill_executor.submit(self._fill_cache, pkg)
+        return _file
+
+    def _fill_cache(self, pkg):
+        try:
+            blob = self.open(pkg)
+            try:
+                self.blob_cache.fill(pkg.sha256sum, blob).close()
+            finally:
+                blob.close()
+        except Exception as ex:
+            _log.warning("cannot cache %s: %s", pkg.filename, ex)
+        finally:
+            with self._fill_lock:
+                self._fill_pending.discard(pkg.sha256sum)
+
+    def _put_files(self, pkg, files):
+        """Store the file list of `pkg`."""
+        keyname = self._fileskeyname(pkg)
+        upload = self.blobs.upload(keyname)
+        try:
+            upload.write(gzip.compress("\n".join(files).encode('utf-8'),
+                                       mtime=0))
+            upload.commit()
+        except Exception:
+            upload.abort()
+            raise
+        self.files_cache.put((keyname, pkg.sha256sum), files)
+
+    def files(self, pkg):
+        """Return the list of files installed by `pkg`.
+
+        Packages published before file lists were recorded have none.
+        """
+        keyname = self._fileskeyname(pkg)
+        files = self.files_cache.get((keyname, pkg.sha256sum))
+        if files is None:
+            try:
+                blob = self.blobs.open(keyname)
+            except FileNotFoundError:
+                return []
+            try:
+                data = gzip.decompress(blob.read()).decode('utf-8')
+            finally:
+                blob.close()
+            files = data.split("\n") if data else []
+            self.files_cache.put((keyname, pkg.sha256sum), files)
+        return files
+
+    def _read_file_lists(self, repo, arch):
+        try:
+            blob = self.blobs.open(self._filelistskeyname(repo, arch))
+        except FileNotFoundError:
+            return {}
+        try:
+            return json.loads(gzip.decompress(blob.read()).decode('utf-8'))
+        finally:
+            blob.close()
+
+    def _file_lists(self, repo, arch, pkgs):
+        """Return the file lists of `pkgs`, packages of `repo` for `arch`,
+        by `_files_id`.
+
+        The file lists of all packages of a repository and architecture are
+        kept together in one blob, read once by each process and rewritten
+        when packages were added or removed since, so that only the lists
+        of new packages are read from their own blobs.
+        """
+        # the dictionaries cached are replaced, never modified, so that
+        # concurrent builds can read them
+        key = (repo, arch)
+        lists = self._file_lists_cache.get(key)
+        missing = [pkg for pkg in pkgs
+                   if lists is None or _files_id(pkg) not in lists]
+        if lists is None or len(missing) > _FILES_GATHER_SIZE:
+            # not read yet, or rewritten by other processes meanwhile
+            lists = dict(lists or {})
+            lists.update(self._read_file_lists(repo, arch))
+            self._file_lists_cache[key] = lists
+            missing = [pkg for pkg in pkgs if _files_id(pkg) not in lists]
+
+        # lists read are kept even if a later batch fails
+        for i in range(0, len(missing), _FILES_GATHER_SIZE):
+            batch = missing[i:i+_FILES_GATHER_SIZE]
+            lists = dict(lists)
+            lists.update(zip(map(_files_id, batch), self._gather(
+                [partial(self.files, pkg) for pkg in batch])))
+            self._file_lists_cache[key] = lists
+
+        ids = set(map(_files_id, pkgs))
+        if missing or len(lists) != len(ids):
+            # packages added, or removed or replaced
+            lists = { _id: lists[_id] for _id in ids }
+            self._put_blob(self._filelistskeyname(repo, arch),
+                           gzip.compress(json.dumps(lists).encode('utf-8'),
+                                         mtime=0))
+            self._file_lists_cache[key] = lists
+        return lists
+
+    def _delete(self, pkgs):
+        if not pkgs:
+            return pkgs
+        self._gather(self._batched(self.blobs, self.blobs.delete,
+                                   self._keynames(pkgs)) +
+                     self._batched(self.metadata, self.metadata.delete, pkgs))
+        self._forget(pkgs)
+        repos = {}
         for pkg in pkgs:
-            pkgkey = self.s3_bucket.get_key(self._pkgkeyname(pkg))
-            if pkgkey is not None:
-                pkgkey.delete()
-            self.sdb_domain.delete_attributes(self._pkgitemname(pkg))
+            repos.setdefault(pkg.repo, []).append(pkg)
+        self._gather([partial(self._touch, repo, removed=removed)
+                      for repo, removed in repos.items()])
         return pkgs
+
+    def delete(self, **kwargs):
+        """Delete all matching packages."""
+        return self._delete(self.find(**kwargs))
+
+    def prune(self, repo, before=None, match=None, dry_run=False):
+        """Delete packages of `repo` published before the datetime `before`
+        or with a name matching the glob pattern `match`.
+
+        Returns the deleted packages, or the packages that would be deleted
+        if `dry_run` is true.
+        """
+        pkgs = []
+        for pkg in self.query({ 'repo': repo }, _DELETE_FIELDS)[0]:
+            if (before is not None and pkg.publishdate < before) or \
+               (match is not None and fnmatch.fnmatchcase(pkg.name, match)):
+                pkgs.append(pkg)
+        if dry_run:
+            return pkgs
+        return self._delete(pkgs)
+
+    def stats(self):
+        """Return cache statistics of this process."""
+        stats = { 'package_cache': self.package_cache.stats(),
+                  'files_cache': self.files_cache.stats() }
+        stats.update(self.blobs.stats())
+        if self.blob_cache is not None:
+            stats['blob_cache'] = self.blob_cache.stats()
+        return stats
+
+    def stamp(self, repo):
+        """Return the time of the last change to `repo`, or the epoch if it
+        has never changed."""
+        return self.metadata.get_stamp(repo) or _EPOCH
+
+    def changes(self, repo, since=None, limit=None):
+        """Return the changes of `repo` after the token `since`, oldest
+        first, up to `limit` of them.
+
+        Each publish or delete records a change per package, with its
+        `action`, 'publish' or 'delete', the `date`, the package `arch`,
+        `name`, `version` and `filename`, and the `sha256sum` of published
+        packages. Raises ValueError if `since` is not a valid token.
+        """
+        return self.metadata.query_changes(repo, since, limit)
+
+    def index(self, repo):
+        """Return the `DependencyIndex` of the packages of `repo`.
+
+        The index is built on first use and kept up to date with the
+        packages published and deleted through this instance. It is rebuilt
+        when `repo` was changed by another process.
+        """
+        stamp = self.stamp(repo)
+        indexed = self._indexes.get(repo)
+        if indexed is None or indexed[0] != stamp:
+            pkgs = self.query({ 'repo': repo }, INDEX_FIELDS)[0]
+            indexed = self._indexes[repo] = (stamp, DependencyIndex(pkgs))
+        return indexed[1]
+
+    def warm_up(self, repos, compression='gz'):
+        """Fill the caches of this process for each repository in `repos`:
+        the package cache, as far as it holds, the dependency index, and
+        the package databases of each architecture compressed with
+        `compression`, unless they have current snapshots."""
+        for repo in repos:
+            stamp = self.stamp(repo)
+            pkgs = list(self.query({ 'repo': repo })[0])
+            for pkg in pkgs[:self.package_cache.maxsize // 2]:
+                self.package_cache.put((repo, pkg.arch, pkg.name), pkg)
+                self.package_cache.put((repo, pkg.filename), pkg)
+            self._indexes[repo] = (stamp, DependencyIndex(pkgs))
+            arches = set(pkg.arch for pkg in pkgs)
+            arches.discard('any')
+            for arch in sorted(arches):
+                if self.snapshot(repo, arch, stamp, False,
+                                 compression) is None:
+                    self.database(repo, arch, stamp, False, compression)
+
+    def _schedule_snapshots(self, repo):
+        if self._snapshot_executor is None:
+            return
+        with self._snapshot_lock:
+            if repo in self._snapshot_pending:
+                return
+            self._snapshot_pending.add(repo)
+        self._snapshot_executor.submit(self._snapshot_databases, repo)
+
+    def _snapshot_databases(self, repo):
+        # changes from now on need another snapshot
+        with self._snapshot_lock:
+            self._snapshot_pending.discard(repo)
+        try:
+            self.snapshot_databases(repo)
+        except Exception:
+            _log.exception("cannot snapshot the databases of %s", repo)
+
+    def _put_blob(self, keyname, data):
+        upload = self.blobs.upload(keyname)
+        try:
+            upload.write(data)
+            upload.commit()
+        except Exception:
+            upload.abort()
+            raise
+
+    def snapshot_databases(self, repo):
+        """Build the package and files databases of `repo` for each of its
+        architectures, and store them in the blob store, named by their
+        SHA-256 sum, as the snapshots of the current stamp of `repo`.
+
+        The previous snapshot of each database is kept, for clients that
+        were just sent to it, and older ones are deleted.
+        """
+        compression = self.snapshot_compression
+        stamp = self.stamp(repo)
+        arches = set(pkg.arch for pkg in
+                     self.query({ 'repo': repo }, ['arch'])[0])
+        arches.discard('any')
+        current = self.metadata.get_snapshots(repo)
+        snapshots = {}
+        stale = []
+        uploaded = []
+        for arch in sorted(arches):
+            for files in (False, True):
+                name = _snapshot_name(arch, files, compression)
+                kind = "files" if files else "db"
+                data = self.database(repo, arch, stamp, files, compression)
+                keyname = os.path.join(repo, ".snapshots", "%s.%s.tar.%s" % \
+                    (hashlib.sha256(data).hexdigest(), kind, compression))
+                snapshot = current.pop(name, None) or {}
+                if snapshot.get('keyname') != keyname:
+                    uploaded.append(keyname)
+                    self._put_blob(keyname, data)
+                    if self.sign_key:
+                        self._put_blob(keyname + ".sig",
+                                       sign_data(data, self.sign_key))
+                    if snapshot.get('previous') not in (None, keyname):
+                        stale.append(snapshot['previous'])
+                    snapshot['previous'] = snapshot.get('keyname')
+                snapshots[name] = { 'stamp': stamp.isoformat(),
+                                    'keyname': keyname, 'size': len(data),
+                                    'signed': bool(self.sign_key),
+                                    'previous': snapshot['previous'] }
+        if self.stamp(repo) != stamp:
+            # changed meanwhile, the next snapshot follows: delete the blobs
+            # of this one, unless recorded by another process meanwhile
+            recorded = set()
+            for snapshot in self.metadata.get_snapshots(repo).values():
+                recorded.update([snapshot.get('keyname'),
+                                 snapshot.get('previous')])
+            uploaded = [keyname for keyname in uploaded
+                        if keyname not in recorded]
+            if uploaded:
+                self.blobs.delete(uploaded +
+                                  [keyname + ".sig" for keyname in uploaded])
+            return
+        # architectures without packages left
+        for snapshot in current.values():
+            stale.extend(filter(None, [snapshot.get('keyname'),
+                                       snapshot.get('previous')]))
+        self.metadata.set_snapshots(repo, snapshots)
+        stale = [keyname for keyname in stale
+                 if not any(keyname in (snapshot['keyname'],
+                                        snapshot['previous'])
+                            for snapshot in snapshots.values())]
+        if stale:
+            self.blobs.delete(stale + [keyname + ".sig" for keyname in stale])
+        self._snapshots[repo] = snapshots
+
+    def snapshot(self, repo, arch, stamp, files=False, compression='gz'):
+        """Return the snapshot of the database of `repo` for `arch` built
+        for `stamp`, a dictionary with its blob `keyname`, its `size` and
+        whether it is `signed`, or None."""
+        if compression != self.snapshot_compression:
+            return None
+        name = _snapshot_name(arch, files, compression)
+        snapshot = self._snapshots.get(repo, {}).get(name)
+        if snapshot is None or snapshot['stamp'] != stamp.isoformat():
+            # not built yet, or by another process
+            snapshots = self._snapshots[repo] = \
+                self.metadata.get_snapshots(repo)
+            snapshot = snapshots.get(name)
+        if snapshot is None or snapshot['stamp'] != stamp.isoformat():
+            return None
+        return snapshot
+
+    def blob_url(self, keyname):
+        """Return a HTTP download URL for the blob `keyname`, or None."""
+        return self.blobs.url(keyname)
+
+    def open_blob(self, keyname):
+        """Open the blob `keyname` for reading."""
+        return self.blobs.open(keyname)
+
+    def cached_database(self, repo, arch, stamp, files=False,
+                        compression='gz'):
+        """Return the database file built by `iter_database` for the given
+        arguments, if `repo` has not changed since, or None."""
+        cached = self._databases.get((repo, arch, files, compression))
+        if cached and cached[0] == stamp:
+            return cached[1]
+        return None
+
+    def iter_database(self, repo, arch, stamp=None, files=False,
+                      compression='gz'):
+        """Generate the package database file of `repo` for `arch`, or the
+        files database if `files` is true, compressed with `compression`.
+
+        The file is streamed as it is built, and rebuilt only if `repo` has
+        changed since it was last built by this process, or if it is no
+        longer among the `database_cache_size` most recently used ones.
+        """
+        stamp = stamp or self.stamp(repo)
+        data = self.cached_database(repo, arch, stamp, files, compression)
+        if data is not None:
+            return iter([data])
+
+        start = time.perf_counter()
+
+        # collect packages with given system architecture or 'any'
+        pkgs = [pkg for found in self._gather(
+                    [partial(self.find, repo=repo, arch=_arch)
+                     for _arch in (arch, 'any')])
+                for pkg in found]
+        pkgs.sort(key=lambda pkg: pkg.name)
+
+        getfiles = None
+        if files:
+            pkgfiles = {}
+            for _arch in set(pkg.arch for pkg in pkgs):
+                pkgfiles.update(self._file_lists(repo, _arch,
+                    [pkg for pkg in pkgs if pkg.arch == _arch]))
+            getfiles = lambda pkg: pkgfiles[_files_id(pkg)]
+
+        chunks = iter_database_file(pkgs, getfiles, compression,
+                                    self._compress_executor)
+        if self._database_seconds is not None:
+            chunks = TimedIterator(chunks, self._database_seconds,
+                                   ("files" if files else "db", compression),
+                                   time.perf_counter() - start)
+        return self._cache_database((repo, arch, files, compression), stamp,
+                                    chunks)
+
+    def _cache_database(self, key, stamp, chunks):
+        data = []
+        for chunk in chunks:
+            data.append(chunk)
+            yield chunk
+        self._databases.put(key, (stamp, b"".join(data)))
+
+    def database(self, repo, arch, stamp=None, files=False,
+                 compression='gz'):
+        """Return the package database file of `repo` for `arch`, see
+        `iter_database`."""
+        return b"".join(self.iter_database(repo, arch, stamp, files,
+                                           compression))
@@ -0,0 +1,142 @@
+"""In-memory index of package relations."""
+import re, threading
+
+# Package relations indexed by name.
+RELATIONS = ['depends', 'makedepends', 'provides', 'conflicts', 'replaces']
+
+# Package properties kept in the index.
+INDEX_FIELDS = ['repo', 'arch', 'name', 'version'] + RELATIONS
+
+_VERSION_SPEC = re.compile(r"[<>=:]")
+
+def _depname(dep):
+    """Return the package name of a relation, such as "foo>=1.0"."""
+    return _VERSION_SPEC.split(dep, 1)[0].strip()
+
+class DependencyIndex:
+    """Index of the relations of the packages of a repository.
+
+    Packages are keyed by (arch, name), and their keys are indexed by name.
+    For each relation, the index maps the names in the relation, without
+    version constraints, to the packages having them. Queries restricted to
+    an `arch` consider only packages for that architecture or 'any'.
+    """
+    def __init__(self, pkgs=()):
+        self.pkgs = {}
+        self.keys = {}
+        self.names = { relation: {} for relation in RELATIONS }
+        self._lock = threading.Lock()
+        self.add(pkgs)
+
+    def _remove(self, key):
+        pkg = self.pkgs.pop(key, None)
+        if pkg is None:
+            return
+        self.keys[key[1]].discard(key)
+        if not self.keys[key[1]]:
+            del self.keys[key[1]]
+        for relation in RELATIONS:
+            for name in map(_depname, getattr(pkg, relation)):
+                keys = self.names[relation].get(name)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.names[relation][name]
+
+    def add(self, pkgs):
+        """Add or replace packages."""
+        with self._lock:
+            for pkg in pkgs:
+                key = (pkg.arch, pkg.name)
+                self._remove(key)
+                self.pkgs[key] = pkg
+                self.keys.setdefault(pkg.name, set()).add(key)
+                for relation in RELATIONS:
+                    for name in map(_depname, getattr(pkg, relation)):
+                        self.names[relation].setdefault(name, set()).add(key)
+
+    def remove(self, pkgs):
+        """Remove packages."""
+        with self._lock:
+            for pkg in pkgs:
+                self._remove((pkg.arch, pkg.name))
+
+    def _matches(self, key, arch):
+        return arch is None or key[0] in (arch, 'any')
+
+    def _providers(self, name, arch):
+        keys = self.keys.get(name, set()) | \
+               self.names['provides'].get(name, set())
+        return sorted(key for key in keys if self._matches(key, arch))
+
+    def _result(self, depths):
+        return [(self.pkgs[key], depth) for key, depth in
+                sorted(depths.items(), key=lambda item: (item[1], item[0]))]
+
+    def providers(self, name, arch=None):
+        """Return the packages named `name` or providing `name`."""
+        with self._lock:
+            return [self.pkgs[key] for key in self._providers(name, arch)]
+
+    def rdepends(self, name, relations=('depends',), arch=None,
+                 transitive=False):
+        """Return the packages with `name`, or a name provided by a package
+        `name`, in any of `relations`, as (pkg, depth) pairs.
+
+        With `transitive`, the packages related to those are included, and
+        so on, with the depth at which they were found.
+        """
+        with self._lock:
+            depths = {}
+            names = [name]
+            depth = 1
+            while names:
+                found = set()
+                for _name in names:
+                    targets = set([_name])
+                    for key in self._providers(_name, arch):
+                        targets.update(map(_depname,
+                                           self.pkgs[key].provides))
+                    for target in targets:
+                        for relation in relations:
+                            found.update(self.names[relation].get(target, ()))
+                found = [key for key in found if key not in depths and
+                         self._matches(key, arch) and key[1] != name]
+                for key in found:
+                    depths[key] = depth
+                if not transitive:
+                    break
+                names = sorted(set(key[1] for key in found))
+                depth += 1
+            return self._result(depths)
+
+    def depends(self, name, relations=('depends',), arch=None,
+                transitive=False):
+        """Return the packages satisfying the `relations` of the packages
+        `name`, as (pkg, depth) pairs, or None if there is no package
+        `name`.
+
+        With `transitive`, the relations of those are followed too, and so
+        on, with the depth at which the packages were found.
+        """
+        with self._lock:
+            keys = [key for key in sorted(self.keys.get(name, ()))
+                    if self._matches(key, arch)]
+            if not keys:
+                return None
+            depths = { key: 0 for key in keys }
+            depth = 1
+            while keys:
+                found = set()
+                for key in keys:
+                    for relation in relations:
+                        for dep in getattr(self.pkgs[key], relation):
+                            found.update(self._providers(_depname(dep), arch))
+                keys = [key for key in sorted(found) if key not in depths]
+                for key in keys:
+                    depths[key] = depth
+                if not transitive:
+                    break
+                depth += 1
+            return [result for result in self._result(depths)
+                    if result[1] > 0]
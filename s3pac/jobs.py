@@ -0,0 +1,73 @@
+"""Background jobs with status shared between server processes."""
+import os, re, json, time, uuid, tempfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+class JobQueue:
+    """Bounded pool of background jobs.
+
+    Jobs run on at most `threads` threads of this process. The state of each
+    job is kept in a JSON file in the directory `root`, so that it can be
+    queried from any process sharing the directory, and is removed `ttl`
+    seconds after the job was submitted. A job is 'pending', 'running',
+    'done' with a `result`, or 'failed' with an `error`.
+    """
+    def __init__(self, root, threads=2, ttl=86400):
+        self.root = root
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max(threads, 1))
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, jobid):
+        return os.path.join(self.root, jobid + ".json")
+
+    def _write(self, job):
+        fd, temppath = tempfile.mkstemp(dir=self.root, prefix=".job-")
+        with os.fdopen(fd, 'w') as _file:
+            json.dump(job, _file)
+        os.replace(temppath, self._path(job['id']))
+
+    def _expire(self):
+        now = time.time()
+        for entry in os.scandir(self.root):
+            try:
+                if entry.stat().st_ctime + self.ttl < now:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def _run(self, job, func, args):
+        job['state'] = 'running'
+        self._write(job)
+        try:
+            job['result'] = func(*args)
+            job['state'] = 'done'
+        except Exception as ex:
+            job['error'] = str(ex)
+            job['state'] = 'failed'
+        job['finished'] = datetime.utcnow().isoformat()
+        self._write(job)
+
+    def submit(self, func, *args):
+        """Run `func(*args)` in the background and return the job id.
+
+        The result of `func` must be serializable as JSON.
+        """
+        self._expire()
+        job = { 'id': uuid.uuid4().hex, 'state': 'pending',
+                'submitted': datetime.utcnow().isoformat() }
+        self._write(job)
+        self._executor.submit(self._run, job, func, args)
+        return job['id']
+
+    def status(self, jobid):
+        """Return the state of job `jobid`, or None if there is no such job."""
+        if not _JOB_ID.match(jobid):
+            return None
+        try:
+            with open(self._path(jobid)) as _file:
+                return json.load(_file)
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,259 @@
+"""Storage backend on SQLite and a local directory."""
+import os, json, sqlite3, tempfile, threading
+from datetime import datetime
+from dateutil import parser as dateparser
+
+from s3pac.model import DateTimeProperty
+from s3pac.package import Package
+from s3pac.storage import MetadataStore, BlobStore, BlobUpload
+
+# -----------------------------------------------------------------------------
+
+_FROM_SQLITE = {
+    DateTimeProperty: dateparser.parse,
+    }
+
+_TO_SQLITE = {
+    DateTimeProperty: datetime.isoformat,
+    }
+
+def _multiple(name):
+    return Package.__model_props__[name].multiple
+
+def _pkg_from_row(row):
+    _dict = { name: json.loads(row[name]) if _multiple(name) else row[name]
+              for name in row.keys() }
+    return Package.load(_FROM_SQLITE, _dict)
+
+def _row_from_pkg(pkg):
+    _dict = Package.store(_TO_SQLITE, pkg)
+    return { name: json.dumps(value) if _multiple(name) else value
+             for name, value in _dict.items() }
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    %s,
+    PRIMARY KEY (repo, arch, name)
+);
+CREATE INDEX IF NOT EXISTS packages_filename ON packages (repo, filename);
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT PRIMARY KEY,
+    stamp TEXT
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    repo TEXT,
+    name TEXT,
+    snapshot TEXT,
+    PRIMARY KEY (repo, name)
+);
+CREATE TABLE IF NOT EXISTS changes (
+    token INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo TEXT,
+    change TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_repo ON changes (repo, token);
+""" % ",\n    ".join('"%s"' % name for name in Package.__model_properties__)
+
+# -----------------------------------------------------------------------------
+
+class SQLiteMetadataStore(MetadataStore):
+    """Package metadata storage in an SQLite database.
+
+    Packages are stored one row per package, indexed by (repo, arch, name)
+    and (repo, filename). Properties with multiple values are stored as JSON
+    arrays. Changes are stored as JSON objects, with a sequence number as
+    their token. Each thread uses its own connection.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA case_sensitive_like = ON")
+            self._local.conn = conn
+        return conn
+
+    def put(self, pkgs):
+        names = Package.__model_properties__
+        query = "INSERT OR REPLACE INTO packages (%s) VALUES (%s)" % \
+            (", ".join('"%s"' % name for name in names),
+             ", ".join("?" * len(names)))
+        rows = map(_row_from_pkg, pkgs)
+        with self._connection() as conn:
+            conn.executemany(query, ([row[name] for name in names]
+                                     for row in rows))
+
+    def query(self, conds, fields=None, order=None, limit=None, token=None):
+        parts = []
+        params = []
+        conds = Package.convertvalues(_TO_SQLITE, conds)
+        for name, values in conds.items():
+            if not isinstance(values, list):
+                values = [values]
+            if not values:
+                return iter([]), None
+            alts = []
+            exact = []
+            for value in values:
+                if isinstance(value, str) and \
+                   (value.startswith('%') or value.endswith('%')):
+                    escaped = value[1:-1].replace('\\', '\\\\') \
+                                         .replace('%', '\\%') \
+                                         .replace('_', '\\_')
+                    alts.append("LIKE ? ESCAPE '\\'")
+                    params.append(value[0] + escaped + value[-1])
+                else:
+                    exact.append(value)
+            if exact:
+                alts.append("IN (%s)" % ", ".join("?" * len(exact)))
+                params.extend(exact)
+            if _multiple(name):
+                parts.append('EXISTS (SELECT 1 FROM json_each("%s") '
+                             'WHERE %s)' % (name, " OR ".join(
+                                 "value %s" % alt for alt in alts)))
+            else:
+                parts.append("(%s)" % " OR ".join(
+                    '"%s" %s' % (name, alt) for alt in alts))
+
+        query = "SELECT %s FROM packages WHERE %s" % \
+            (", ".join('"%s"' % name for name in fields) if fields else "*",
+             " AND ".join(parts) or "1")
+        if order:
+            query += ' ORDER BY "%s" %s' % \
+                (order.lstrip('-'), "DESC" if order[0] == '-' else "ASC")
+        elif limit is not None:
+            # pages must follow a stable order
+            query += " ORDER BY repo, arch, name"
+        if limit is None:
+            rows = self._connection().execute(query, params)
+            return map(_pkg_from_row, rows), None
+        offset = int(token or 0)
+        query += " LIMIT ? OFFSET ?"
+        rows = self._connection().execute(query, params + [limit + 1, offset])
+        pkgs = list(map(_pkg_from_row, rows))
+        if len(pkgs) > limit:
+            return pkgs[:limit], str(offset + limit)
+        return pkgs, None
+
+    def delete(self, pkgs):
+        with self._connection() as conn:
+            conn.executemany("DELETE FROM packages "
+                             "WHERE repo = ? AND arch = ? AND name = ?",
+                             [(pkg.repo, pkg.arch, pkg.name) for pkg in pkgs])
+
+    def get_stamp(self, repo):
+        row = self._connection().execute(
+            "SELECT stamp FROM repos WHERE repo = ?", (repo,)).fetchone()
+        if row is None:
+            return None
+        return _FROM_SQLITE[DateTimeProperty](row['stamp'])
+
+    def set_stamp(self, repo, stamp):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO repos (repo, stamp) "
+                         "VALUES (?, ?)",
+                         (repo, _TO_SQLITE[DateTimeProperty](stamp)))
+
+    def get_snapshots(self, repo):
+        rows = self._connection().execute(
+            "SELECT name, snapshot FROM snapshots WHERE repo = ?", (repo,))
+        return { row['name']: json.loads(row['snapshot']) for row in rows }
+
+    def set_snapshots(self, repo, snapshots):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM snapshots WHERE repo = ?", (repo,))
+            conn.executemany("INSERT OR REPLACE INTO snapshots "
+                             "(repo, name, snapshot) VALUES (?, ?, ?)",
+                             [(repo, name, json.dumps(snapshot))
+                              for name, snapshot in snapshots.items()])
+
+    def add_changes(self, repo, changes):
+        with self._connection() as conn:
+            conn.executemany("INSERT INTO changes (repo, change) "
+                             "VALUES (?, ?)",
+                             [(repo, json.dumps(change))
+                              for change in changes])
+
+    def query_changes(self, repo, since=None, limit=None):
+        query = "SELECT token, change FROM changes " \
+                "WHERE repo = ? AND token > ? ORDER BY token"
+        params = [repo, int(since or 0)]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        changes = []
+        for row in self._connection().execute(query, params):
+            change = json.loads(row['change'])
+            change['token'] = str(row['token'])
+            changes.append(change)
+        return changes
+
+# -----------------------------------------------------------------------------
+
+class LocalBlobUpload(BlobUpload):
+    """Streaming upload of a blob to a temporary file, renamed into place
+    when committed."""
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, self.temppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                             prefix=".upload-")
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.chmod(self.temppath, 0o644)
+        os.replace(self.temppath, self.path)
+        self.file = None
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            os.unlink(self.temppath)
+            self.file = None
+
+class LocalBlobStore(BlobStore):
+    """Package archive storage in a local directory.
+
+    Blobs are served by the application itself unless `base_url` is given,
+    in which case downloads are redirected to `base_url` + key name (e.g.
+    a web server serving the same directory).
+    """
+    def __init__(self, root, base_url=None):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, keyname):
+        path = os.path.normpath(os.path.join(self.root, keyname))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError("invalid key name: %s" % keyname)
+        return path
+
+    def upload(self, keyname):
+        return LocalBlobUpload(self._path(keyname))
+
+    def delete(self, keynames):
+        for keyname in keynames:
+            try:
+                os.unlink(self._path(keyname))
+            except FileNotFoundError:
+                pass
+
+    def url(self, keyname):
+        if self.base_url is None:
+            return None
+        return self.base_url.rstrip("/") + "/" + keyname
+
+    def open(self, keyname):
+        return open(self._path(keyname), 'rb')
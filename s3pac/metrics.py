@@ -0,0 +1,489 @@
+"""Counters and histograms exposed in the Prometheus text format."""
+import os, json, time, uuid, fcntl, tempfile, threading
+from bisect import bisect_left
+
+# Default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"") \
+                     .replace("\n", "\\n")
+
+def _labels(names, values, extra=""):
+    pairs = ["%s=\"%s\"" % (name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def inc(self, labels=(), amount=1):
+        """Add `amount` to the counter with the label values `labels`."""
+        registry = self._registry
+        key = (self._name, labels)
+        with registry._lock:
+            registry._counters[key] = registry._counters.get(key, 0) + amount
+        registry._tick()
+
+class Histogram:
+    def __init__(self, registry, name, buckets):
+        self._registry = registry
+        self._name = name
+        self._buckets = buckets
+
+    def observe(self, value, labels=()):
+        """Count `value` in the histogram with the label values `labels`."""
+        registry = self._registry
+        key = (self._name, labels)
+        i = bisect_left(self._buckets, value)
+        with registry._lock:
+            entry = registry._histograms.get(key)
+            if entry is None:
+                entry = registry._histograms[key] = \
+                    [0] * (len(self._buckets) + 1) + [0.0]
+            entry[i] += 1
+            entry[-1] += value
+        registry._tick()
+
+    def time(self, labels=()):
+        """Return a context manager observing the time spent in it."""
+        return _Timer(self, labels)
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+# Snapshot file of the metrics of exited processes, see `Registry`.
+_EXITED = "exited.json"
+
+def _read_snapshot(path):
+    try:
+        with open(path) as _file:
+            return json.load(_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _add_snapshot(counters, histograms, snapshot):
+    """Add the values of `snapshot` to `counters` and `histograms`."""
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in snapshot['histograms']:
+        key = (name, tuple(labels))
+        total = histograms.get(key)
+        if total is None or len(total) != len(values):
+            histograms[key] = values
+        else:
+            histograms[key] = [a + b for a, b in zip(total, values)]
+
+def _write_snapshot(root, filename, counters, histograms, **extra):
+    snapshot = { 'counters': [[name, labels, value] for
+                              (name, labels), value in counters.items()],
+                 'histograms': [[name, labels, entry] for
+                                (name, labels), entry in histograms.items()] }
+    snapshot.update(extra)
+    fd, temppath = tempfile.mkstemp(dir=root, prefix=".metrics-")
+    with os.fdopen(fd, 'w') as _file:
+        json.dump(snapshot, _file)
+    os.replace(temppath, os.path.join(root, filename))
+
+class Registry:
+    """Metrics of this process, aggregated with those of other processes.
+
+    Metrics are updated in memory. If `root` is given, each process writes
+    a snapshot of its metrics to a file in the directory `root` at most
+    every `interval` seconds, and `render` sums the snapshots of all
+    processes sharing the directory, such as the workers of a server.
+
+    Snapshots are named by a token unique to the process, which holds a lock
+    on a file of the same name while it lives. The snapshots of exited
+    processes are added to a single snapshot and removed, so that counters
+    do not decrease and the directory does not grow.
+    """
+    def __init__(self, root=None, interval=5.0):
+        self.root = root
+        self.interval = interval
+        self._families = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+        self._token = None
+        self._lockfd = None
+        if self.root is not None:
+            os.makedirs(self.root, exist_ok=True)
+            os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        # the metrics and the lock are those of the parent process
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        if self._lockfd is not None:
+            os.close(self._lockfd)
+        self._token = None
+        self._lockfd = None
+
+    def _family(self, kind, name, doc, labelnames, buckets=None):
+        family = self._families.setdefault(name,
+            (kind, doc, tuple(labelnames), buckets))
+        if family[0] != kind or family[2] != tuple(labelnames):
+            raise ValueError("metric redefined: %s" % name)
+        return family
+
+    def counter(self, name, doc, labelnames=()):
+        """Define a counter and return it."""
+        self._family('counter', name, doc, labelnames)
+        return Counter(self, name)
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Define a histogram and return it."""
+        buckets = self._family('histogram', name, doc, labelnames,
+                               tuple(buckets))[3]
+        return Histogram(self, name, buckets)
+
+    def collect(self, func):
+        """Add a function returning a list of (name, labels, value) values
+        of counters, such as statistics kept elsewhere, to be read whenever
+        the metrics are written or rendered."""
+        self._collectors.append(func)
+
+    def _tick(self):
+        if self.root is None:
+            return
+        now = time.monotonic()
+        if now - self._flushed < self.interval:
+            return
+        with self._lock:
+            if now - self._flushed < self.interval:
+                return
+            self._flushed = now
+        self.flush()
+
+    def _snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = { key: list(entry)
+                           for key, entry in self._histograms.items() }
+        for func in self._collectors:
+            for name, labels, value in func():
+                counters[(name, tuple(labels))] = value
+        return counters, histograms
+
+    def _process_token(self):
+        """Return the token of this process, locking its file first."""
+        if self._token is not None:
+            return self._token
+        with self._lock:
+            if self._token is not None:
+                return self._token
+            token = "%d-%s" % (os.getpid(), uuid.uuid4().hex[:12])
+            # lock the file before it is named, so it never looks unused
+            fd, temppath = tempfile.mkstemp(dir=self.root, prefix=".metrics-")
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.replace(temppath, os.path.join(self.root, token + ".lock"))
+            self._lockfd = fd
+            self._token = token
+        return token
+
+    def flush(self):
+        """Write the snapshot of the metrics of this process."""
+        if self.root is None:
+            return
+        token = self._process_token()
+        counters, histograms = self._snapshot()
+        _write_snapshot(self.root, token + ".json", counters, histograms)
+
+    def _exited_tokens(self):
+        tokens = []
+        for entry in os.scandir(self.root):
+            token, ext = os.path.splitext(entry.name)
+            if ext != ".lock" or token.startswith("."):
+                continue
+            try:
+                fd = os.open(entry.path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                tokens.append(token)
+            except BlockingIOError:
+                pass
+            finally:
+                os.close(fd)
+        return tokens
+
+    def _fold(self):
+        """Add the snapshots of exited processes to that of `_EXITED` and
+        remove them. Returns the tokens of snapshots added but not removed
+        yet."""
+        path = os.path.join(self.root, _EXITED)
+        exited = _read_snapshot(path)
+        added = exited.get('tokens', []) if exited is not None else []
+        tokens = self._exited_tokens()
+        if not tokens:
+            return added
+        counters = {}
+        histograms = {}
+        if exited is not None:
+            _add_snapshot(counters, histograms, exited)
+        for token in tokens:
+            snapshot = _read_snapshot(os.path.join(self.root,
+                                                   token + ".json"))
+            if snapshot is not None and token not in added:
+                _add_snapshot(counters, histograms, snapshot)
+        _write_snapshot(self.root, _EXITED, counters, histograms,
+                        tokens=tokens)
+        for token in tokens:
+            for ext in (".json", ".lock"):
+                try:
+                    os.unlink(os.path.join(self.root, token + ext))
+                except FileNotFoundError:
+                    pass
+        return []
+
+    def _aggregate(self):
+        if self.root is None:
+            return self._snapshot()
+        self.flush()
+        counters = {}
+        histograms = {}
+        # processes aggregating at once would count folded snapshots twice
+        with open(os.path.join(self.root, ".fold.lock"), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            added = self._fold()
+            for entry in os.scandir(self.root):
+                token, ext = os.path.splitext(entry.name)
+                if ext != ".json" or token.startswith(".") or token in added:
+                    continue
+                snapshot = _read_snapshot(entry.path)
+                if snapshot is not None:
+                    _add_snapshot(counters, histograms, snapshot)
+        return counters, histograms
+
+    def render(self):
+        """Return the metrics of all processes in the Prometheus text
+        format."""
+        counters, histograms = self._aggregate()
+        lines = []
+        for name, (kind, doc, labelnames, buckets) in \
+                sorted(self._families.items()):
+            lines.append("# HELP %s %s" % (name, doc))
+            lines.append("# TYPE %s %s" % (name, kind))
+            if kind == 'counter':
+                for (_name, labels), value in sorted(counters.items()):
+                    if _name == name:
+                        lines.append("%s%s %s" % (name,
+                            _labels(labelnames, labels), _number(value)))
+                continue
+            for (_name, labels), entry in sorted(histograms.items()):
+                if _name != name or len(entry) != len(buckets) + 2:
+                    continue
+                count = 0
+                for bound, bucket in zip(buckets + (float('inf'),), entry):
+                    count += bucket
+                    lines.append("%s_bucket%s %d" % (name,
+                        _labels(labelnames, labels, "le=\"%s\"" %
+                                _number(bound)), count))
+                lines.append("%s_sum%s %s" % (name,
+                    _labels(labelnames, labels), _number(entry[-1])))
+                lines.append("%s_count%s %d" % (name,
+                    _labels(labelnames, labels), count))
+        return "\n".join(lines) + "\n"
+
+# -----------------------------------------------------------------------------
+
+class TimedIterator:
+    """Iterator observing the time spent iterating `iterable`, plus
+    `elapsed` seconds, when it is exhausted or closed."""
+    def __init__(self, iterable, histogram, labels, elapsed=0.0):
+        self.iterator = iter(iterable)
+        self.histogram = histogram
+        self.labels = labels
+        self.elapsed = elapsed
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.close()
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def close(self):
+        if not self.done:
+            self.done = True
+            self.histogram.observe(self.elapsed, self.labels)
+            if hasattr(self.iterator, 'close'):
+                self.iterator.close()
+
+class _TimedUpload:
+    """Blob upload observing the time taken to commit it."""
+    def __init__(self, upload, histogram, labels):
+        self._upload = upload
+        self._histogram = histogram
+        self._labels = labels
+        self.write = upload.write
+        self.abort = upload.abort
+
+    def commit(self):
+        with self._histogram.time(self._labels):
+            return self._upload.commit()
+
+class TimedStore:
+    """Proxy of a metadata or blob store observing the duration of each
+    method call in `histogram`, labelled with `name` and the method name.
+
+    Query results are timed until they have been read, and uploads until
+    they are committed. Statistics are not timed.
+    """
+    def __init__(self, store, histogram, name):
+        self._store = store
+        self._histogram = histogram
+        self._name = name
+
+    def __getattr__(self, attrname):
+        attr = getattr(self._store, attrname)
+        if attrname.startswith('_') or attrname == 'stats' or \
+           not callable(attr):
+            return attr
+        histogram = self._histogram
+        labels = (self._name, attrname)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            if attrname == 'query':
+                iterable, token = result
+                return TimedIterator(iterable, histogram, labels,
+                                     time.perf_counter() - start), token
+            histogram.observe(time.perf_counter() - start, labels)
+            if attrname == 'upload':
+                return _TimedUpload(result, histogram,
+                                    (self._name, 'commit'))
+            return result
+
+        # look up the method only once
+        self.__dict__[attrname] = timed
+        return timed
+
+class _TimedBody:
+    """Response body counting the bytes sent and observing the request
+    when it is closed."""
+    def __init__(self, body, middleware, environ, status, start):
+        self.body = body
+        self.middleware = middleware
+        self.environ = environ
+        self.status = status
+        self.start = start
+        self.size = 0
+
+    def __iter__(self):
+        for data in self.body:
+            self.size += len(data)
+            yield data
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.middleware._observe(self.environ, self.status, self.start,
+                                     self.size)
+
+class TimedApplication:
+    """WSGI middleware counting requests and bytes sent, and observing the
+    duration of requests until the response has been sent.
+
+    Requests are labelled with the route stored by the application in the
+    WSGI environment as `s3pac.route`, or "none". Bodies created with the
+    server's `wsgi.file_wrapper` are returned as they are, so that the
+    server can still send them with sendfile, and counted by their
+    Content-Length.
+    """
+    def __init__(self, app, registry):
+        self.app = app
+        self.duration = registry.histogram(
+            's3pac_http_request_duration_seconds',
+            "Time taken to answer HTTP requests.", ('route', 'method'))
+        self.requests = registry.counter(
+            's3pac_http_requests_total',
+            "HTTP requests answered.", ('route', 'method', 'status'))
+        self.sent = registry.counter(
+            's3pac_http_response_bytes_total',
+            "Bytes sent in HTTP response bodies.", ('route',))
+
+    def observe(self, route, method, status, seconds, size):
+        """Count a request answered with `status` after `seconds`, sending
+        `size` bytes, such as one answered outside this application."""
+        self.duration.observe(seconds, (route, method))
+        self.requests.inc((route, method, status))
+        self.sent.inc((route,), size)
+
+    def _observe(self, environ, status, start, size):
+        self.observe(environ.get('s3pac.route', "none"),
+                     environ.get('REQUEST_METHOD', ""),
+                     status[0] if status else "",
+                     time.perf_counter() - start, size)
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = []
+        length = []
+
+        def _start_response(_status, headers, exc_info=None):
+            status[:] = [_status.split(" ", 1)[0]]
+            length[:] = [value for name, value in headers
+                         if name.lower() == 'content-length']
+            return start_response(_status, headers, exc_info)
+
+        body = self.app(environ, _start_response)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and \
+           isinstance(body, file_wrapper):
+            return self._wrap_close(body, environ, status, length, start)
+        return _TimedBody(body, self, environ, status, start)
+
+    def _wrap_close(self, body, environ, status, length, start):
+        close = getattr(body, 'close', None)
+
+        def _close():
+            try:
+                if close is not None:
+                    close()
+            finally:
+                size = int(length[0]) if length and \
+                       length[0].isdigit() else 0
+                self._observe(environ, status, start, size)
+
+        try:
+            body.close = _close
+        except AttributeError:
+            return _TimedBody(body, self, environ, status, start)
+        return body
@@ -17,49 +17,153 @@ class DateTimeProperty(Property):
     def __init__(self, default=datetime.utcfromtimestamp(0), multiple=False):
         super().__init__(default, multiple)
 
+# -----------------------------------------------------------------------------
+
+# Model classes generate their constructor and their conversion functions as
+# Python source, specialized to the properties of the class and, for the
+# conversion functions, to a converter table. This avoids looking up the
+# property and its converter for each value, which dominates the time taken
+# to load or store large numbers of models.
+
+def _value_expr(prop, conv, value):
+    """Return an expression converting `value` for `prop` with `conv`."""
+    if prop.multiple:
+        if conv is None:
+            return "(list(%s) if %s.__class__ is list else [%s])" % \
+                (value, value, value)
+        return "(list(map(%s, %s)) if %s.__class__ is list else [%s(%s)])" % \
+            (conv, value, value, conv, value)
+    else:
+        if conv is None:
+            return "(%s[0] if %s.__class__ is list else %s)" % \
+                (value, value, value)
+        return "%s(%s[0] if %s.__class__ is list else %s)" % \
+            (conv, value, value, value)
+
+def _compile(source, namespace, funcname):
+    exec(source, namespace)
+    return namespace[funcname]
+
+def _compile_init(props):
+    """Generate the constructor of a model class with properties `props`."""
+    namespace = {}
+    params = []
+    lines = []
+    for i, (name, prop) in enumerate(props.items()):
+        if prop.multiple:
+            params.append("%s=None" % name)
+            lines.append("    self.%s = [] if %s is None else %s" % \
+                         (name, name, name))
+        else:
+            namespace['d%d' % i] = prop.default
+            params.append("%s=d%d" % (name, i))
+            lines.append("    self.%s = %s" % (name, name))
+    if params:
+        params.insert(0, "*")
+    source = "def __init__(self, %s):\n%s\n" % \
+        (", ".join(params + ["**kwargs"]), "\n".join(lines or ["    pass"]))
+    return _compile(source, namespace, '__init__')
+
+def _compile_convs(_class, convs):
+    """Generate functions converting models of `_class` with `convs`."""
+    namespace = { '_new': object.__new__, '_class': _class,
+                  '_missing': object() }
+    convert = ["def convert(_dict):", "    result = {}"]
+    values = ["def values(_dict):", "    result = {}"]
+    load = ["def load(_dict):", "    self = _new(_class)",
+            "    get = _dict.get"]
+    store = ["def store(self):", "    return {"]
+    for i, (name, prop) in enumerate(_class.__model_props__.items()):
+        conv = convs.get(prop.__class__)
+        if conv is not None:
+            namespace['c%d' % i] = conv
+            conv = 'c%d' % i
+        namespace['d%d' % i] = prop.default
+        expr = _value_expr(prop, conv, "value")
+
+        convert += ["    if %r in _dict:" % name,
+                    "        value = _dict[%r]" % name,
+                    "        result[%r] = %s" % (name, expr)]
+
+        each = "%s(value)" % conv if conv else "value"
+        every = "list(map(%s, value))" % conv if conv else "list(value)"
+        values += ["    if %r in _dict:" % name,
+                   "        value = _dict[%r]" % name,
+                   "        result[%r] = %s if value.__class__ is list "
+                   "else %s" % (name, every, each)]
+
+        default = "[]" if prop.multiple else "d%d" % i
+        load += ["    value = get(%r, _missing)" % name,
+                 "    self.%s = %s if value is _missing else %s" % \
+                     (name, default, expr)]
+
+        value = "self.%s" % name
+        if prop.multiple:
+            value = "[%s(v) for v in %s]" % (conv, value) if conv \
+                    else "list(%s)" % value
+        elif conv:
+            value = "%s(%s)" % (conv, value)
+        store += ["        %r: %s," % (name, value)]
+
+    convert += ["    return result"]
+    values += ["    return result"]
+    load += ["    return self"]
+    store += ["        }"]
+    return (_compile("\n".join(convert), namespace, 'convert'),
+            _compile("\n".join(load), namespace, 'load'),
+            _compile("\n".join(store), namespace, 'store'),
+            _compile("\n".join(values), namespace, 'values'))
+
 class ModelType(type):
-    def __init__(_class, name, bases, dct):
-        propnames = [propname for propname, prop \
-                              in _class.__dict__.items() \
-                              if isinstance(prop, Property)]
-        _class.__model_properties__ = propnames
+    def __new__(meta, name, bases, dct):
+        # replace property descriptors with slots
+        props = {}
+        for base in reversed(bases):
+            props.update(getattr(base, '__model_props__', {}))
+        own = [propname for propname, prop in dct.items()
+                        if isinstance(prop, Property)]
+        for propname in own:
+            props[propname] = dct.pop(propname)
+        dct['__slots__'] = tuple(own)
+        dct['__model_props__'] = props
+        dct['__model_properties__'] = list(props)
+        dct['__model_convs__'] = {}
+        if '__init__' not in dct:
+            dct['__init__'] = _compile_init(props)
+        return super().__new__(meta, name, bases, dct)
 
-class Model(metaclass=ModelType):
-    def __init__(self, **kwargs):
-        _class = self.__class__
-        for name in _class.__model_properties__:
-            prop = getattr(_class, name)
-            value = kwargs.get(name, prop.default)
-            setattr(self, name, value)
+    def _convs(_class, convs):
+        """Return the (convert, load, store, values) functions for `convs`.
 
+        Functions are compiled once for each converter table, which is
+        assumed not to change afterwards.
+        """
+        compiled = _class.__model_convs__.get(id(convs))
+        if compiled is None or compiled[0] is not convs:
+            compiled = (convs,) + _compile_convs(_class, convs)
+            _class.__model_convs__[id(convs)] = compiled
+        return compiled
+
+class Model(metaclass=ModelType):
     def __str__(self):
-        return "%s(%s)" % (self.__class__.__name__, self.__dict__)
+        return "%s(%s)" % (self.__class__.__name__,
+            { name: getattr(self, name)
+              for name in self.__class__.__model_properties__ })
 
     @classmethod
     def convertdict(_class, convs, _dict):
-        result = {}
-        for name in _class.__model_properties__:
-            if name not in _dict:
-                continue
-            prop = getattr(_class, name)
-            value = _dict.get(name)
-            conv = convs.get(prop.__class__, lambda v: v)
-            if prop.multiple:
-                if isinstance(value, list):
-                    result[name] = list(map(conv, value))
-                else:
-                    result[name] = [conv(value)]
-            else:
-                if isinstance(value, list):
-                    result[name] = conv(value[0])
-                else:
-                    result[name] = conv(value)
-        return result
+        return _class._convs(convs)[1](_dict)
+
+    @classmethod
+    def convertvalues(_class, convs, _dict):
+        """Convert each value, or each value in a list of values, of the
+        properties in `_dict`, keeping lists of values for any property."""
+        return _class._convs(convs)[4](_dict)
 
     @classmethod
     def load(_class, convs, _dict):
-        return _class(**_class.convertdict(convs, _dict))
+        return _class._convs(convs)[2](_dict)
 
     @classmethod
     def store(_class, convs, model):
-        return _class.convertdict(convs, model.__dict__)
+        return _class._convs(convs)[3](model)
@@ -1,11 +1,15 @@
-import re, hashlib, tarfile
-from io import BytesIO, SEEK_END
+import re, bz2, lzma, zlib, struct, hashlib, tarfile, subprocess
+from io import BytesIO
 from base64 import b64encode, b64decode
 from datetime import datetime
-from stat import S_IFREG, S_IFDIR, S_IRWXU, \
-                 S_IRUSR, S_IWUSR, S_IRGRP, \
+from stat import S_IRWXU, S_IRUSR, S_IWUSR, S_IRGRP, \
                  S_IXGRP, S_IROTH, S_IXOTH
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from s3pac.model import Model
 from s3pac.model import LongProperty, StringProperty, DateTimeProperty
 
@@ -37,19 +41,6 @@ class Package(Model):
     sha256sum = StringProperty()
     publishdate = DateTimeProperty()
 
-def _checksum_file(_file, hashclass):
-    """Compute the checksum of a file."""
-    buf = bytearray(65536)
-    mem = memoryview(buf)
-    _hash = hashclass()
-    _file.seek(0)
-    while True:
-        n = _file.readinto(buf)
-        if n == 0:
-            break
-        _hash.update(mem[:n])
-    return _hash.hexdigest()
-
 _PKGINFO_LIST_KEYS = [
     'license', 'replaces', 'group', 'conflict', 'provides', 'backup', 'depend',
     'optdepend', 'makedepend', 'checkdepend', 'makepkgopt'
@@ -60,7 +51,7 @@ def _read_pkginfo_file(pkginfofile):
     pkginfo = { key: [] for key in _PKGINFO_LIST_KEYS }
     for line in pkginfofile:
         line = line.decode('utf8').strip()
-        if line[0] == '#':
+        if not line or line[0] == '#':
             continue
         key, value = re.split("\s*=\s*", line, 1)
         if key in _PKGINFO_LIST_KEYS:
@@ -69,16 +60,90 @@ def _read_pkginfo_file(pkginfofile):
             pkginfo[key] = value
     return pkginfo
 
-def read_package_file(pkgfile, sigfile=None):
-    """Read a package archive (and optionally a signature file)."""
-    pkg = Package()
+# Package file extensions by compression.
+_PACKAGE_EXTENSIONS = {
+    'none': ".pkg.tar",
+    'xz':   ".pkg.tar.xz",
+    'zst':  ".pkg.tar.zst",
+    'gz':   ".pkg.tar.gz",
+    'bz2':  ".pkg.tar.bz2",
+    }
 
-    # read .PKGINFO properties
-    pkgfile.seek(0)
-    with tarfile.open(fileobj=pkgfile, mode='r') as pkgtar:
-        pkginfo = _read_pkginfo_file(pkgtar.extractfile(".PKGINFO"))
+def is_package_filename(filename):
+    """Return whether `filename` has a package file extension."""
+    return any(filename.endswith(ext) for ext in _PACKAGE_EXTENSIONS.values())
+
+_VERSION_SEPARATOR = re.compile(r"[^0-9A-Za-z]*")
+_VERSION_DIGITS = re.compile(r"[0-9]*")
+_VERSION_LETTERS = re.compile(r"[A-Za-z]*")
 
-    # parse pkginfo properties
+def _isalpha(s, i):
+    return _VERSION_LETTERS.match(s, i).end() > i
+
+def _rpmvercmp(a, b):
+    """Compare the version strings `a` and `b` as rpmvercmp of libalpm."""
+    if a == b:
+        return 0
+    i = j = 0
+    while i < len(a) and j < len(b):
+        sepa = _VERSION_SEPARATOR.match(a, i).end()
+        sepb = _VERSION_SEPARATOR.match(b, j).end()
+        if sepa == len(a) or sepb == len(b):
+            i, j = sepa, sepb
+            break
+        if sepa - i != sepb - j:
+            return -1 if sepa - i < sepb - j else 1
+        i, j = sepa, sepb
+
+        # compare the next segments, numeric or alphabetic as in `a`
+        isnum = not _isalpha(a, i)
+        segment = _VERSION_DIGITS if isnum else _VERSION_LETTERS
+        enda = segment.match(a, i).end()
+        endb = segment.match(b, j).end()
+        if endb == j:
+            # numeric segments are newer than alphabetic ones
+            return 1 if isnum else -1
+        sa, sb = a[i:enda], b[j:endb]
+        if isnum:
+            sa, sb = sa.lstrip("0"), sb.lstrip("0")
+            if len(sa) != len(sb):
+                return -1 if len(sa) < len(sb) else 1
+        if sa != sb:
+            return -1 if sa < sb else 1
+        i, j = enda, endb
+
+    if i == len(a) and j == len(b):
+        return 0
+    # a remaining alphabetic segment never beats an empty one
+    if (i == len(a) and not _isalpha(b, j)) or _isalpha(a, i):
+        return -1
+    return 1
+
+def _parse_version(version):
+    """Return the epoch, version and release, or None, of a package version
+    [epoch:]version[-release]."""
+    epoch, version = re.match(r"(?:([0-9]*):)?(.*)$", version).groups()
+    version, _, release = version.rpartition("-") if "-" in version \
+                          else (version, None, None)
+    return epoch or "0", version, release
+
+def vercmp(a, b):
+    """Compare the package versions `a` and `b` as pacman does, returning a
+    negative number, zero or a positive number if `a` is older than, equal
+    to or newer than `b`."""
+    if a == b:
+        return 0
+    epocha, versiona, releasea = _parse_version(a)
+    epochb, versionb, releaseb = _parse_version(b)
+    result = _rpmvercmp(epocha, epochb) or _rpmvercmp(versiona, versionb)
+    if result == 0 and releasea is not None and releaseb is not None:
+        result = _rpmvercmp(releasea, releaseb)
+    return result
+
+def _package_from_pkginfo(pkginfo, compression='xz'):
+    """Create package metadata from .PKGINFO key-value pairs of a package
+    file compressed with `compression`."""
+    pkg = Package()
     pkg.arch = pkginfo.get('arch', 'any')
     pkg.name = pkginfo.get('pkgname', "")
     pkg.base = pkginfo.get('pkgbase', "")
@@ -97,22 +162,258 @@ def read_package_file(pkgfile, sigfile=None):
     pkg.optdepends = pkginfo.get('optdepend', [])
     pkg.makedepends = pkginfo.get('makedepend', [])
     pkg.checkdepends = pkginfo.get('checkdepend', [])
+    pkg.filename = "%s-%s-%s%s" % (pkg.name, pkg.version, pkg.arch,
+                                   _PACKAGE_EXTENSIONS[compression])
+    return pkg
 
-    # determine file properties
-    pkg.filename = "%s-%s-%s.pkg.tar.xz" % (pkg.name, pkg.version, pkg.arch)
-    pkg.filesize = pkgfile.seek(0, SEEK_END)
-    pkg.md5sum = _checksum_file(pkgfile, hashlib.md5)
-    pkg.sha256sum = _checksum_file(pkgfile, hashlib.sha256)
+# -----------------------------------------------------------------------------
 
-    # add signature if it exists
-    if sigfile:
-        pkg.pgpsig = b64encode(sigfile.read())
+# Decompressed bytes produced per decompressor call, bounding the memory
+# used when highly compressible archive members are skipped.
+_DECOMPRESS_CHUNK = 1024 * 1024
 
-    return pkg
+# Compressed bytes passed per zstd decompressor call, which cannot limit
+# its output otherwise.
+_ZSTD_INPUT_CHUNK = 16 * 1024
 
-def write_desc_file(_file, pkg):
-    """Write a `desc` file for the package database."""
-    fields = [
+_COMPRESSION_MAGIC = [
+    (b"\xfd7zXZ\x00",     'xz'),
+    (b"\x28\xb5\x2f\xfd", 'zst'),
+    (b"\x1f\x8b",         'gz'),
+    (b"BZh",              'bz2'),
+    ]
+
+_DECOMPRESS_ERRORS = (ValueError, OSError, EOFError, lzma.LZMAError,
+                      zlib.error)
+if zstandard is not None:
+    _DECOMPRESS_ERRORS += (zstandard.ZstdError,)
+
+class _Decompressor:
+    """Incremental decompressor that detects the compression format."""
+    def __init__(self):
+        self.head = b""
+        self.compression = None
+        self.impl = None
+
+    def _detect(self, data):
+        self.compression = 'none'
+        for magic, compression in _COMPRESSION_MAGIC:
+            if data.startswith(magic):
+                self.compression = compression
+        if self.compression == 'xz':
+            self.impl = lzma.LZMADecompressor()
+        elif self.compression == 'gz':
+            self.impl = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.compression == 'bz2':
+            self.impl = bz2.BZ2Decompressor()
+        elif self.compression == 'zst':
+            if zstandard is None:
+                raise ValueError("zstd support requires zstandard")
+            self.impl = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        """Decompress `data`, yielding decompressed chunks."""
+        if self.compression is None:
+            self.head += data
+            if len(self.head) < 6:
+                return
+            data, self.head = self.head, b""
+            self._detect(data)
+        if self.compression == 'none':
+            yield data
+        elif self.compression == 'gz':
+            while data:
+                yield self.impl.decompress(data, _DECOMPRESS_CHUNK)
+                data = self.impl.unconsumed_tail
+        elif self.compression == 'zst':
+            for i in range(0, len(data), _ZSTD_INPUT_CHUNK):
+                yield self.impl.decompress(data[i:i+_ZSTD_INPUT_CHUNK])
+        else:
+            while not self.impl.eof:
+                yield self.impl.decompress(data, _DECOMPRESS_CHUNK)
+                data = b""
+                if self.impl.needs_input:
+                    break
+
+    def flush(self):
+        """Decompress any data held back for format detection."""
+        if self.compression is None and self.head:
+            data, self.head = self.head, b""
+            self._detect(data)
+            yield from self.decompress(data)
+
+class _TarScanner:
+    """Incremental tar archive reader.
+
+    Decompressed archive data is fed with `feed`, and `onfile` is called
+    with the path and contents of each member for which `wants(path)` is
+    true. Other member contents are skipped without being buffered. If
+    given, `onmember` is called with the path and type flag of every member.
+    """
+    def __init__(self, wants, onfile, onmember=None):
+        self.wants = wants
+        self.onfile = onfile
+        self.onmember = onmember
+        self.buf = bytearray()
+        self.path = None      # path of the current member
+        self.data = None      # contents of the current member, if wanted
+        self.skip = 0         # bytes left in the current member
+        self.pad = 0          # padding after the current member
+        self.kind = None      # type flag of the current member
+        self.longpath = None  # path given by a preceding pax/GNU header
+        self.done = False
+
+    def feed(self, data):
+        self.buf += data
+        while not self.done:
+            if self.skip or self.pad:
+                n = min(len(self.buf), self.skip + self.pad)
+                if n == 0:
+                    return
+                if self.data is not None:
+                    self.data += self.buf[:min(n, self.skip)]
+                del self.buf[:n]
+                taken = min(n, self.skip)
+                self.skip -= taken
+                self.pad -= n - taken
+                if self.skip == 0 and self.pad == 0:
+                    self._member_done()
+                continue
+            if len(self.buf) < 512:
+                return
+            header = bytes(self.buf[:512])
+            del self.buf[:512]
+            if header == bytes(512):
+                self.done = True
+                return
+            self._member_start(header)
+            if self.skip == 0:
+                self._member_done()
+
+    def _member_start(self, header):
+        chksum = header[148:156].split(b"\0", 1)[0].strip()
+        if not chksum.isdigit() or int(chksum, 8) != \
+           sum(header[:148]) + 8 * 0x20 + sum(header[156:]):
+            raise ValueError("invalid tar header")
+
+        def _field(start, end):
+            field = header[start:end].split(b"\0", 1)[0]
+            return field.decode('utf8', 'replace')
+        path = _field(0, 100)
+        if header[257:262] == b"ustar" and header[345]:
+            path = _field(345, 500) + "/" + path
+        size = header[124:136]
+        if size[0] & 0x80:
+            size = int.from_bytes(size[1:], 'big')
+        else:
+            size = int(size.split(b"\0", 1)[0].strip() or b"0", 8)
+        self.kind = header[156:157]
+        self.path = self.longpath or path
+        self.skip = size
+        self.pad = -size % 512
+        wanted = self.kind in (b"x", b"L") or self.wants(self.path)
+        self.data = bytearray() if wanted else None
+
+    def _member_done(self):
+        data, self.data = self.data, None
+        if self.kind == b"L":
+            self.longpath = bytes(data).split(b"\0", 1)[0].decode('utf8')
+            return
+        if self.kind == b"x":
+            for key, value in _parse_pax_records(data):
+                if key == "path":
+                    self.longpath = value
+            return
+        self.longpath = None
+        if self.onmember is not None:
+            self.onmember(self.path, self.kind)
+        if data is not None:
+            self.onfile(self.path, bytes(data))
+
+def _parse_pax_records(data):
+    """Parse pax extended header records."""
+    pos = 0
+    while pos < len(data):
+        space = data.index(b" ", pos)
+        length = int(data[pos:space])
+        key, value = bytes(data[space+1:pos+length-1]).split(b"=", 1)
+        yield key.decode('utf8'), value.decode('utf8')
+        pos += length
+
+class PackageReader:
+    """Single-pass package archive reader.
+
+    Archive data is fed in arbitrary chunks with `write`. Checksums are
+    updated and the archive is decompressed as it arrives, so the archive
+    never has to be read twice. The paths of the installed files are
+    collected in `files`.
+    """
+    def __init__(self):
+        self.pkg = None
+        self.files = []
+        self.filesize = 0
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.decompressor = _Decompressor()
+        self.scanner = _TarScanner(lambda path: path == ".PKGINFO",
+                                   self._onfile, self._onmember)
+
+    def _onfile(self, path, data):
+        self.pkg = _package_from_pkginfo(_read_pkginfo_file(BytesIO(data)),
+                                         self.decompressor.compression)
+
+    def _onmember(self, path, kind):
+        # metadata files such as .PKGINFO and .MTREE are not installed
+        if path.startswith("."):
+            return
+        if kind == b"5" and not path.endswith("/"):
+            path += "/"
+        self.files.append(path)
+
+    def _scan(self, chunks):
+        try:
+            for chunk in chunks:
+                if self.scanner.done:
+                    break
+                self.scanner.feed(chunk)
+        except _DECOMPRESS_ERRORS as ex:
+            raise ValueError("not a package archive: %s" % ex)
+
+    def write(self, data):
+        """Feed the next chunk of archive data."""
+        self.filesize += len(data)
+        self.md5.update(data)
+        self.sha256.update(data)
+        if not self.scanner.done:
+            self._scan(self.decompressor.decompress(data))
+        return len(data)
+
+    def package(self, sigfile=None):
+        """Return the package metadata once the whole archive is written."""
+        self._scan(self.decompressor.flush())
+        if self.pkg is None:
+            raise ValueError("not a package archive: no .PKGINFO found")
+        self.pkg.filesize = self.filesize
+        self.files.sort()
+        self.pkg.md5sum = self.md5.hexdigest()
+        self.pkg.sha256sum = self.sha256.hexdigest()
+        if sigfile:
+            self.pkg.pgpsig = b64encode(sigfile.read()).decode('ascii')
+        return self.pkg
+
+def read_package_file(pkgfile, sigfile=None):
+    """Read a package archive (and optionally a signature file)."""
+    reader = PackageReader()
+    pkgfile.seek(0)
+    while True:
+        data = pkgfile.read(65536)
+        if not data:
+            break
+        reader.write(data)
+    return reader.package(sigfile)
+
+def _desc_fields(pkg):
+    return [
         ("%FILENAME%",  pkg.filename),
         ("%NAME%",      pkg.name),
         ("%BASE%",      pkg.base),
@@ -131,13 +432,9 @@ def write_desc_file(_file, pkg):
         ("%PACKAGER%",  pkg.packager),
         ("%REPLACES%",  str.join("\n", pkg.replaces)),
     ]
-    _file.seek(0)
-    for block in ["%s\n%s\n\n" % (k,v) for k,v in fields if v]:
-        _file.write(block.encode('utf-8'))
 
-def write_depends_file(_file, pkg):
-    """Write a `depends` file for the package database."""
-    fields = [
+def _depends_fields(pkg):
+    return [
         ("%DEPENDS%",      str.join("\n", pkg.depends)),
         ("%CONFLICTS%",    str.join("\n", pkg.conflicts)),
         ("%PROVIDES%",     str.join("\n", pkg.provides)),
@@ -145,43 +442,191 @@ def write_depends_file(_file, pkg):
         ("%MAKEDEPENDS%",  str.join("\n", pkg.makedepends)),
         ("%CHECKDEPENDS%", str.join("\n", pkg.checkdepends)),
     ]
+
+def _files_fields(files):
+    return [("%FILES%", str.join("\n", files))]
+
+def _fields_data(fields):
+    return str.join("", ["%s\n%s\n\n" % (k,v) for k,v in fields if v]) \
+              .encode('utf-8')
+
+def write_desc_file(_file, pkg):
+    """Write a `desc` file for the package database."""
     _file.seek(0)
-    for block in ["%s\n%s\n\n" % (k,v) for k,v in fields if v]:
-        _file.write(block.encode('utf-8'))
+    _file.write(_fields_data(_desc_fields(pkg)))
+
+def write_depends_file(_file, pkg):
+    """Write a `depends` file for the package database."""
+    _file.seek(0)
+    _file.write(_fields_data(_depends_fields(pkg)))
 
 def write_signature_file(_file, pkg):
     """Write the signature file of a package."""
     _file.seek(0)
     _file.write(b64decode(pkg.pgpsig))
 
-def write_database_file(_file, pkgs):
-    """Write out a package database file."""
-    _file.seek(0)
-    tar = tarfile.open(fileobj=_file, mode='w:gz')
+def sign_data(data, key):
+    """Return a detached OpenPGP signature of `data` made with the secret
+    key `key` by gpg, like repo-add --sign."""
+    result = subprocess.run(["gpg", "--batch", "--detach-sign", "--no-armor",
+                             "--local-user", key, "--output", "-"],
+                            input=data, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise IOError("gpg failed: %s" % \
+                      result.stderr.decode('utf-8', 'replace').strip())
+    return result.stdout
+
+# -----------------------------------------------------------------------------
 
-    REG = S_IFREG | S_IRUSR | S_IWUSR | S_IRGRP | S_IROTH
-    DIR = S_IFDIR | S_IRWXU | S_IRGRP | S_IXGRP | S_IROTH | S_IXOTH
+_REG = S_IRUSR | S_IWUSR | S_IRGRP | S_IROTH
+_DIR = S_IRWXU | S_IRGRP | S_IXGRP | S_IROTH | S_IXOTH
 
-    def _add(path, mode, _file=None):
+def _tar_header(path, mode, kind, size):
+    """Return a ustar header for a member owned by root."""
+    name = path.encode('utf-8')
+    if len(name) > 100:
         info = tarfile.TarInfo(path)
-        info.mode = mode
-        info.uname = 'root'
-        info.gname = 'root'
-        if _file:
-            info.size = _file.seek(0, SEEK_END)
-            _file.seek(0)
-        tar.addfile(info, _file)
+        info.mode, info.type, info.size = mode, kind, size
+        info.uname = info.gname = 'root'
+        return info.tobuf(tarfile.PAX_FORMAT)
+    header = bytearray(_TAR_HEADER)
+    header[0:len(name)] = name
+    header[100:108] = b"%07o\0" % mode
+    header[124:136] = b"%011o\0" % size
+    header[156:157] = kind
+    header[148:156] = b"%06o\0 " % sum(header)
+    return header
 
+_TAR_HEADER = bytearray(512)
+_TAR_HEADER[108:124] = b"0000000\0" * 2                 # uid, gid
+_TAR_HEADER[136:156] = b"00000000000\0" + b" " * 8      # mtime, chksum
+_TAR_HEADER[257:265] = b"ustar\x0000"
+_TAR_HEADER[265:269] = b"root"
+_TAR_HEADER[297:301] = b"root"
+_TAR_HEADER[329:345] = b"0000000\0" * 2                 # devmajor, devminor
+
+def _tar_member(path, data=None):
+    """Return the tar header and contents of a database member, which is a
+    directory if `data` is None."""
+    if data is None:
+        return _tar_header(path, _DIR, tarfile.DIRTYPE, 0)
+    return _tar_header(path, _REG, tarfile.REGTYPE, len(data)) + data + \
+        bytes(-len(data) % 512)
+
+def _iter_database_tar(pkgs, files):
     for pkg in pkgs:
         dirname = "%s-%s" % (pkg.name, pkg.version)
-        _add(dirname + "/", DIR)
+        yield _tar_member(dirname + "/")
+        yield _tar_member(dirname + "/desc", _fields_data(_desc_fields(pkg)))
+        yield _tar_member(dirname + "/depends",
+                          _fields_data(_depends_fields(pkg)))
+        if files is not None:
+            yield _tar_member(dirname + "/files",
+                              _fields_data(_files_fields(files(pkg))))
+    yield bytes(2 * 512)
+
+# Uncompressed bytes per independently compressed gzip block.
+_GZIP_BLOCK_SIZE = 128 * 1024
+
+# Maximum number of gzip blocks being compressed at a time.
+_GZIP_MAX_PENDING = 32
+
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
 
-        descfile = BytesIO()
-        write_desc_file(descfile, pkg)
-        _add(dirname + "/desc", REG, descfile)
+def _deflate_block(data, zdict, level):
+    if zdict:
+        deflate = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                   zdict=zdict)
+    else:
+        deflate = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return deflate.compress(data) + deflate.flush(zlib.Z_SYNC_FLUSH)
 
-        dependsfile = BytesIO()
-        write_depends_file(dependsfile, pkg)
-        _add(dirname + "/depends", REG, dependsfile)
+def _blocks(chunks, size):
+    block = bytearray()
+    for chunk in chunks:
+        block += chunk
+        while len(block) >= size:
+            yield bytes(block[:size])
+            del block[:size]
+    if block:
+        yield bytes(block)
 
-    tar.close()
+def _compress_gzip(chunks, level=9, executor=None):
+    """Compress `chunks` into a single gzip stream.
+
+    As in pigz, the data is split into blocks that are compressed
+    independently, and concurrently if an `executor` is given, and then
+    joined into one deflate stream. Each block is primed with the last 32
+    KiB of the previous block, which keeps the compression ratio close to
+    that of a single stream. Only the checksum is computed serially.
+    """
+    yield _GZIP_HEADER
+    crc = 0
+    size = 0
+    zdict = b""
+    pending = []
+    for block in _blocks(chunks, _GZIP_BLOCK_SIZE):
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        args = (block, zdict, level)
+        zdict = block[-32768:]
+        if executor is None:
+            yield _deflate_block(*args)
+            continue
+        pending.append(executor.submit(_deflate_block, *args))
+        while len(pending) >= _GZIP_MAX_PENDING or pending[0].done():
+            yield pending.pop(0).result()
+            if not pending:
+                break
+    for future in pending:
+        yield future.result()
+    # empty final block, then the gzip trailer
+    yield zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush() \
+        + struct.pack("<II", crc, size & 0xffffffff)
+
+def _compress_xz(chunks, executor=None):
+    lzc = lzma.LZMACompressor()
+    for chunk in chunks:
+        data = lzc.compress(chunk)
+        if data:
+            yield data
+    yield lzc.flush()
+
+def _compress_zst(chunks, executor=None):
+    # zstd compresses on threads of its own
+    threads = -1 if executor is not None else 0
+    zc = zstandard.ZstdCompressor(threads=threads).compressobj()
+    for chunk in chunks:
+        data = zc.compress(chunk)
+        if data:
+            yield data
+    yield zc.flush()
+
+_COMPRESSORS = {
+    'gz':  _compress_gzip,
+    'xz':  _compress_xz,
+    'zst': _compress_zst,
+    }
+
+def iter_database_file(pkgs, files=None, compression='gz', executor=None):
+    """Generate a package database file in chunks.
+
+    If `files` is given, a files database is generated instead, listing the
+    files of each package as returned by `files(pkg)`. The database is
+    compressed with `compression` ('gz', 'xz' or 'zst'), using the threads
+    of `executor` if given. The output depends only on the packages, so that
+    identical package lists produce byte-identical database files.
+    """
+    if compression not in _COMPRESSORS:
+        raise ValueError("unknown compression: %s" % compression)
+    if compression == 'zst' and zstandard is None:
+        raise ValueError("zst compression requires zstandard")
+    chunks = _blocks(_iter_database_tar(pkgs, files), _GZIP_BLOCK_SIZE)
+    return _COMPRESSORS[compression](chunks, executor=executor)
+
+def write_database_file(_file, pkgs, files=None, compression='gz'):
+    """Write out a package database file, see `iter_database_file`."""
+    _file.seek(0)
+    for chunk in iter_database_file(pkgs, files, compression):
+        _file.write(chunk)
@@ -0,0 +1,116 @@
+"""Storage backend interfaces.
+
+A package repository is kept in two stores: a metadata store holding the
+`Package` records, per-repository state and change logs, and a blob store
+holding the package archives. `s3pac.aws` implements both on SimpleDB and
+S3, and `s3pac.local` on SQLite and a local directory.
+"""
+
+class MetadataStore:
+    """Package metadata storage."""
+
+    # Number of packages per `put` or `delete` call, if larger calls should
+    # be split into several made concurrently.
+    batch_size = None
+
+    def put(self, pkgs):
+        """Insert or replace the metadata of each package in `pkgs`."""
+        raise NotImplementedError
+
+    def query(self, conds, fields=None, order=None, limit=None, token=None):
+        """Return an iterable of packages matching all conditions, and a
+        token for the next page of results or None.
+
+        `conds` maps `Package` property names to a value or a list of
+        values, any of which must match. String values beginning or ending
+        with '%' match as prefix, suffix or substring patterns. Only the
+        properties in `fields` are read, if given. Packages are ordered by
+        the property `order`, descending if prefixed with '-'. At most
+        `limit` packages are returned, starting from `token`.
+        """
+        raise NotImplementedError
+
+    def find(self, **conds):
+        """Return a list of all packages matching `conds`, see `query`."""
+        pkgs, _ = self.query(conds)
+        return list(pkgs)
+
+    def delete(self, pkgs):
+        """Delete the metadata of each package in `pkgs`."""
+        raise NotImplementedError
+
+    def get_stamp(self, repo):
+        """Return the change stamp of `repo`, or None if it has none."""
+        raise NotImplementedError
+
+    def set_stamp(self, repo, stamp):
+        """Set the change stamp of `repo`."""
+        raise NotImplementedError
+
+    def get_snapshots(self, repo):
+        """Return the database snapshots of `repo`, a dictionary mapping
+        snapshot names to dictionaries of JSON values."""
+        raise NotImplementedError
+
+    def set_snapshots(self, repo, snapshots):
+        """Record the database snapshots of `repo` in `snapshots`, see
+        `get_snapshots`, replacing all previous ones."""
+        raise NotImplementedError
+
+    def add_changes(self, repo, changes):
+        """Append `changes`, a list of dictionaries of JSON values, to the
+        change log of `repo`."""
+        raise NotImplementedError
+
+    def query_changes(self, repo, since=None, limit=None):
+        """Return the changes in the change log of `repo` after the token
+        `since`, or from the start, in order, up to `limit` of them.
+
+        Each change is returned with its token added as 'token'. Tokens are
+        strings ordered like the changes. Raises ValueError if `since` is
+        not a token of this store.
+        """
+        raise NotImplementedError
+
+class BlobUpload:
+    """Streaming upload of a single blob."""
+
+    def write(self, data):
+        """Write the next chunk of blob data."""
+        raise NotImplementedError
+
+    def commit(self):
+        """Complete the upload, making the blob available."""
+        raise NotImplementedError
+
+    def abort(self):
+        """Abort an unfinished upload, discarding any data written."""
+        raise NotImplementedError
+
+class BlobStore:
+    """Package archive storage."""
+
+    # Number of blobs per `delete` call, if larger calls should be split
+    # into several made concurrently.
+    batch_size = None
+
+    def upload(self, keyname):
+        """Start a streaming upload of the blob `keyname`."""
+        raise NotImplementedError
+
+    def delete(self, keynames):
+        """Delete each blob in `keynames` that exists."""
+        raise NotImplementedError
+
+    def url(self, keyname):
+        """Return a HTTP download URL for `keyname`, or None if the blob
+        must be served with `open` instead."""
+        raise NotImplementedError
+
+    def open(self, keyname):
+        """Open the blob `keyname` for reading."""
+        raise NotImplementedError
+
+    def stats(self):
+        """Return a dictionary of cache statistics, if any."""
+        return {}
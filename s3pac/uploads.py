@@ -0,0 +1,126 @@
+"""Resumable uploads in chunks, shared between server processes."""
+import os, re, json, time, uuid, shutil
+from datetime import datetime
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+_CHUNK_NAME = re.compile(r"^(\d+)-(\d+)\.chunk$")
+
+_COPY_SIZE = 65536
+
+class UploadSessions:
+    """Uploads of files sent in chunks, in any order and in parallel.
+
+    Each upload session keeps the file in a directory below `root`, along
+    with a marker for each chunk written completely, so that any process
+    sharing the directory can accept chunks and an interrupted upload can
+    be resumed by sending only the missing chunks. Sessions are removed
+    `ttl` seconds after they last received a chunk.
+    """
+    def __init__(self, root, ttl=86400):
+        self.root = root
+        self.ttl = ttl
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, uploadid, *names):
+        return os.path.join(self.root, uploadid, *names)
+
+    def _expire(self):
+        now = time.time()
+        for entry in os.scandir(self.root):
+            try:
+                if entry.stat().st_mtime + self.ttl < now:
+                    shutil.rmtree(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def _session(self, repo, uploadid):
+        if not _UPLOAD_ID.match(uploadid):
+            return None
+        try:
+            with open(self._path(uploadid, "session.json")) as _file:
+                session = json.load(_file)
+        except FileNotFoundError:
+            return None
+        return session if session['repo'] == repo else None
+
+    def create(self, repo, filename, size):
+        """Start an upload of `size` bytes to be published to `repo` as
+        `filename` and return its state."""
+        self._expire()
+        session = { 'id': uuid.uuid4().hex, 'repo': repo,
+                    'filename': filename, 'size': size,
+                    'created': datetime.utcnow().isoformat() }
+        os.makedirs(self._path(session['id']))
+        with open(self._path(session['id'], "data"), 'wb') as _file:
+            _file.truncate(size)
+        with open(self._path(session['id'], "session.json"), 'w') as _file:
+            json.dump(session, _file)
+        return self.status(repo, session['id'])
+
+    def status(self, repo, uploadid):
+        """Return the state of an upload, including the byte ranges received
+        so far, or None if there is no such upload."""
+        session = self._session(repo, uploadid)
+        if session is None:
+            return None
+        chunks = sorted(tuple(map(int, match.groups()))
+                        for match in map(_CHUNK_NAME.match,
+                                         os.listdir(self._path(uploadid)))
+                        if match)
+        received = []
+        for start, stop in chunks:
+            if received and start <= received[-1][1]:
+                received[-1][1] = max(received[-1][1], stop)
+            else:
+                received.append([start, stop])
+        session['received'] = received
+        session['complete'] = received == [[0, session['size']]]
+        return session
+
+    def write(self, repo, uploadid, start, stop, stream):
+        """Write bytes `start` to `stop` (exclusive) of an upload, read from
+        `stream`.
+
+        Raises KeyError if there is no such upload and ValueError if the
+        range is invalid or `stream` ends early.
+        """
+        session = self._session(repo, uploadid)
+        if session is None:
+            raise KeyError(uploadid)
+        if not 0 <= start < stop <= session['size']:
+            raise ValueError("invalid range: %d-%d" % (start, stop))
+
+        fd = os.open(self._path(uploadid, "data"), os.O_WRONLY)
+        try:
+            offset = start
+            while offset < stop:
+                data = stream.read(min(_COPY_SIZE, stop - offset))
+                if not data:
+                    raise ValueError("incomplete chunk: %d-%d" % (start, stop))
+                offset += os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+
+        # mark the chunk as received only once it is written completely
+        open(self._path(uploadid, "%d-%d.chunk" % (start, stop)), 'w').close()
+        os.utime(self._path(uploadid))
+
+    def open(self, repo, uploadid):
+        """Return the file name and an open file of a complete upload.
+
+        Raises KeyError if there is no such upload and ValueError if the
+        upload is not complete.
+        """
+        session = self.status(repo, uploadid)
+        if session is None:
+            raise KeyError(uploadid)
+        if not session['complete']:
+            raise ValueError("upload not complete: %s" % uploadid)
+        return session['filename'], open(self._path(uploadid, "data"), 'rb')
+
+    def remove(self, repo, uploadid):
+        """Remove an upload. Returns whether there was such an upload."""
+        if self._session(repo, uploadid) is None:
+            return False
+        shutil.rmtree(self._path(uploadid), ignore_errors=True)
+        return True
@@ -1,12 +1,20 @@
-import os, io, json
-from datetime import datetime
+import os, io, json, time, hashlib, tempfile, threading
+from datetime import datetime, timezone
 from dateutil import parser as dateparser
 from flask import Flask, Response, request, redirect, url_for, abort, send_file
-from werkzeug import secure_filename
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import is_resource_modified, parse_content_range_header
+from werkzeug.wsgi import wrap_file
 
 from s3pac.model import LongProperty, DateTimeProperty
-from s3pac.package import Package, write_database_file, write_signature_file
-from s3pac.database import PackageDatabase
+from s3pac.package import Package, is_package_filename
+from s3pac.package import write_signature_file
+from s3pac.database import PackageDatabase, PackageUpload
+from s3pac.blobcache import BlobCache, is_sha256sum
+from s3pac.index import RELATIONS
+from s3pac.jobs import JobQueue
+from s3pac.uploads import UploadSessions
+from s3pac.metrics import Registry, TimedApplication
 
 # -----------------------------------------------------------------------------
 
@@ -19,12 +27,25 @@ _FROM_QUERY = {
     DateTimeProperty: dateparser.parse,
     }
 
-def _json_from_pkg(pkg):
-    return Package.store(_TO_JSON, pkg)
+# Package list arguments that are not filters.
+_LIST_ARGS = ['fields', 'order', 'limit', 'next']
+
+# Maximum number of changes returned at once.
+_CHANGES_LIMIT = 1000
+
+def _json_from_pkg(pkg, fields=None):
+    _json = Package.store(_TO_JSON, pkg)
+    if fields:
+        return { name: _json[name] for name in fields }
+    return _json
 
 def _filters_from_args(args):
-    filters = { key: args.getlist(key) for key in args.keys() }
-    return Package.convertdict(_FROM_QUERY, filters)
+    filters = { key: args.getlist(key) for key in args.keys()
+                if key not in _LIST_ARGS }
+    try:
+        return Package.convertvalues(_FROM_QUERY, filters)
+    except ValueError:
+        abort(400)
 
 # -----------------------------------------------------------------------------
 
@@ -32,44 +53,250 @@ app = Flask(__name__, instance_path=os.getcwd(),
                       instance_relative_config=True)
 app.config.from_pyfile("s3pac.conf.py")
 
-pkgdb = PackageDatabase(
-    access_key_id = app.config.get('AWS_ACCESS_KEY_ID', None),
-    secret_access_key = app.config.get('AWS_SECRET_ACCESS_KEY', None),
-    region_name = app.config.get('AWS_REGION_NAME'),
-    sdb_domain_name = app.config.get('AWS_SDB_DOMAIN_NAME'),
-    s3_bucket_name = app.config.get('AWS_S3_BUCKET_NAME'),
-    s3_prefix = app.config.get('AWS_S3_PREFIX', "")
-)
+def _create_stores(config):
+    """Create the metadata and blob stores selected by `STORAGE`."""
+    storage = config.get('STORAGE', 'aws')
+
+    if storage == 'aws':
+        from s3pac.aws import SimpleDBMetadataStore, S3BlobStore
+        metadata = SimpleDBMetadataStore(
+            access_key_id = config.get('AWS_ACCESS_KEY_ID', None),
+            secret_access_key = config.get('AWS_SECRET_ACCESS_KEY', None),
+            region_name = config.get('AWS_REGION_NAME'),
+            domain_name = config.get('AWS_SDB_DOMAIN_NAME'))
+        blobs = S3BlobStore(
+            access_key_id = config.get('AWS_ACCESS_KEY_ID', None),
+            secret_access_key = config.get('AWS_SECRET_ACCESS_KEY', None),
+            region_name = config.get('AWS_REGION_NAME'),
+            bucket_name = config.get('AWS_S3_BUCKET_NAME'),
+            prefix = config.get('AWS_S3_PREFIX', ""),
+            endpoint = config.get('AWS_S3_ENDPOINT', None),
+            part_size = config.get('AWS_S3_PART_SIZE', 8 * 1024 * 1024),
+            upload_threads = config.get('AWS_S3_UPLOAD_THREADS', 4),
+            upload_retries = config.get('AWS_S3_UPLOAD_RETRIES', 3),
+            url_expires = config.get('AWS_S3_URL_EXPIRES', 3600),
+            url_reuse = config.get('AWS_S3_URL_REUSE', 1800))
+        return metadata, blobs
+
+    if storage == 'local':
+        from s3pac.local import SQLiteMetadataStore, LocalBlobStore
+        metadata = SQLiteMetadataStore(
+            path = config.get('LOCAL_DATABASE_PATH', "s3pac.sqlite"))
+        blobs = LocalBlobStore(
+            root = config.get('LOCAL_BLOB_ROOT', "packages"),
+            base_url = config.get('LOCAL_BLOB_URL', None))
+        return metadata, blobs
+
+    raise ValueError("unknown STORAGE: %s" % storage)
 
 def _data_abspath(relpath):
     root = app.config.get('DATA_ROOT', "data")
     return os.path.join(os.getcwd(), root, relpath)
 
+# metrics of all server processes sharing DATA_ROOT
+metrics = Registry(_data_abspath("metrics"),
+    interval = app.config.get('METRICS_INTERVAL', 5.0))
+
+app.wsgi_app = TimedApplication(app.wsgi_app, metrics)
+
+@app.before_request
+def _label_request():
+    request.environ['s3pac.route'] = request.endpoint or "none"
+
+# package files downloaded from the blob store, if enabled
+blob_cache = None
+if app.config.get('BLOB_CACHE_SIZE', 0) > 0:
+    blob_cache = BlobCache(_data_abspath("blobs"),
+                           maxsize = app.config['BLOB_CACHE_SIZE'])
+
+pkgdb = PackageDatabase(*_create_stores(app.config),
+    cache_size = app.config.get('PACKAGE_CACHE_SIZE', 10000),
+    cache_ttl = app.config.get('PACKAGE_CACHE_TTL', 60),
+    files_cache_size = app.config.get('FILES_CACHE_SIZE', 10000),
+    database_cache_size = app.config.get('DATABASE_CACHE_SIZE', 64),
+    threads = app.config.get('STORAGE_THREADS', 8),
+    timeout = app.config.get('STORAGE_TIMEOUT', 60),
+    compress_threads = app.config.get('DATABASE_COMPRESS_THREADS', 4),
+    blob_cache = blob_cache,
+    fill_threads = app.config.get('BLOB_CACHE_THREADS', 2),
+    snapshot_compression = app.config.get('DATABASE_COMPRESSION', 'gz')
+        if app.config.get('DATABASE_SNAPSHOTS', False) else None,
+    sign_key = app.config.get('DATABASE_SIGN_KEY', None),
+    metrics = metrics)
+
+_database_cache = metrics.counter('s3pac_cache_requests_total',
+    "Cache lookups by result.", ('cache', 'result'))
+
+# package archives of background publish jobs are spooled to disk
+os.makedirs(_data_abspath("uploads"), exist_ok=True)
+
+jobs = JobQueue(_data_abspath("jobs"),
+    threads = app.config.get('PUBLISH_JOB_THREADS', 2),
+    ttl = app.config.get('PUBLISH_JOB_TTL', 86400))
+
+sessions = UploadSessions(_data_abspath("sessions"),
+    ttl = app.config.get('UPLOAD_SESSION_TTL', 86400))
+
+# state of the cache warm-up of this process, see /readyz
+_warmup = { 'pid': None, 'ready': False, 'error': None }
+_warmup_lock = threading.Lock()
+
+def _warm_up():
+    """Warm up the caches for WARMUP_REPOS, retrying until it succeeds."""
+    delay = 1
+    while True:
+        try:
+            pkgdb.warm_up(app.config.get('WARMUP_REPOS', []),
+                          app.config.get('DATABASE_COMPRESSION', 'gz'))
+            _warmup.update(ready=True, error=None)
+            return
+        except Exception as ex:
+            app.logger.warning("cache warm-up failed: %s", ex)
+            _warmup['error'] = str(ex)
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+@app.before_request
+def _start_warm_up():
+    """Start the cache warm-up in this process, unless it is started.
+
+    Called for each request rather than on import, since servers may fork
+    their workers after importing the application.
+    """
+    if _warmup['pid'] == os.getpid():
+        return
+    with _warmup_lock:
+        if _warmup['pid'] == os.getpid():
+            return
+        _warmup.update(pid=os.getpid(), ready=False, error=None)
+        threading.Thread(target=_warm_up, name="s3pac-warmup",
+                         daemon=True).start()
+
 # -----------------------------------------------------------------------------
 
-def _get_database_file(repo, sysarch):
-    # collect packages with given system architecture or 'any'
-    pkgs = []
-    for arch in (sysarch, 'any'):
-        pkgs.extend(pkgdb.find(repo=repo, arch=arch))
+# Database file extensions, and whether they denote the files database and
+# which compression. Plain .db and .files use DATABASE_COMPRESSION.
+_DATABASE_EXTENSIONS = [
+    (".db",              False, None),
+    (".db.tar.gz",       False, 'gz'),
+    (".db.tar.xz",       False, 'xz'),
+    (".db.tar.zst",      False, 'zst'),
+    (".files",           True,  None),
+    (".files.tar.gz",    True,  'gz'),
+    (".files.tar.xz",    True,  'xz'),
+    (".files.tar.zst",   True,  'zst'),
+    ]
 
-    # write package database file
-    dbfilepath = _data_abspath("%s.db.tar.gz" % repo)
-    with open(dbfilepath, 'wb') as dbfile:
-        write_database_file(dbfile, pkgs)
+def _send_blob(keyname, response, size=None):
+    """Redirect to the blob `keyname` if it has a download URL, or send it
+    in `response`."""
+    if app.config.get('DATABASE_SNAPSHOT_REDIRECT', True):
+        url = pkgdb.blob_url(keyname)
+        if url:
+            return redirect(url)
+    response.response = wrap_file(request.environ, pkgdb.open_blob(keyname))
+    response.direct_passthrough = True
+    if size is not None:
+        response.content_length = size
+    return response
 
-    # send the database file
-    return send_file(dbfilepath, mimetype='application/octet-stream')
+def _database_etag(repo, sysarch, files, compression, stamp):
+    # the database only changes when the repository does
+    etag = "%s/%s/%s/%s/%s" % (repo, sysarch, "files" if files else "db",
+                               compression, stamp.isoformat())
+    return hashlib.sha1(etag.encode('utf-8')).hexdigest()
+
+def _get_database_file(repo, sysarch, files, compression):
+    compression = compression or app.config.get('DATABASE_COMPRESSION', 'gz')
+
+    stamp = pkgdb.stamp(repo)
+    etag = _database_etag(repo, sysarch, files, compression, stamp)
+
+    response = Response(mimetype='application/octet-stream')
+    response.set_etag(etag)
+    response.last_modified = stamp
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=stamp):
+        response.status_code = 304
+        return response
+
+    snapshot = pkgdb.snapshot(repo, sysarch, stamp, files, compression)
+    if snapshot is not None:
+        return _send_blob(snapshot['keyname'], response, snapshot['size'])
+
+    data = pkgdb.cached_database(repo, sysarch, stamp, files, compression)
+    if data is not None:
+        _database_cache.inc(('database', 'hit'))
+        response.set_data(data)
+    else:
+        _database_cache.inc(('database', 'miss'))
+        try:
+            response.response = pkgdb.iter_database(repo, sysarch, stamp,
+                                                    files, compression)
+        except ValueError:
+            abort(404)
+    return response
+
+def _get_database_signature_file(repo, sysarch, files, compression):
+    compression = compression or app.config.get('DATABASE_COMPRESSION', 'gz')
+    snapshot = pkgdb.snapshot(repo, sysarch, pkgdb.stamp(repo), files,
+                              compression)
+    if snapshot is None or not snapshot['signed']:
+        abort(404)
+    return _send_blob(snapshot['keyname'] + ".sig",
+                      Response(mimetype='application/octet-stream'))
+
+def _send_package_file(pkg, pkgfile):
+    """Send the open package file of `pkg`, answering conditional and range
+    requests."""
+    response = Response(mimetype='application/octet-stream')
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=pkg.filename)
+    if is_sha256sum(pkg.sha256sum):
+        response.set_etag(pkg.sha256sum)
+    if pkg.publishdate:
+        response.last_modified = pkg.publishdate
+
+    accel = app.config.get('BLOB_CACHE_ACCEL_REDIRECT', None)
+    if accel and blob_cache and \
+       os.path.dirname(pkgfile.name) == blob_cache.root:
+        # sent by the front-end server, which handles conditions and ranges
+        pkgfile.close()
+        response.headers['X-Accel-Redirect'] = \
+            accel.rstrip("/") + "/" + os.path.basename(pkgfile.name)
+        return response
+
+    try:
+        size = os.fstat(pkgfile.fileno()).st_size
+        response.response = wrap_file(request.environ, pkgfile)
+        response.direct_passthrough = True
+        response.content_length = size
+        return response.make_conditional(request, accept_ranges=True,
+                                         complete_length=size)
+    except Exception:
+        pkgfile.close()
+        raise
 
 def _get_package_file(repo, filename):
-    pkg = pkgdb.findone(repo=repo, filename=filename)
+    pkg = pkgdb.package_file(repo, filename)
     if not pkg:
         abort(404)
-    return redirect(pkgdb.url(pkg))
+    pkgurl = pkgdb.url(pkg)
+    if pkgurl is None:
+        return _send_package_file(pkg, pkgdb.open(pkg))
+    # files not cached yet are sent from the blob store meanwhile
+    try:
+        pkgfile = pkgdb.open_cached(pkg)
+    except OSError as ex:
+        app.logger.warning("cannot read %s from the cache: %s", filename, ex)
+        pkgfile = None
+    if pkgfile is None:
+        return redirect(pkgurl)
+    return _send_package_file(pkg, pkgfile)
 
 def _get_package_signature_file(repo, sigfilename):
     pkgfilename = sigfilename[:-4]
-    pkg = pkgdb.findone(repo=repo, filename=pkgfilename)
+    pkg = pkgdb.package_file(repo, pkgfilename)
     if not pkg or not pkg.pgpsig:
         abort(404)
 
@@ -84,22 +311,63 @@ def _get_package_signature_file(repo, sigfilename):
 @app.route("/r/<repo>/<arch>/<filename>", methods=['GET'])
 def get_file(repo, arch, filename):
     """Pacman repository interface."""
-    if filename.endswith(".pkg.tar.xz"):
+    if is_package_filename(filename):
         return _get_package_file(repo, filename)
-    if filename.endswith(".pkg.tar.xz.sig"):
+    if filename.endswith(".sig") and is_package_filename(filename[:-4]):
         return _get_package_signature_file(repo, filename)
-    if filename.endswith(".db") or filename.endswith(".db.tar.gz"):
-        return _get_database_file(repo, arch)
+    for ext, files, compression in _DATABASE_EXTENSIONS:
+        if filename.endswith(ext + ".sig"):
+            return _get_database_signature_file(repo, arch, files,
+                                                compression)
+    for ext, files, compression in _DATABASE_EXTENSIONS:
+        if filename.endswith(ext):
+            return _get_database_file(repo, arch, files, compression)
     abort(404)
 
+def _get_package_list(filters):
+    """Return the packages matching `filters` as a JSON array.
+
+    Only the properties listed in the `fields` argument are returned, if
+    given, ordered by the property in `order`. If `limit` is given, at most
+    that many packages are returned, and the `X-Next-Token` header of the
+    response gives the `next` argument for the following page.
+    """
+    props = Package.__model_props__
+    fields = request.args.get('fields')
+    fields = fields.split(",") if fields else None
+    if fields and not all(name in props for name in fields):
+        abort(400)
+    order = request.args.get('order')
+    if order and (order.lstrip('-') not in props or
+                  props[order.lstrip('-')].multiple):
+        abort(400)
+    try:
+        limit = request.args.get('limit')
+        limit = int(limit) if limit else None
+        if limit is not None and limit < 1:
+            raise ValueError("invalid limit")
+        pkgs, token = pkgdb.query(filters, fields, order, limit,
+                                  request.args.get('next'))
+    except ValueError:
+        abort(400)
+
+    def _generate():
+        yield "["
+        for i, pkg in enumerate(pkgs):
+            yield ("," if i else "") + json.dumps(_json_from_pkg(pkg, fields))
+        yield "]"
+
+    response = Response(_generate(), mimetype='application/json')
+    if token:
+        response.headers['X-Next-Token'] = token
+    return response
+
 @app.route("/p/<repo>/", methods=['GET'])
 def get_package_list(repo):
     """Return all packages in a repository."""
     filters = _filters_from_args(request.args)
     filters['repo'] = repo
-    pkgs = pkgdb.find(**filters)
-    _json = list(map(_json_from_pkg, pkgs))
-    return json.dumps(_json)
+    return _get_package_list(filters)
 
 @app.route("/p/<repo>/<arch>/", methods=['GET'])
 def get_package_list_arch(repo, arch):
@@ -107,14 +375,12 @@ def get_package_list_arch(repo, arch):
     filters = _filters_from_args(request.args)
     filters['repo'] = repo
     filters['arch'] = arch
-    pkgs = pkgdb.find(**filters)
-    _json = list(map(_json_from_pkg, pkgs))
-    return json.dumps(_json)
+    return _get_package_list(filters)
 
 @app.route("/p/<repo>/<arch>/<name>", methods=['GET'])
 def get_package(repo, arch, name):
     """Return a specific package."""
-    pkg = pkgdb.findone(repo=repo, arch=arch, name=name)
+    pkg = pkgdb.package(repo, arch, name)
     if not pkg:
         abort(404)
     return json.dumps(_json_from_pkg(pkg))
@@ -126,29 +392,309 @@ def delete_package(repo, arch, name):
         abort(404)
     return ""
 
+def _relation_args():
+    relations = request.args.getlist('relation') or ['depends']
+    if any(relation not in RELATIONS for relation in relations):
+        abort(400)
+    transitive = request.args.get('transitive', "0") != "0"
+    return relations, request.args.get('arch', None), transitive
+
+def _json_from_related(related):
+    return Response(json.dumps([{ 'arch': pkg.arch, 'name': pkg.name,
+                                  'version': pkg.version, 'depth': depth }
+                                for pkg, depth in related]),
+                    mimetype='application/json')
+
+@app.route("/p/<repo>/provides/<name>", methods=['GET'])
+def get_providers(repo, name):
+    """Return the packages named or providing `name`, for the architecture
+    in the `arch` argument, if given."""
+    pkgs = pkgdb.index(repo).providers(name, request.args.get('arch', None))
+    return _json_from_related((pkg, 0) for pkg in pkgs)
+
+@app.route("/p/<repo>/rdepends/<name>", methods=['GET'])
+def get_reverse_dependencies(repo, name):
+    """Return the packages depending on `name` or on a name it provides.
+
+    The `relation` arguments select the relations followed (default
+    `depends`), and with `transitive`, the packages depending on those are
+    returned too, each with the depth at which it was found.
+    """
+    relations, arch, transitive = _relation_args()
+    return _json_from_related(pkgdb.index(repo).rdepends(name, relations,
+                                                         arch, transitive))
+
+@app.route("/p/<repo>/depends/<name>", methods=['GET'])
+def get_dependencies(repo, name):
+    """Return the packages satisfying the dependencies of `name`, with the
+    same arguments as the reverse dependencies."""
+    relations, arch, transitive = _relation_args()
+    related = pkgdb.index(repo).depends(name, relations, arch, transitive)
+    if related is None:
+        abort(404)
+    return _json_from_related(related)
+
+@app.route("/p/<repo>/changes", methods=['GET'])
+def get_changes(repo):
+    """Return the changes of a repository as a JSON array, oldest first.
+
+    Only the changes after the token in the `since` argument are returned,
+    up to `limit` of them. The `X-Next-Token` header of the response gives
+    the `since` argument to poll for the following changes.
+    """
+    since = request.args.get('since') or None
+    try:
+        limit = int(request.args.get('limit', _CHANGES_LIMIT))
+        if not 0 < limit <= _CHANGES_LIMIT:
+            raise ValueError("invalid limit")
+        changes = pkgdb.changes(repo, since, limit)
+    except ValueError:
+        abort(400)
+    response = Response(json.dumps(changes), mimetype='application/json')
+    token = changes[-1]['token'] if changes else since
+    if token:
+        response.headers['X-Next-Token'] = token
+    return response
+
+@app.route("/p/<repo>/prune", methods=['POST'])
+def prune_packages(repo):
+    """Delete packages published before a date or matching a name pattern.
+
+    Query arguments are `before` (a date), `match` (a glob pattern matched
+    against package names) and `dry_run`. Returns the deleted packages.
+    """
+    before = request.args.get('before', None)
+    match = request.args.get('match', None)
+    dry_run = request.args.get('dry_run', "") not in ("", "0", "false")
+    if before is None and match is None:
+        abort(400)
+
+    if before is not None:
+        try:
+            before = dateparser.parse(before)
+        except (ValueError, OverflowError):
+            abort(400)
+        if before.tzinfo is not None:
+            before = before.astimezone(timezone.utc).replace(tzinfo=None)
+
+    pkgs = pkgdb.prune(repo, before=before, match=match, dry_run=dry_run)
+    return json.dumps([{ 'arch': pkg.arch, 'name': pkg.name,
+                         'version': pkg.version } for pkg in pkgs])
+
+def _publish_report(filenames, results):
+    report = []
+    for filename, (pkg, error) in zip(filenames, results):
+        entry = { 'filename': filename, 'error': None }
+        if pkg is not None:
+            entry.update(arch=pkg.arch, name=pkg.name, version=pkg.version)
+        else:
+            entry['error'] = str(error)
+        report.append(entry)
+    return report
+
+def _publish_job(repo, filenames, files):
+    try:
+        return _publish_report(filenames, pkgdb.publish_many(repo, files))
+    finally:
+        for pkgfile, sigfile in files:
+            pkgfile.close()
+
 @app.route("/p/<repo>/", methods=['POST'])
 def post_package_file(repo):
-    """Upload and publish a package."""
-    pkgupload = request.files.get('package', None)
-    if not pkgupload or not pkgupload.filename.endswith(".pkg.tar.xz"):
-        abort(401)
+    """Upload and publish one or more packages.
+
+    Packages are sent as form data, or uploaded in chunks beforehand and
+    given by the `upload` arguments. A single package is answered with a
+    redirect to its metadata, and several packages with a JSON report for
+    each package. With the `async` argument, the packages are published by
+    a background job after the upload, and the request is answered with 202
+    and the job id.
+    """
+    background = request.args.get('async', "0") != "0"
+    uploadids = request.args.getlist('upload')
+    uploads = []
+    submitted = []
+    published = False
+
+    # stream each package archive straight into a package upload, or spool
+    # it to disk for a background job
+    def _stream_factory(total_content_length, content_type, filename,
+                        content_length=None):
+        if filename.endswith(".sig") and is_package_filename(filename[:-4]):
+            return io.BytesIO()
+        if not is_package_filename(filename):
+            abort(401)
+        if background:
+            uploads.append(tempfile.TemporaryFile(
+                dir=_data_abspath("uploads")))
+        else:
+            uploads.append(pkgdb.upload(repo))
+        return uploads[-1]
+
+    try:
+        _, _, files = parse_form_data(request.environ,
+            stream_factory=_stream_factory,
+            max_content_length=app.config.get('MAX_CONTENT_LENGTH'))
+
+        pkguploads = [(upload.filename, upload.stream)
+                      for upload in files.getlist('package')
+                      if upload.stream in uploads]
+        for uploadid in uploadids:
+            try:
+                pkguploads.append(sessions.open(repo, uploadid))
+            except KeyError:
+                abort(404)
+            except ValueError:
+                abort(409)
+            uploads.append(pkguploads[-1][1])
+        if not pkguploads:
+            abort(401)
 
-    sigupload = request.files.get('signature', None)
-    if sigupload and not sigupload.filename.endswith(".pkg.tar.xz.sig"):
+        # pair signatures with packages by file name
+        siguploads = files.getlist('signature')
+        if any(not upload.filename.endswith(".sig") or
+               not is_package_filename(upload.filename[:-4])
+               for upload in siguploads):
+            abort(401)
+        sigfiles = { upload.filename[:-4]: upload.stream
+                     for upload in siguploads }
+        if len(pkguploads) == 1 and len(siguploads) == 1:
+            sigfiles = { pkguploads[0][0]: siguploads[0].stream }
+
+        filenames = [filename for filename, stream in pkguploads]
+        pairs = [(stream, sigfiles.get(filename, None))
+                 for filename, stream in pkguploads]
+
+        if background:
+            jobid = jobs.submit(_publish_job, repo, filenames, pairs)
+            submitted = [stream for filename, stream in pkguploads]
+            published = True
+            response = Response(json.dumps(jobs.status(jobid)), status=202,
+                                mimetype='application/json')
+            response.headers['Location'] = url_for('get_job', jobid=jobid)
+            return response
+
+        published = True
+        results = pkgdb.publish_many(repo, pairs)
+    finally:
+        # discard any upload that was not published, and upload sessions
+        # once published, as their open files remain readable
+        if published:
+            for uploadid in uploadids:
+                sessions.remove(repo, uploadid)
+        for upload in uploads:
+            if isinstance(upload, PackageUpload):
+                upload.abort()
+            elif upload not in submitted:
+                upload.close()
+
+    if len(results) == 1:
+        pkg, error = results[0]
+        if isinstance(error, ValueError):
+            abort(401)
+        if error is not None:
+            raise error
+        pkgurl = url_for('get_package', repo=repo, arch=pkg.arch,
+                         name=pkg.name)
+        return redirect(pkgurl)
+
+    return json.dumps(_publish_report(filenames, results))
+
+def _upload_response(session, status=200):
+    response = Response(json.dumps(session), status=status,
+                        mimetype='application/json')
+    response.headers['Location'] = url_for('get_upload', repo=session['repo'],
+                                           uploadid=session['id'])
+    return response
+
+@app.route("/p/<repo>/uploads", methods=['POST'])
+def post_upload(repo):
+    """Start an upload in chunks of a package file.
+
+    Arguments are the package `filename` and its `size`. Chunks are then
+    sent with PUT requests to the upload, each with a Content-Range header,
+    and the package is published by POST /p/<repo>/?upload=<id>.
+    """
+    filename = request.args.get('filename', "")
+    if not is_package_filename(filename) or "/" in filename:
         abort(401)
+    try:
+        size = int(request.args.get('size', ""))
+    except ValueError:
+        abort(400)
+    if size <= 0:
+        abort(400)
+    maxsize = app.config.get('MAX_CONTENT_LENGTH')
+    if maxsize is not None and size > maxsize:
+        abort(413)
+    return _upload_response(sessions.create(repo, filename, size), 201)
+
+@app.route("/p/<repo>/uploads/<uploadid>", methods=['GET'])
+def get_upload(repo, uploadid):
+    """Return the state of an upload, including the ranges received."""
+    session = sessions.status(repo, uploadid)
+    if session is None:
+        abort(404)
+    return _upload_response(session)
+
+@app.route("/p/<repo>/uploads/<uploadid>", methods=['PUT'])
+def put_upload_chunk(repo, uploadid):
+    """Write the chunk of an upload given by the Content-Range header."""
+    crange = parse_content_range_header(request.headers.get('Content-Range'))
+    if crange is None or crange.units != 'bytes' or crange.start is None \
+       or request.content_length != crange.stop - crange.start:
+        abort(400)
+    try:
+        sessions.write(repo, uploadid, crange.start, crange.stop,
+                       request.stream)
+    except KeyError:
+        abort(404)
+    except ValueError:
+        abort(400)
+    return "", 204
+
+@app.route("/p/<repo>/uploads/<uploadid>", methods=['DELETE'])
+def delete_upload(repo, uploadid):
+    """Discard an upload."""
+    if not sessions.remove(repo, uploadid):
+        abort(404)
+    return ""
+
+@app.route("/jobs/<jobid>", methods=['GET'])
+def get_job(jobid):
+    """Return the state of a background job."""
+    job = jobs.status(jobid)
+    if job is None:
+        abort(404)
+    return Response(json.dumps(job), mimetype='application/json')
 
-    def _save_upload(upload):
-        filepath = _data_abspath(secure_filename(upload.filename))
-        upload.save(filepath)
-        return filepath
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    """Return the metrics of all server processes for Prometheus."""
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
 
-    pkgfilepath = _save_upload(pkgupload)
-    sigfilepath = _save_upload(sigupload) if sigupload else None
+def _readiness():
+    """Return the status and body of the answer to /readyz."""
+    if _warmup['ready']:
+        return 200, "ready\n"
+    if _warmup['error']:
+        return 503, "warm-up failed: %s\n" % _warmup['error']
+    return 503, "warming up\n"
 
-    pkgfile = open(pkgfilepath, 'rb')
-    sigfile = open(sigfilepath, 'rb') if sigfilepath else None
+@app.route("/healthz", methods=['GET'])
+def get_health():
+    """Return 200 while this server process is running."""
+    return Response("ok\n", mimetype='text/plain')
 
-    pkg = pkgdb.publish(repo, pkgfile, sigfile)
+@app.route("/readyz", methods=['GET'])
+def get_readiness():
+    """Return 200 once this server process has warmed up its caches, or
+    503 until then."""
+    status, body = _readiness()
+    return Response(body, status=status, mimetype='text/plain')
 
-    pkgurl = url_for('get_package', repo=repo, arch=pkg.arch, name=pkg.name)
-    return redirect(pkgurl)
+@app.route("/stats", methods=['GET'])
+def get_stats():
+    """Return cache statistics of this server process."""
+    return json.dumps(pkgdb.stats())
@@ -0,0 +1,125 @@
+"""Tests of `s3pac.database` on the local stores.
+
+Run with `python3 -m unittest discover tests`.
+"""
+import io, os, lzma, shutil, tarfile, tempfile, unittest
+from datetime import timedelta
+
+from s3pac.database import PackageDatabase
+from s3pac.local import SQLiteMetadataStore, LocalBlobStore
+
+def make_package(name, version="1-1", arch='x86_64', files=()):
+    """Return a package archive installing `files`, and its filename."""
+    pkginfo = "pkgname = %s\npkgbase = %s\npkgver = %s\narch = %s\n" \
+              "builddate = 0\nsize = 0\n" % (name, name, version, arch)
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for path, content in [(".PKGINFO", pkginfo.encode('utf-8'))] + \
+                             [(path, path.encode('utf-8')) for path in files]:
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    filename = "%s-%s-%s.pkg.tar.xz" % (name, version, arch)
+    return io.BytesIO(lzma.compress(data.getvalue())), filename
+
+def database_members(data):
+    """Return the members of a database file by path."""
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return { member.name: tar.extractfile(member).read()
+                 for member in tar.getmembers() if member.isfile() }
+
+class PackageDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.pkgdb = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def open(self, **kwargs):
+        """Return a new database instance, as in another process."""
+        return PackageDatabase(
+            SQLiteMetadataStore(os.path.join(self.root, "s3pac.sqlite")),
+            LocalBlobStore(os.path.join(self.root, "packages")), **kwargs)
+
+    def settle(self, pkgdb):
+        """Wait for the snapshots built in the background."""
+        pkgdb._snapshot_executor.submit(lambda: None).result()
+
+    def snapshot_blobs(self, repo):
+        path = os.path.join(self.root, "packages", repo, ".snapshots")
+        return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+    def test_republished_files(self):
+        pkgfile, _ = make_package('foo', files=["usr/bin/old"])
+        self.pkgdb.publish('core', pkgfile, None)
+        files = database_members(self.pkgdb.database('core', 'x86_64',
+                                                     files=True))
+        self.assertIn(b"usr/bin/old", files['foo-1-1/files'])
+
+        # same filename, different contents
+        other = self.open()
+        other.database('core', 'x86_64', files=True)
+        pkgfile, _ = make_package('foo', files=["usr/bin/new"])
+        self.pkgdb.publish('core', pkgfile, None)
+        for pkgdb in (self.pkgdb, other, self.open()):
+            files = database_members(pkgdb.database('core', 'x86_64',
+                                                    files=True))
+            self.assertIn(b"usr/bin/new", files['foo-1-1/files'])
+            self.assertNotIn(b"usr/bin/old", files['foo-1-1/files'])
+
+    def test_stamps(self):
+        stamps = []
+        for name in ('foo', 'bar', 'baz'):
+            self.pkgdb.publish('core', make_package(name)[0], None)
+            stamps.append(self.open().stamp('core'))
+        for previous, stamp in zip(stamps, stamps[1:]):
+            self.assertEqual(stamp.microsecond, 0)
+            self.assertGreaterEqual(stamp - previous, timedelta(seconds=1))
+
+    def test_database_cache(self):
+        pkgdb = self.open(database_cache_size=1)
+        pkgdb.publish('core', make_package('foo')[0], None)
+        data = pkgdb.database('core', 'x86_64')
+        self.assertEqual(pkgdb.cached_database('core', 'x86_64',
+                                               pkgdb.stamp('core')), data)
+        pkgdb.database('core', 'i686')
+        self.assertEqual(len(pkgdb._databases), 1)
+        self.assertIsNone(pkgdb.cached_database('core', 'x86_64',
+                                                pkgdb.stamp('core')))
+
+    def test_snapshots_of_removed_architecture(self):
+        pkgdb = self.open(snapshot_compression='gz')
+        pkgdb.publish('core', make_package('foo')[0], None)
+        pkgdb.publish('core', make_package('bar', arch='i686')[0], None)
+        self.settle(pkgdb)
+        snapshot = pkgdb.snapshot('core', 'i686', pkgdb.stamp('core'))
+        self.assertIn(os.path.basename(snapshot['keyname']),
+                      self.snapshot_blobs('core'))
+
+        pkgdb.delete(repo='core', arch='i686', name='bar')
+        self.settle(pkgdb)
+        self.assertEqual(sorted(pkgdb.metadata.get_snapshots('core')),
+                         ['x86_64.db.gz', 'x86_64.files.gz'])
+        self.assertIsNone(pkgdb.snapshot('core', 'i686',
+                                         pkgdb.stamp('core')))
+        self.assertNotIn(os.path.basename(snapshot['keyname']),
+                         self.snapshot_blobs('core'))
+
+    def test_snapshots_of_changed_repository(self):
+        pkgdb = self.open(snapshot_compression='gz')
+        pkgdb.publish('core', make_package('foo')[0], None)
+        self.settle(pkgdb)
+        blobs = self.snapshot_blobs('core')
+
+        # the repository changes while the snapshot is built
+        stamp = pkgdb.stamp('core')
+        stamps = [stamp, stamp + timedelta(seconds=1)]
+        pkgdb.stamp = lambda repo: stamps.pop(0) if stamps else stamp
+        pkgdb._databases.clear()
+        pkgdb.snapshot_compression = 'xz'
+        pkgdb.snapshot_databases('core')
+        self.assertEqual(self.snapshot_blobs('core'), blobs)
+
+if __name__ == '__main__':
+    unittest.main()